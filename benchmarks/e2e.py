@@ -0,0 +1,288 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+End-to-end benchmark: drives the API and the runners against fake cloud
+providers and a fake varnishadm, reporting how long it takes for instances
+to start, for binds to get their VCL applied and for scale jobs to finish,
+along with the latency of the API calls.
+
+Usage::
+
+    python -m benchmarks.e2e --instances 1000 --binds 1 --scale 100
+
+The VCL of an instance is written once, with its first bind, so the time for
+the VCL to get applied is measured per instance, from the first bind request.
+Items that do not finish before ``--timeout`` are reported as timeouts.
+
+The fake varnishadm listens on port 6082 (the port used by the runners), so
+it must be available on the machine running the benchmark.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import urllib
+import urllib2
+from multiprocessing.pool import ThreadPool
+
+from werkzeug import serving
+
+from benchmarks import fakes
+
+
+def percentiles(values, points=(50, 90, 99)):
+    if not values:
+        return None
+    values = sorted(values)
+    result = {"count": len(values), "max": values[-1]}
+    for point in points:
+        index = min(len(values) - 1, int(round(point / 100.0 * (len(values) - 1))))
+        result["p{}".format(point)] = values[index]
+    return result
+
+
+class Recorder(object):
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, latency, ok):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(latency)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+
+class Client(object):
+
+    def __init__(self, url, recorder):
+        self.url = url
+        self.recorder = recorder
+
+    def request(self, name, method, path, data=None):
+        body = urllib.urlencode(data) if data is not None else None
+        req = urllib2.Request(self.url + path, data=body)
+        req.get_method = lambda: method
+        start = time.time()
+        status = None
+        try:
+            resp = urllib2.urlopen(req)
+            status = resp.getcode()
+            resp.read()
+        except urllib2.HTTPError as e:
+            status = e.code
+        except Exception:
+            pass
+        finished = time.time()
+        self.recorder.record(name, finished - start, status is not None and status < 400)
+        return start, status
+
+
+def configure_env(args, ec2, cloudstack):
+    os.environ.setdefault("API_PACKAGES", "varnish")
+    os.environ["API_MANAGER"] = args.manager
+    os.environ["API_STORAGE"] = args.storage
+    os.environ["API_MONGODB_URI"] = args.mongodb_uri
+    os.environ["API_MONGODB_DATABASE_NAME"] = args.database
+    os.environ["EC2_ENDPOINT"] = "http://{}:{}/".format(ec2.host, ec2.port)
+    os.environ["EC2_ACCESS_KEY"] = "bench"
+    os.environ["EC2_SECRET_KEY"] = "bench"
+    cloudstack_url = "http://{}:{}/client/api".format(cloudstack.host, cloudstack.port)
+    os.environ["CLOUDSTACK_API_URL"] = cloudstack_url
+    os.environ["CLOUDSTACK_API_KEY"] = "bench"
+    os.environ["CLOUDSTACK_SECRET_KEY"] = "bench"
+    os.environ["CLOUDSTACK_TEMPLATE_ID"] = "template"
+    os.environ["CLOUDSTACK_ZONE_ID"] = "zone"
+    os.environ["CLOUDSTACK_SERVICE_OFFERING_ID"] = "offering"
+
+
+def reset_storage(strg):
+    db = getattr(strg, "db", None)
+    if db is not None:
+        db.connection.drop_database(db.name)
+    strg.ensure_indexes()
+
+
+def wait_for(pending, check, timeout, interval=0.2):
+    done = {}
+    deadline = time.time() + timeout
+    while pending and time.time() < deadline:
+        now = time.time()
+        for key in check(pending):
+            done[key] = now - pending.pop(key)
+        if pending:
+            time.sleep(interval)
+    return done
+
+
+def started_instances(strg):
+    def check(pending):
+        return [i.name for i in strg.retrieve_instances(state="started") if i.name in pending]
+    return check
+
+
+def scaled_instances(strg, quantity):
+    def check(pending):
+        return [i.name for i in strg.retrieve_instances(state="started")
+                if i.name in pending and len(i.units) == quantity]
+    return check
+
+
+def first_binds(binds, bound):
+    first = {}
+    for (name, host), at in zip(binds, bound):
+        first.setdefault(name, (host, at))
+    return dict(first.values())
+
+
+def applied_vcls(varnishadm):
+    def check(pending):
+        with varnishadm.lock:
+            applied = dict(varnishadm.applied_at)
+        return [host for host in pending if host in applied]
+    return check
+
+
+def run(args):
+    from feaas import api
+    from feaas.runners import supervisor
+
+    # python-varnish calls logging.basicConfig(level=DEBUG) when imported by
+    # feaas.api, so the root level can only be raised after the import.
+    logging.getLogger().setLevel(logging.WARNING)
+
+    secrets = fakes.Secrets()
+    ec2 = fakes.FakeEC2(secrets=secrets).start()
+    cloudstack = fakes.FakeCloudStack(job_latency=args.job_latency, secrets=secrets).start()
+    varnishadm = fakes.FakeVarnishadm(port=args.varnishadm_port, secrets=secrets).start()
+    configure_env(args, ec2, cloudstack)
+
+    manager = api.get_manager()
+    reset_storage(manager.storage)
+    server = serving.make_server("127.0.0.1", 0, api.api, threaded=True)
+    t = threading.Thread(target=server.serve_forever, name="api")
+    t.daemon = True
+    t.start()
+    recorder = Recorder()
+    client = Client("http://127.0.0.1:{}".format(server.server_port), recorder)
+    sup = supervisor.Supervisor(manager, ["vcl_writer", "instance_starter",
+                                          "instance_terminator", "instance_scalator"],
+                                interval=args.interval)
+    sup.start()
+    pool = ThreadPool(args.clients)
+    names = ["bench{}".format(i) for i in xrange(args.instances)]
+    results = {}
+    timed_out = {}
+    try:
+        began = time.time()
+        created = pool.map(lambda n: client.request("POST /resources", "POST", "/resources",
+                                                    {"name": n})[0], names)
+        pending = dict(zip(names, created))
+        binds = [(n, "{}-app{}.bench".format(n, j)) for n in names for j in xrange(args.binds)]
+        bound = pool.map(lambda b: client.request("POST /resources/<name>/bind-app", "POST",
+                                                  "/resources/{}/bind-app".format(b[0]),
+                                                  {"app-host": b[1]})[0], binds)
+        pending_vcls = first_binds(binds, bound)
+        results["time_to_started"] = wait_for(pending, started_instances(manager.storage),
+                                              args.timeout)
+        timed_out["time_to_started"] = len(pending)
+        results["time_to_vcl_applied"] = wait_for(pending_vcls, applied_vcls(varnishadm),
+                                                  args.timeout)
+        timed_out["time_to_vcl_applied"] = len(pending_vcls)
+        to_scale = names[:args.scale]
+        scaled = pool.map(lambda n: client.request("POST /resources/<name>/scale", "POST",
+                                                   "/resources/{}/scale".format(n),
+                                                   {"quantity": 2})[0], to_scale)
+        pending_scales = dict(zip(to_scale, scaled))
+        results["time_to_scaled"] = wait_for(pending_scales,
+                                             scaled_instances(manager.storage, 2),
+                                             args.timeout)
+        timed_out["time_to_scaled"] = len(pending_scales)
+        pool.map(lambda n: client.request("GET /resources/<name>/status", "GET",
+                                          "/resources/{}/status".format(n)), names)
+        elapsed = time.time() - began
+    finally:
+        pool.close()
+        sup.stop()
+        server.shutdown()
+        for service in (ec2, cloudstack, varnishadm):
+            service.stop()
+    return report(args, results, timed_out, recorder, varnishadm, elapsed)
+
+
+def report(args, results, timed_out, recorder, varnishadm, elapsed):
+    data = {"instances": args.instances, "binds": args.instances * args.binds,
+            "scale_jobs": args.scale, "elapsed": elapsed,
+            "vcl_pushes": varnishadm.pushes, "auth_failures": varnishadm.auth_failures,
+            "timings": {}, "api": {}}
+    for name, done in sorted(results.items()):
+        data["timings"][name] = percentiles(done.values()) or {"count": 0}
+        data["timings"][name]["timeouts"] = timed_out.get(name, 0)
+    for name, latencies in sorted(recorder.latencies.items()):
+        data["api"][name] = percentiles(latencies)
+        data["api"][name]["errors"] = recorder.errors.get(name, 0)
+    return data
+
+
+def print_report(data, out=sys.stdout):
+    out.write("{instances} instances, {binds} binds, {scale_jobs} scale jobs "
+              "in {elapsed:.1f}s ({vcl_pushes} VCL pushes, "
+              "{auth_failures} auth failures)\n\n".format(**data))
+    header = "{:<40} {:>7} {:>9} {:>9} {:>9} {:>9} {:>7} {:>8}\n"
+    row = "{:<40} {:>7} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>7} {:>8}\n"
+    empty = "{:<40} {:>7} {:>9} {:>9} {:>9} {:>9} {:>7} {:>8}\n"
+    out.write(header.format("seconds", "count", "p50", "p90", "p99", "max", "errors",
+                            "timeouts"))
+    sections = [(name, stats) for name, stats in sorted(data["timings"].items())]
+    sections += [(name, stats) for name, stats in sorted(data["api"].items())]
+    for name, stats in sections:
+        if not stats.get("count"):
+            out.write(empty.format(name, 0, "", "", "", "", stats.get("errors", ""),
+                                   stats.get("timeouts", "")))
+            continue
+        out.write(row.format(name, stats["count"], stats["p50"], stats["p90"],
+                             stats["p99"], stats["max"], stats.get("errors", ""),
+                             stats.get("timeouts", "")))
+
+
+def main():
+    parser = argparse.ArgumentParser("End-to-end benchmark for the API and runners")
+    parser.add_argument("-m", "--manager", choices=["ec2", "cloudstack"], default="ec2")
+    parser.add_argument("-n", "--instances", type=int, default=1000,
+                        help="Number of instances to create")
+    parser.add_argument("-b", "--binds", type=int, default=1,
+                        help="Number of binds per instance (the VCL is timed on the first)")
+    parser.add_argument("-s", "--scale", type=int, default=100,
+                        help="Number of instances to scale to two units")
+    parser.add_argument("-c", "--clients", type=int, default=16,
+                        help="Number of concurrent API clients")
+    parser.add_argument("-i", "--interval", type=float, default=0.1,
+                        help="Interval for running each runner (in seconds)")
+    parser.add_argument("--job-latency", type=float, default=1,
+                        help="Latency of CloudStack async jobs (in seconds)")
+    parser.add_argument("--varnishadm-port", type=int, default=6082)
+    parser.add_argument("--storage", choices=["mongodb", "memory"], default="mongodb")
+    parser.add_argument("--mongodb-uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--database", default="feaas_bench",
+                        help="Database used by the benchmark (dropped before running)")
+    parser.add_argument("--timeout", type=float, default=600,
+                        help="Maximum time to wait for each phase (in seconds)")
+    parser.add_argument("--json", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+    data = run(args)
+    print_report(data)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import base64
+import BaseHTTPServer
+import hashlib
+import itertools
+import json
+import os
+import re
+import socket
+import SocketServer
+import threading
+import time
+import urlparse
+
+SECRET_RE = re.compile(r"echo (\S+) > /etc/varnish/secret")
+APP_HOST_RE = re.compile(r'\.host = \\?"([^"\\]+)\\?"')
+
+
+class Secrets(object):
+    """
+    Secrets collects the varnishadm secrets sent by the manager in the user
+    data of each new unit, so the fake varnishadm can check the auth response
+    like a real varnish would.
+    """
+
+    def __init__(self):
+        self.secrets = set()
+        self.lock = threading.Lock()
+
+    def add_from_user_data(self, user_data):
+        match = SECRET_RE.search(user_data or "")
+        if match:
+            with self.lock:
+                self.secrets.add(match.group(1))
+
+    def check(self, challenge, response):
+        return self.match(challenge, response) is not None
+
+    def match(self, challenge, response):
+        with self.lock:
+            secrets = list(self.secrets)
+        for secret in secrets:
+            expected = hashlib.sha256("{0}\n{1}\n{0}\n".format(challenge, secret))
+            if expected.hexdigest() == response:
+                return secret
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeService(object):
+    handler_class = None
+
+    def __init__(self, host="127.0.0.1", port=0, unit_address="127.0.0.1", secrets=None):
+        self.unit_address = unit_address
+        self.secrets = secrets
+        self.ids = itertools.count(1)
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.server = Server((host, port), self.handler_class)
+        self.server.service = self
+        self.host, self.port = self.server.server_address[:2]
+
+    def new_id(self, prefix):
+        return "{}-{:08x}".format(prefix, next(self.ids))
+
+    def record(self, action):
+        with self.lock:
+            self.calls[action] = self.calls.get(action, 0) + 1
+
+    def start(self):
+        t = threading.Thread(target=self.server.serve_forever, name=self.__class__.__name__)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class EC2Handler(FakeHandler):
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        params = dict(urlparse.parse_qsl(self.rfile.read(length)))
+        self.handle_action(params)
+
+    def do_GET(self):
+        self.handle_action(dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query)))
+
+    def handle_action(self, params):
+        action = params.get("Action")
+        self.service.record(action)
+        if action == "RunInstances":
+            body = self.service.run_instances(params)
+        elif action == "TerminateInstances":
+            body = self.service.terminate_instances(params)
+        else:
+            body = ("<Response><Errors><Error><Code>InvalidAction</Code>"
+                    "<Message>{}</Message></Error></Errors></Response>").format(action)
+            return self.reply(400, body, "text/xml")
+        self.reply(200, body, "text/xml")
+
+
+class FakeEC2(FakeService):
+    """
+    FakeEC2 answers the RunInstances and TerminateInstances calls made by
+    :class:`feaas.managers.ec2.EC2Manager`. New instances point to
+    ``unit_address``, where the fake varnishadm is expected to listen.
+    """
+    handler_class = EC2Handler
+
+    def run_instances(self, params):
+        if self.secrets is not None and "UserData" in params:
+            self.secrets.add_from_user_data(base64.b64decode(params["UserData"]))
+        instance_id = self.new_id("i")
+        return ("<RunInstancesResponse>"
+                "<requestId>{0}</requestId><reservationId>r-{0}</reservationId>"
+                "<ownerId>000000000000</ownerId><groupSet/>"
+                "<instancesSet><item><instanceId>{0}</instanceId>"
+                "<imageId>{1}</imageId>"
+                "<instanceState><code>0</code><name>pending</name></instanceState>"
+                "<dnsName>{2}</dnsName><privateDnsName>{2}</privateDnsName>"
+                "</item></instancesSet></RunInstancesResponse>").format(
+                    instance_id, params.get("ImageId", "ami-bench"), self.unit_address)
+
+    def terminate_instances(self, params):
+        items = []
+        for key, value in sorted(params.items()):
+            if key.startswith("InstanceId."):
+                items.append("<item><instanceId>{}</instanceId>"
+                             "<currentState><code>32</code><name>shutting-down</name>"
+                             "</currentState></item>".format(value))
+        return ("<TerminateInstancesResponse><requestId>t</requestId>"
+                "<instancesSet>{}</instancesSet></TerminateInstancesResponse>").format(
+                    "".join(items))
+
+
+class CloudStackHandler(FakeHandler):
+
+    def do_GET(self):
+        params = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+        command = params.get("command", "")
+        self.service.record(command)
+        method = getattr(self.service, command, None)
+        if method is None:
+            result = {"errorcode": 432, "errortext": "unknown command {}".format(command)}
+        else:
+            result = method(params)
+        body = json.dumps({command.lower() + "response": result})
+        self.reply(200, body, "application/json")
+
+
+class FakeCloudStack(FakeService):
+    """
+    FakeCloudStack answers the calls made by
+    :class:`feaas.managers.cloudstack.CloudStackManager`. Each deployed VM
+    is returned by an async job that only completes after ``job_latency``
+    seconds.
+    """
+    handler_class = CloudStackHandler
+
+    def __init__(self, job_latency=0, **kwargs):
+        super(FakeCloudStack, self).__init__(**kwargs)
+        self.job_latency = job_latency
+        self.jobs = {}
+        self.vms = {}
+
+    def deployVirtualMachine(self, params):
+        if self.secrets is not None and "userdata" in params:
+            self.secrets.add_from_user_data(base64.b64decode(params["userdata"]))
+        vm_id = self.new_id("vm")
+        job_id = self.new_id("job")
+        with self.lock:
+            self.vms[vm_id] = {"id": vm_id, "group": params.get("group"),
+                               "nic": [{"ipaddress": self.unit_address,
+                                        "networkname": "public"}]}
+            self.jobs[job_id] = (time.time() + self.job_latency, vm_id)
+        return {"id": vm_id, "jobid": job_id}
+
+    def queryAsyncJobResult(self, params):
+        with self.lock:
+            job = self.jobs.get(params.get("jobid"))
+        if job is None:
+            return {"errorcode": 431, "errortext": "job not found"}
+        ready_at, vm_id = job
+        if time.time() < ready_at:
+            return {"jobid": params["jobid"], "jobstatus": 0}
+        return {"jobid": params["jobid"], "jobstatus": 1,
+                "jobresult": {"virtualmachine": self.vms[vm_id]}}
+
+    def listVirtualMachines(self, params):
+        with self.lock:
+            vm = self.vms.get(params.get("id"))
+        if vm is None:
+            return {"count": 0}
+        return {"count": 1, "virtualmachine": [vm]}
+
+    def destroyVirtualMachine(self, params):
+        with self.lock:
+            self.vms.pop(params.get("id"), None)
+        return {"jobid": self.new_id("job")}
+
+
+class VarnishadmHandler(SocketServer.StreamRequestHandler):
+
+    def send(self, status, body=""):
+        self.wfile.write("{} {:<8}\n{}\n".format(status, len(body), body))
+
+    def handle(self):
+        service = self.server.service
+        try:
+            challenge = os.urandom(16).encode("hex")
+            self.send(107, challenge + "\n\nAuthentication required.")
+            target = None
+            for line in iter(self.rfile.readline, ""):
+                parts = line.strip().split(" ", 2)
+                command = parts[0]
+                if not command:
+                    continue
+                if command == "auth":
+                    target = service.authenticate(challenge, parts[1])
+                    if target is not None:
+                        self.send(200, "Authenticated.")
+                    else:
+                        self.send(107, challenge + "\n\nAuthentication required.")
+                elif target is None:
+                    self.send(107, challenge + "\n\nAuthentication required.")
+                elif command == "vcl.inline" and len(parts) == 3:
+                    self.send(*service.vcl_inline(target, parts[1], parts[2]))
+                elif command == "vcl.use" and len(parts) == 2:
+                    self.send(*service.vcl_use(target, parts[1]))
+                elif command == "vcl.discard" and len(parts) == 2:
+                    self.send(*service.vcl_discard(target, parts[1]))
+                elif command == "ping":
+                    self.send(200)
+                else:
+                    self.send(101, "Unknown request.")
+        except socket.error:
+            pass
+
+
+class VarnishadmServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeVarnishadm(object):
+    """
+    FakeVarnishadm listens like the management port of varnish (6082 by
+    default), sends the auth challenge, and records every VCL pushed through
+    ``vcl.inline``, keeping the time when each application host first got
+    its VCL applied.
+
+    All units share the same address, so the VCL programs loaded in each
+    unit are tracked by the secret the connection authenticated with. Like
+    varnishd, it answers 106 when loading a program whose name is taken,
+    and when using or discarding a program that isn't loaded (or discarding
+    the active one).
+    """
+
+    def __init__(self, host="127.0.0.1", port=6082, secrets=None):
+        self.secrets = secrets
+        self.server = VarnishadmServer((host, port), VarnishadmHandler)
+        self.server.service = self
+        self.host, self.port = self.server.server_address[:2]
+        self.pushes = 0
+        self.auth_failures = 0
+        self.applied_at = {}
+        self.configs = {}
+        self.lock = threading.Lock()
+
+    def authenticate(self, challenge, response):
+        if self.secrets is None:
+            return ""
+        secret = self.secrets.match(challenge, response)
+        if secret is None:
+            with self.lock:
+                self.auth_failures += 1
+        return secret
+
+    def _configs(self, target):
+        return self.configs.setdefault(target, {"loaded": set(["boot"]), "active": "boot"})
+
+    def vcl_inline(self, target, name, vcl):
+        with self.lock:
+            configs = self._configs(target)
+            if name in configs["loaded"]:
+                return 106, "Already a VCL program named {}".format(name)
+            configs["loaded"].add(name)
+        self.record_push(name, vcl)
+        return 200, "VCL compiled."
+
+    def vcl_use(self, target, name):
+        with self.lock:
+            configs = self._configs(target)
+            if name not in configs["loaded"]:
+                return 106, "No configuration named {} known.".format(name)
+            configs["active"] = name
+        return 200, ""
+
+    def vcl_discard(self, target, name):
+        with self.lock:
+            configs = self._configs(target)
+            if name not in configs["loaded"]:
+                return 106, "No configuration named {} known.".format(name)
+            if configs["active"] == name:
+                return 106, "Cannot discard active VCL program"
+            configs["loaded"].discard(name)
+        return 200, ""
+
+    def record_push(self, name, vcl):
+        now = time.time()
+        match = APP_HOST_RE.search(vcl)
+        with self.lock:
+            self.pushes += 1
+            if match:
+                self.applied_at.setdefault(match.group(1), now)
+
+    def start(self):
+        t = threading.Thread(target=self.server.serve_forever, name="FakeVarnishadm")
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
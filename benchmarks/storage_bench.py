@@ -0,0 +1,229 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Micro-benchmarks for the hot paths of the storages and their lockers, run
+against collections seeded with different numbers of documents. Results are
+written as JSON, and may be compared against the results of a previous run::
+
+    python -m benchmarks.storage_bench --output 0.10.0.json
+    python -m benchmarks.storage_bench --compare 0.10.0.json
+    python -m benchmarks.storage_bench --storage memory
+
+With MongoDB, the database defined by ``--database`` is dropped before seeding
+each size.
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import random
+import sys
+import time
+
+import pymongo
+
+import feaas
+from benchmarks.e2e import percentiles
+from feaas import storage
+
+BATCH_SIZE = 1000
+
+
+def instance_name(i):
+    return "instance{}".format(i)
+
+
+def seed(strg, size):
+    db = getattr(strg, "db", None)
+    if db is not None:
+        db.connection.drop_database(db.name)
+    else:
+        strg = storage.MemoryStorage()
+    strg.ensure_indexes()
+    now = datetime.datetime.utcnow()
+    for start in xrange(0, size, BATCH_SIZE):
+        instances, units, binds = [], [], []
+        for i in xrange(start, min(size, start + BATCH_SIZE)):
+            name = instance_name(i)
+            shard = storage.shard_of(name)
+            instances.append(storage.Instance(name=name, state="started").to_dict())
+            for j in xrange(2):
+                unit = storage.Unit(id="i-{}-{}".format(i, j), secret="secret",
+                                    dns_name="10.0.{}.{}".format(i % 256, j),
+                                    state="started", instance=storage.Instance(name=name))
+                units.append(dict(unit.to_dict(), instance_name=name, shard=shard))
+            bind = storage.Bind("app{}.cloud.tsuru.io".format(i), storage.Instance(name=name),
+                                created_at=now, state="created")
+            binds.append(dict(bind.to_dict(), shard=shard))
+        if db is not None:
+            db[strg.collection_name].insert(instances)
+            db.units.insert(units)
+            db.binds.insert(binds)
+        else:
+            for collection, docs in ((strg.instances, instances), (strg.units, units),
+                                     (strg.binds, binds)):
+                for doc in docs:
+                    collection.insert(doc)
+    return strg
+
+
+class Cases(object):
+
+    def __init__(self, strg, size, rand):
+        self.storage = strg
+        self.size = size
+        self.random = rand
+        self.locker = storage.new_locker(strg)
+        self.locker.init("bench")
+
+    def name(self):
+        return instance_name(self.random.randrange(self.size))
+
+    def instance(self):
+        i = self.random.randrange(self.size)
+        units = [storage.Unit(id="i-{}-{}".format(i, j), secret="secret",
+                              dns_name="10.0.{}.{}".format(i % 256, j), state="started")
+                 for j in xrange(2)]
+        return storage.Instance(name=instance_name(i), state="started", units=units)
+
+    def store_instance(self):
+        self.storage.store_instance(self.instance())
+
+    def store_instance_without_units(self):
+        self.storage.store_instance(self.instance(), save_units=False)
+
+    def retrieve_instance(self):
+        self.storage.retrieve_instance(name=self.name())
+
+    def retrieve_units_in(self):
+        names = [self.name() for i in xrange(100)]
+        self.storage.retrieve_units(instance_name={"$in": names})
+
+    def retrieve_binds(self):
+        self.storage.retrieve_binds(instance_name=self.name(), state="created")
+
+    def update_units(self):
+        self.storage.update_units(self.instance().units, state="started")
+
+    def locker_cycle(self):
+        self.locker.lock("bench")
+        self.locker.unlock("bench")
+
+    def prepare(self, case):
+        return getattr(self, case)
+
+
+CASES = ["store_instance", "store_instance_without_units", "retrieve_instance",
+         "retrieve_units_in", "retrieve_binds", "update_units", "locker_cycle"]
+
+
+def measure(fn, iterations, warmup):
+    for i in xrange(warmup):
+        fn()
+    timings = []
+    began = time.time()
+    for i in xrange(iterations):
+        start = time.time()
+        fn()
+        timings.append(time.time() - start)
+    elapsed = time.time() - began
+    result = percentiles(timings)
+    result["mean"] = sum(timings) / len(timings)
+    result["min"] = min(timings)
+    result["ops_per_second"] = iterations / elapsed if elapsed else None
+    return result
+
+
+def new_storage(args):
+    if args.storage == "memory":
+        return storage.MemoryStorage()
+    return storage.MongoDBStorage(mongo_uri=args.mongodb_uri, dbname=args.database)
+
+
+def run(args):
+    strg = new_storage(args)
+    rand = random.Random(args.seed)
+    results = []
+    for size in args.sizes:
+        sys.stderr.write("seeding {} instances...\n".format(size))
+        strg = seed(strg, size)
+        cases = Cases(strg, size, rand)
+        for case in args.cases:
+            result = measure(cases.prepare(case), args.iterations, args.warmup)
+            result.update({"case": case, "documents": size, "iterations": args.iterations})
+            results.append(result)
+            sys.stderr.write("{:<30} {:>7} docs  p50 {:.6f}s  p99 {:.6f}s\n".format(
+                case, size, result["p50"], result["p99"]))
+    data = {"version": feaas.__version__,
+            "started_at": datetime.datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "storage": args.storage,
+            "iterations": args.iterations,
+            "results": results}
+    if args.storage == "mongodb":
+        data["pymongo"] = pymongo.version
+        data["mongodb"] = strg.db.connection.server_info().get("version")
+        strg.db.connection.drop_database(strg.db.name)
+    return data
+
+
+def compare(baseline, current, threshold):
+    previous = dict([((r["case"], r["documents"]), r) for r in baseline["results"]])
+    regressions = []
+    for result in current["results"]:
+        old = previous.get((result["case"], result["documents"]))
+        if old is None or not old["p50"]:
+            continue
+        change = (result["p50"] - old["p50"]) / old["p50"]
+        if change > threshold:
+            regressions.append({"case": result["case"], "documents": result["documents"],
+                                "baseline_p50": old["p50"], "p50": result["p50"],
+                                "change": change})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser("Micro-benchmarks for the storages")
+    parser.add_argument("--storage", choices=["mongodb", "memory"], default="mongodb")
+    parser.add_argument("--mongodb-uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--database", default="feaas_storage_bench",
+                        help="Database used by the benchmark (dropped before seeding)")
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        type=lambda v: [int(s) for s in v.split(",")],
+                        help="Comma separated numbers of instances to seed")
+    parser.add_argument("--cases", default=",".join(CASES),
+                        type=lambda v: v.split(","),
+                        help="Comma separated cases to run, among: " + ", ".join(CASES))
+    parser.add_argument("-n", "--iterations", type=int, default=500)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("-o", "--output", help="Write the results to this file")
+    parser.add_argument("--compare", help="Results of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Slowdown of the p50 considered a regression (default: 0.2)")
+    args = parser.parse_args()
+    for case in args.cases:
+        if case not in CASES:
+            parser.error("unknown case: {}".format(case))
+    data = run(args)
+    output = json.dumps(data, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), data, args.threshold)
+        for r in regressions:
+            sys.stderr.write("[ERROR] {case} with {documents} documents regressed: "
+                             "p50 {baseline_p50:.6f}s -> {p50:.6f}s\n".format(**r))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,15 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
 import inspect
 import json
 import os
+import time
 
-from flask import Flask, Response, request
+from flask import Flask, Response, g, request
 
-from . import auth, plugin, storage
+from . import auth, cache, metrics, plugin, storage, tracing
 from .managers import cloudstack, ec2
 
 api = Flask(__name__)
@@ -20,17 +22,198 @@ managers = {
 }
 
 
+def mongodb_storage():
+    mongodb_uri = os.environ.get("API_MONGODB_URI")
+    mongodb_database = os.environ.get("API_MONGODB_DATABASE_NAME")
+    return storage.MongoDBStorage(mongo_uri=mongodb_uri, dbname=mongodb_database)
+
+
+storages = {
+    "mongodb": mongodb_storage,
+    "memory": storage.memory_storage,
+}
+
+queue_depths = None
+
+STATUS_CODES = {"started": 204, "pending": 202, "scaling": 204}
+
+BATCH_LIMIT = 1000
+INSTANCE_FIELDS = ["name", "state", "status", "address", "units"]
+
+SCAN_BATCH_SIZE = int(os.environ.get("API_SCAN_BATCH_SIZE", 1000))
+
+
+@api.before_request
+def start_timer():
+    g.started_at = time.time()
+    endpoint = request.url_rule.rule if request.url_rule else "unknown"
+    g.span = tracing.span("http {} {}".format(request.method, endpoint),
+                          trace_id=request.headers.get("X-Trace-Id"),
+                          path=request.path).start()
+
+
+def observe_request(status):
+    started_at = getattr(g, "started_at", None)
+    if started_at is None:
+        return
+    g.started_at = None
+    endpoint = request.url_rule.rule if request.url_rule else "unknown"
+    metrics.http_seconds.observe(time.time() - started_at, method=request.method,
+                                 endpoint=endpoint)
+    metrics.http_requests.inc(method=request.method, endpoint=endpoint, status=status)
+
+
+@api.after_request
+def record_request(response):
+    observe_request(response.status_code)
+    span = getattr(g, "span", None)
+    if span is not None and span.trace_id is not None:
+        response.headers["X-Trace-Id"] = span.trace_id
+    return response
+
+
+@api.teardown_request
+def record_failed_request(exc):
+    if exc is not None:
+        observe_request(500)
+    span = getattr(g, "span", None)
+    if span is not None:
+        g.span = None
+        span.finish(exc)
+
+
+def get_priority(default="interactive"):
+    priority = request.form.get("priority") or request.headers.get("X-Priority")
+    return storage.PRIORITIES.get(priority or default)
+
+
 @api.route("/resources", methods=["POST"])
 @auth.required
 def add_instance():
     name = request.form.get("name")
     if not name:
         return "name is required", 400
+    priority = get_priority()
+    if priority is None:
+        return "invalid priority", 400
     manager = get_manager()
-    manager.new_instance(name)
+    manager.new_instance(name, priority=priority)
     return "", 201
 
 
+@api.route("/resources", methods=["GET"])
+@auth.required
+def list_instances():
+    return describe_instances(request.args, ["name", "state", "address"])
+
+
+@api.route("/resources/status:batch", methods=["POST"])
+@auth.required
+def batch_status():
+    try:
+        params = batch_params()
+    except ValueError as e:
+        return str(e), 400
+    return describe_instances(params, ["name", "state", "status"])
+
+
+def batch_params():
+    if request.json is None:
+        return request.form
+    if not isinstance(request.json, dict):
+        raise ValueError("invalid body: expected a JSON object")
+    params = {}
+    for key, value in request.json.items():
+        if isinstance(value, list):
+            if [v for v in value if not isinstance(v, basestring)]:
+                raise ValueError("invalid %s: expected a list of strings" % key)
+            value = ",".join(value)
+        params[key] = value if isinstance(value, basestring) else str(value)
+    return params
+
+
+def split(value):
+    return [v.strip() for v in (value or "").split(",") if v.strip()]
+
+
+def describe_instances(params, default_fields):
+    names = sorted(set(split(params.get("names"))))
+    if not names:
+        return "names is required", 400
+    fields = split(params.get("fields")) or default_fields
+    unknown = [f for f in fields if f not in INSTANCE_FIELDS]
+    if unknown:
+        return "unknown fields: %s" % ", ".join(unknown), 400
+    try:
+        limit = int(params.get("limit", 100))
+    except ValueError:
+        limit = 0
+    if not 0 < limit <= BATCH_LIMIT:
+        return "limit must be between 1 and %d" % BATCH_LIMIT, 400
+    after = params.get("after")
+    if after:
+        names = [n for n in names if n > after]
+    page = names[:limit]
+    found = {}
+    if page:
+        found = dict([(i["name"], i) for i in get_manager().describe_instances(page)])
+    instances = []
+    for name in page:
+        if name in found:
+            instance = dict(found[name], status=STATUS_CODES.get(found[name]["state"], 500))
+            instances.append(dict([(f, instance.get(f)) for f in fields]))
+    result = {"instances": instances,
+              "missing": [name for name in page if name not in found],
+              "next": page[-1] if len(names) > limit else None}
+    return Response(response=json.dumps(result), status=200,
+                    mimetype="application/json")
+
+
+@api.route("/admin/<kind>", methods=["GET"])
+@auth.required
+def scan(kind):
+    if kind not in storage.SCAN_KINDS:
+        return "Not found", 404
+    query = {}
+    if request.args.get("state"):
+        query["state"] = request.args["state"]
+    if request.args.get("instance_name"):
+        field = "name" if kind == "instances" else "instance_name"
+        query[field] = request.args["instance_name"]
+    try:
+        limit = int(request.args.get("limit", 0))
+        if limit < 0:
+            raise ValueError()
+    except ValueError:
+        return "invalid limit: %s" % request.args.get("limit"), 400
+    try:
+        items = get_manager().storage.scan(kind, after=request.args.get("after"),
+                                           limit=limit, batch_size=SCAN_BATCH_SIZE,
+                                           **query)
+    except ValueError as e:
+        return " ".join(e.args), 400
+    return Response(response=scan_lines(items, limit), status=200,
+                    mimetype="application/x-ndjson")
+
+
+def scan_lines(items, limit):
+    count = 0
+    cursor_id = None
+    for cursor_id, item in items:
+        count += 1
+        item.pop("secret", None)
+        item["cursor"] = cursor_id
+        yield json.dumps(item, default=json_default, sort_keys=True) + "\n"
+    if limit and count == limit:
+        yield json.dumps({"next": cursor_id}) + "\n"
+
+
+def json_default(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+
 @api.route("/resources/<name>", methods=["DELETE"])
 @auth.required
 def remove_instance(name):
@@ -44,13 +227,17 @@ def remove_instance(name):
 
 @api.route("/resources/<name>/bind-app", methods=["POST"])
 @auth.required
+@cache.cached_reads
 def bind(name):
     app_host = request.form.get("app-host")
     if not app_host:
         return "app-host is required", 400
+    priority = get_priority()
+    if priority is None:
+        return "invalid priority", 400
     manager = get_manager()
     try:
-        manager.bind(name, app_host)
+        manager.bind(name, app_host, priority=priority)
     except storage.InstanceNotFoundError:
         return "Instance not found", 404
     return Response(response="null", status=201,
@@ -59,6 +246,7 @@ def bind(name):
 
 @api.route("/resources/<name>/bind-app", methods=["DELETE"])
 @auth.required
+@cache.cached_reads
 def unbind(name):
     host = request.form.get("app-host")
     manager = get_manager()
@@ -69,6 +257,54 @@ def unbind(name):
     return "", 200
 
 
+@api.route("/resources/<name>/bind-apps", methods=["POST"])
+@auth.required
+@cache.cached_reads
+def bind_many(name):
+    try:
+        app_hosts = get_app_hosts()
+    except ValueError as e:
+        return str(e), 400
+    if not app_hosts:
+        return "app-hosts is required", 400
+    if len(app_hosts) > BATCH_LIMIT:
+        return "at most %d app-hosts are allowed" % BATCH_LIMIT, 400
+    priority = get_priority(default="bulk")
+    if priority is None:
+        return "invalid priority", 400
+    manager = get_manager()
+    try:
+        manager.bind_many(name, app_hosts, priority=priority)
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    return Response(response=json.dumps({"binds": len(app_hosts)}), status=201,
+                    mimetype="application/json")
+
+
+@api.route("/resources/<name>/bind-apps", methods=["DELETE"])
+@auth.required
+@cache.cached_reads
+def unbind_many(name):
+    try:
+        app_hosts = get_app_hosts()
+    except ValueError as e:
+        return str(e), 400
+    if not app_hosts:
+        return "app-hosts is required", 400
+    if len(app_hosts) > BATCH_LIMIT:
+        return "at most %d app-hosts are allowed" % BATCH_LIMIT, 400
+    manager = get_manager()
+    try:
+        manager.unbind_many(name, app_hosts)
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    return "", 200
+
+
+def get_app_hosts():
+    return sorted(set(split(batch_params().get("app-hosts"))))
+
+
 @api.route("/resources/<name>/bind", methods=["POST"])
 @auth.required
 def bind_unit(name):
@@ -83,6 +319,7 @@ def unbind_unit(name):
 
 @api.route("/resources/<name>", methods=["GET"])
 @auth.required
+@cache.cached_reads
 def info(name):
     manager = get_manager()
     try:
@@ -97,25 +334,59 @@ def info(name):
 
 @api.route("/resources/<name>/status", methods=["GET"])
 @auth.required
+@cache.cached_reads
 def status(name):
-    states = {"started": 204, "pending": 202, "scaling": 204}
+    try:
+        wait = min(float(request.args.get("wait", 0)), cache.max_wait())
+    except ValueError:
+        return "invalid wait: %s" % request.args.get("wait"), 400
     manager = get_manager()
     try:
-        status = manager.status(name)
+        status = wait_for_status(manager, name, wait, request.args.get("until"))
     except storage.InstanceNotFoundError:
         return "Instance not found", 404
-    return status, states.get(status, 500)
+    return status, STATUS_CODES.get(status, 500)
+
+
+def wait_for_status(manager, name, wait, until=None):
+    event = None
+    if wait > 0:
+        event = cache.watchers.watch(name, limit=cache.max_waiters())
+    if event is None:
+        return manager.status(name)
+    deadline = time.time() + wait
+    try:
+        initial = None
+        while True:
+            event.clear()
+            status = manager.status(name)
+            if initial is None:
+                initial = status
+            if until is not None and status == until:
+                return status
+            if until is None and status != initial:
+                return status
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return status
+            event.wait(remaining)
+    finally:
+        cache.watchers.unwatch(name, event)
 
 
 @api.route("/resources/<name>/scale", methods=["POST"])
 @auth.required
+@cache.cached_reads
 def scale_instance(name):
     quantity = request.form.get("quantity")
     if not quantity:
         return "missing quantity", 400
+    priority = get_priority()
+    if priority is None:
+        return "invalid priority", 400
     manager = get_manager()
     try:
-        manager.scale_instance(name, int(quantity))
+        manager.scale_instance(name, int(quantity), priority=priority)
     except ValueError as e:
         msg = " ".join(e.args)
         if "invalid literal" in msg:
@@ -131,6 +402,17 @@ def get_plugin():
     return inspect.getsource(plugin)
 
 
+@api.route("/metrics", methods=["GET"])
+def get_metrics():
+    global queue_depths
+    if queue_depths is None:
+        ttl = int(os.environ.get("API_METRICS_QUEUE_TTL", 15))
+        queue_depths = metrics.QueueDepths(get_manager().storage, ttl)
+        metrics.registry.add_collector(queue_depths)
+    return Response(response=metrics.render(), status=200,
+                    content_type=metrics.CONTENT_TYPE)
+
+
 def register_manager(name, obj, override=False):
     if not override and name in managers:
         raise ValueError("Manager already registered")
@@ -142,7 +424,18 @@ def get_manager():
     manager_class = managers.get(manager)
     if not manager_class:
         raise ValueError("{0} is not a valid manager".format(manager))
-    mongodb_uri = os.environ.get("API_MONGODB_URI")
-    mongodb_database = os.environ.get("API_MONGODB_DATABASE_NAME")
-    return manager_class(storage.MongoDBStorage(mongo_uri=mongodb_uri,
-                                                dbname=mongodb_database))
+    return manager_class(get_storage())
+
+
+def register_storage(name, obj, override=False):
+    if not override and name in storages:
+        raise ValueError("Storage already registered")
+    storages[name] = obj
+
+
+def get_storage():
+    storage_name = os.environ.get("API_STORAGE", "mongodb")
+    storage_factory = storages.get(storage_name)
+    if not storage_factory:
+        raise ValueError("{0} is not a valid storage".format(storage_name))
+    return cache.wrap(storage_factory())
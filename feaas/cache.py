@@ -0,0 +1,269 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import collections
+import contextlib
+import copy
+import functools
+import os
+import sys
+import threading
+import time
+
+from feaas import metrics, storage
+
+ALL = "*"
+
+_local = threading.local()
+_cache = None
+_notifications = False
+_subscribed = set()
+_subscribe_lock = threading.Lock()
+
+
+class LRUCache(object):
+    """
+    LRUCache is a thread-safe cache holding at most ``max_size`` entries,
+    each one for at most ``ttl`` seconds. When it's full, the least recently
+    used entry is evicted.
+
+    ``version`` changes on every invalidation: values read from the storage
+    are only cached if no invalidation happened since the read started.
+    """
+
+    def __init__(self, max_size=1024, ttl=5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                metrics.cache_requests.inc(result="miss")
+                return None
+            self.entries[key] = entry
+        metrics.cache_requests.inc(result="hit")
+        return entry[1]
+
+    def set(self, key, value, version=None):
+        with self.lock:
+            if version is not None and version != self.version:
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        if key == ALL:
+            return self.clear()
+        with self.lock:
+            self.version += 1
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Watchers(object):
+    """
+    Watchers lets threads wait for changes in instances: each call to
+    ``watch`` returns an event that is set when the instance (or ``"*"``,
+    meaning all instances) is notified as changed. When ``limit`` events are
+    already being watched, ``watch`` returns None instead.
+    """
+
+    def __init__(self):
+        self.events = {}
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def watch(self, name, limit=None):
+        event = threading.Event()
+        with self.lock:
+            if limit is not None and self.count >= limit:
+                return None
+            self.events.setdefault(name, set()).add(event)
+            self.count += 1
+        return event
+
+    def unwatch(self, name, event):
+        with self.lock:
+            events = self.events.get(name, set())
+            if event in events:
+                self.count -= 1
+            events.discard(event)
+            if not events:
+                self.events.pop(name, None)
+
+    def notify(self, name):
+        with self.lock:
+            if name == ALL:
+                events = [e for events in self.events.values() for e in events]
+            else:
+                events = list(self.events.get(name, ()))
+        for event in events:
+            event.set()
+
+
+watchers = Watchers()
+
+
+def changed(name):
+    if _cache is not None:
+        _cache.invalidate(name)
+    watchers.notify(name)
+
+
+class CachedStorage(storage.BaseStorage):
+    """
+    CachedStorage wraps another storage, serving instances retrieved by name
+    from ``cache`` when cached reads are enabled in the current thread (see
+    :func:`cached_reads`). Every write that changes instances or units goes
+    through it, evicting the affected instances from the cache, waking up
+    their :data:`watchers` and publishing their names with ``notifier``, so
+    other processes do the same. ``cache`` may be None, when only change
+    notifications are enabled.
+    """
+
+    def __init__(self, storage, cache, notifier=None):
+        self.storage = storage
+        self.cache = cache
+        self.notifier = notifier
+
+    def changed(self, *names):
+        for name in names:
+            if self.cache is not None:
+                self.cache.invalidate(name)
+            watchers.notify(name)
+            if self.notifier is not None:
+                self.notifier.publish(name)
+
+    def retrieve_instance(self, check_liveness=False, sort=None, **query):
+        if (self.cache is None or not reading() or sort is not None or
+                query.keys() != ["name"]):
+            return self.storage.retrieve_instance(check_liveness=check_liveness,
+                                                  sort=sort, **query)
+        instance = self.cache.get(query["name"])
+        if instance is None:
+            version = self.cache.version
+            instance = self.storage.retrieve_instance(name=query["name"])
+            self.cache.set(instance.name, copy.deepcopy(instance), version=version)
+        else:
+            instance = copy.deepcopy(instance)
+        if check_liveness and instance.state in ("removed", "terminating"):
+            raise storage.InstanceNotFoundError()
+        return instance
+
+    def store_instance(self, instance, save_units=True):
+        self.storage.store_instance(instance, save_units=save_units)
+        self.changed(instance.name)
+
+    def transition_instance(self, name, from_state, **changes):
+        transitioned = self.storage.transition_instance(name, from_state, **changes)
+        if transitioned:
+            self.changed(name)
+        return transitioned
+
+    def remove_instance(self, name):
+        self.storage.remove_instance(name)
+        self.changed(name)
+
+    def update_units(self, units, **changes):
+        self.storage.update_units(units, **changes)
+        names = set([unit.instance.name if unit.instance else ALL for unit in units])
+        self.changed(*(ALL,) if ALL in names else sorted(names))
+
+    def release_expired_leases(self, now=None):
+        released = self.storage.release_expired_leases(now=now)
+        if any(released.get(state) for state in storage.LEASED_STATES):
+            self.changed(ALL)
+        return released
+
+
+def _delegate(name):
+    def method(self, *args, **kwargs):
+        return getattr(self.storage, name)(*args, **kwargs)
+    method.__name__ = name
+    return method
+
+
+for name in storage.BaseStorage.__dict__:
+    if not name.startswith("_") and name not in CachedStorage.__dict__:
+        setattr(CachedStorage, name, _delegate(name))
+
+
+def reading():
+    return getattr(_local, "depth", 0) > 0
+
+
+@contextlib.contextmanager
+def reads():
+    _local.depth = getattr(_local, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        _local.depth -= 1
+
+
+def cached_reads(fn):
+    @functools.wraps(fn)
+    def decorated(*args, **kwargs):
+        with reads():
+            return fn(*args, **kwargs)
+    return decorated
+
+
+def configure():
+    global _cache, _notifications
+    _cache = None
+    size = int(os.environ.get("API_CACHE_SIZE", 0))
+    if size > 0:
+        _cache = LRUCache(max_size=size, ttl=float(os.environ.get("API_CACHE_TTL", 5)))
+    _notifications = _cache is not None or max_wait() > 0
+
+
+def enabled():
+    return _cache is not None
+
+
+def max_wait():
+    return float(os.environ.get("API_STATUS_MAX_WAIT", 0))
+
+
+def max_waiters():
+    return int(os.environ.get("API_STATUS_MAX_WAITERS", 16))
+
+
+def _subscribe(notifier):
+    with _subscribe_lock:
+        if notifier in _subscribed:
+            return
+        _subscribed.add(notifier)
+    notifier.subscribe(changed)
+
+
+def wrap(strg):
+    if not _notifications or isinstance(strg, CachedStorage):
+        return strg
+    notifier = None
+    try:
+        notifier = strg.new_notifier()
+    except Exception as e:
+        sys.stderr.write("[ERROR] failed to set up cache notifications: {}\n".format(
+            " ".join([str(arg) for arg in e.args])))
+    if notifier is not None:
+        _subscribe(notifier)
+    return CachedStorage(strg, _cache, notifier)
+
+
+configure()
@@ -3,11 +3,13 @@
 # license that can be found in the LICENSE file.
 
 import codecs
-import httplib2
+import datetime
 import os
+import sys
 
 import varnish
-from feaas import storage
+from feaas import metrics, storage, tracing
+from feaas.managers import user_data
 
 VCL_TEMPLATE_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__), "..",
                                                  "misc", "default.vcl"))
@@ -15,15 +17,32 @@ VCL_TEMPLATE_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."
 DUMP_VCL_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__), "..",
                                              "misc", "dump_vcls.bash"))
 
+SECRET_PLACEHOLDER = "VARNISH_SECRET_KEY"
+
+CLOUD_OPERATIONS = ["start_instance", "terminate_instance", "physical_scale",
+                    "boot_unit", "destroy_units"]
+
+
+def pool_size():
+    return int(os.environ.get("API_POOL_SIZE", 0))
+
+
+def recycle_pool_size():
+    return int(os.environ.get("API_RECYCLE_POOL_SIZE", 0))
+
+
+def recycle_ttl():
+    return int(os.environ.get("API_RECYCLE_TTL", 3600))
+
 
 class BaseManager(object):
 
     def __init__(self, storage):
         self.storage = storage
 
-    def new_instance(self, name):
+    def new_instance(self, name, priority=None):
         self._check_duplicate(name)
-        instance = storage.Instance(name)
+        instance = storage.Instance(name, priority=priority)
         self.storage.store_instance(instance)
         return instance
 
@@ -34,17 +53,33 @@ class BaseManager(object):
         except storage.InstanceNotFoundError:
             pass
 
-    def bind(self, name, app_host):
+    def bind(self, name, app_host, priority=None):
         instance = self.storage.retrieve_instance(name=name)
-        bind = storage.Bind(app_host, instance)
+        bind = storage.Bind(app_host, instance, priority=priority,
+                            trace_id=tracing.current_trace_id())
         self.storage.store_bind(bind)
 
+    def bind_many(self, name, app_hosts, priority=None):
+        instance = self.storage.retrieve_instance(name=name)
+        trace_id = tracing.current_trace_id()
+        binds = [storage.Bind(app_host, instance, priority=priority, trace_id=trace_id)
+                 for app_host in app_hosts]
+        self.storage.store_binds(binds)
+
     def unbind(self, name, app_host):
+        self._mark_removing(name, app_host)
+
+    def unbind_many(self, name, app_hosts):
+        self._mark_removing(name, {"$in": list(app_hosts)})
+
+    def _mark_removing(self, name, app_host):
         instance = self.storage.retrieve_instance(name=name)
-        for unit in instance.units:
-            self.remove_vcl(unit.dns_name, unit.secret)
-        bind = storage.Bind(app_host, instance)
-        self.storage.remove_bind(bind)
+        changes = {"state": "removing"}
+        trace_id = tracing.current_trace_id()
+        if trace_id is not None:
+            changes["trace_id"] = trace_id
+        self.storage.update_binds({"instance_name": instance.name, "app_host": app_host},
+                                  **changes)
 
     def write_vcl(self, instance_addr, secret, app_addr):
         vcl = self.vcl_template() % {"app_host": app_addr}
@@ -63,7 +98,11 @@ class BaseManager(object):
         handler = varnish.VarnishHandler("{0}:6082".format(instance_addr),
                                          secret=secret)
         handler.vcl_use("boot")
-        handler.vcl_discard("feaas")
+        try:
+            handler.vcl_discard("feaas")
+        except AssertionError as e:
+            if len(e.args) < 1 or "No configuration named" not in e.args[0]:
+                raise e
         handler.quit()
 
     def vcl_template(self):
@@ -88,7 +127,16 @@ class BaseManager(object):
         instance = self.storage.retrieve_instance(name=name)
         return instance.state
 
-    def scale_instance(self, name, quantity):
+    def describe_instances(self, names):
+        instances = self.storage.retrieve_instances(name={"$in": names})
+        return [{"name": instance.name,
+                 "state": instance.state,
+                 "address": instance.units[0].dns_name if instance.units else None,
+                 "units": [{"id": u.id, "dns_name": u.dns_name, "state": u.state}
+                           for u in instance.units]}
+                for instance in instances]
+
+    def scale_instance(self, name, quantity, priority=None):
         if quantity < 1:
             raise ValueError("quantity must be a positive integer")
         instance = self.storage.retrieve_instance(name=name)
@@ -96,30 +144,78 @@ class BaseManager(object):
             raise ValueError("instance is already scaling")
         if quantity == len(instance.units):
             raise ValueError("instance already have %d units" % quantity)
-        self.storage.store_scale_job({"instance": name, "quantity": quantity,
-                                      "state": "pending"})
+        job = {"instance": name, "quantity": quantity, "state": "pending"}
+        if priority is not None:
+            job["priority"] = priority
+        trace_id = tracing.current_trace_id()
+        if trace_id is not None:
+            job["trace_id"] = trace_id
+        self.storage.store_scale_job(job)
 
     def get_user_data(self, secret):
         if "USER_DATA_URL" in os.environ:
             url = os.environ.get("USER_DATA_URL")
-            h = httplib2.Http()
-            _, user_data = h.request(url)
-            return user_data.replace("VARNISH_SECRET_KEY", secret)
-        user_data_lines = None
+            template = user_data.cache.get(url, user_data.url_fetcher(url))
+            return template.replace(SECRET_PLACEHOLDER, secret)
         packages = os.environ.get("API_PACKAGES")
         if packages:
+            template = user_data.cache.get(("packages", packages),
+                                           self._packages_fetcher(packages))
+            return template.replace(SECRET_PLACEHOLDER, secret)
+
+    def _packages_fetcher(self, packages):
+        def fetch(entry):
+            with open(DUMP_VCL_FILE) as f:
+                dump_vcls = f.read()
             user_data_lines = ["apt-get update",
                                "apt-get install -y {0}".format(packages),
                                "sed -i -e 's/-T localhost:6082/-T :6082/' /etc/default/varnish",
                                "sed -i -e 's/-a :6081/-a :8080/' /etc/default/varnish",
-                               "echo {0} > /etc/varnish/secret".format(secret),
+                               "echo {0} > /etc/varnish/secret".format(SECRET_PLACEHOLDER),
                                "service varnish restart",
                                "cat > /etc/cron.hourly/dump_vcls <<'END'",
-                               open(DUMP_VCL_FILE).read(),
+                               dump_vcls,
                                "END",
                                "chmod +x /etc/cron.hourly/dump_vcls"]
-        if user_data_lines:
-            return "\n".join(user_data_lines) + "\n"
+            return user_data.Template("\n".join(user_data_lines) + "\n")
+        return fetch
+
+    def _claim_units(self, instance, quantity):
+        units = []
+        if pool_size() < 1 and recycle_pool_size() < 1:
+            return units
+        while len(units) < quantity:
+            unit = self.storage.claim_pool_unit()
+            if not unit:
+                break
+            unit.state = "creating"
+            instance.add_unit(unit)
+            units.append(unit)
+        return units
+
+    def _recycle_unit(self, unit):
+        if recycle_pool_size() < 1:
+            return False
+        recycled = self.storage.count_pool_units(expires_at={"$exists": True})
+        if recycled >= recycle_pool_size():
+            return False
+        try:
+            self.remove_vcl(unit.dns_name, unit.secret)
+        except Exception as e:
+            msg = " ".join([str(arg) for arg in e.args])
+            if "No configuration named" not in msg:
+                sys.stderr.write("[ERROR] Failed to clean unit for recycling: %s\n" % msg)
+                return False
+        unit.state = "ready"
+        expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=recycle_ttl())
+        self.storage.store_pool_unit(unit, expires_at=expires_at)
+        return True
+
+    def boot_unit(self):
+        raise NotImplementedError()
+
+    def destroy_units(self, units):
+        raise NotImplementedError()
 
     def start_instance(self, name):
         raise NotImplementedError()
@@ -129,3 +225,8 @@ class BaseManager(object):
 
     def physical_scale(self, instance, quantity):
         raise NotImplementedError()
+
+
+metrics.instrument_methods(BaseManager, metrics.varnish_seconds, metrics.varnish_errors,
+                           ["write_vcl", "remove_vcl"])
+tracing.trace_methods(BaseManager, "varnishadm", ["write_vcl", "remove_vcl"])
@@ -7,10 +7,17 @@ import sys
 import time
 import uuid
 
-from feaas import managers, storage
+from feaas import managers, metrics, storage, tracing
+from feaas.managers import throttle
 
 from .cloudstack_client import CloudStack
 
+THROTTLE_ERRORS = (429, 431, 530)
+
+
+def is_throttled(exc):
+    return getattr(exc, "code", None) in THROTTLE_ERRORS
+
 
 class CloudStackManager(managers.BaseManager):
 
@@ -20,6 +27,7 @@ class CloudStackManager(managers.BaseManager):
         key = self.get_env("CLOUDSTACK_API_KEY")
         secret_key = self.get_env("CLOUDSTACK_SECRET_KEY")
         self.client = CloudStack(url, key, secret_key)
+        self.throttle = throttle.get("cloudstack", is_throttled)
 
     def get_env(self, name):
         try:
@@ -29,28 +37,38 @@ class CloudStackManager(managers.BaseManager):
 
     def start_instance(self, name):
         instance = self.storage.retrieve_instance(name=name)
-        self._add_units(instance, 1)
+        if not instance.units:
+            self._add_units(instance, 1)
         return instance
 
     def terminate_instance(self, name):
         instance = self.storage.retrieve_instance(name=name)
         for unit in instance.units:
-            self._destroy_vm(unit)
+            if not self._recycle_unit(unit):
+                self._destroy_vm(unit)
         return instance
 
+    def destroy_units(self, units):
+        return [unit for unit in units if not self._destroy_vm(unit)]
+
     def physical_scale(self, instance, quantity):
         new_units = quantity - len(instance.units)
         if new_units < 0:
             return self._remove_units(instance, -1 * new_units)
         return self._add_units(instance, new_units)
 
+    def boot_unit(self):
+        return self._deploy_vm(None)
+
     def _add_units(self, instance, quantity):
-        units = []
-        for i in xrange(quantity):
-            unit = self._deploy_vm(instance)
-            instance.add_unit(unit)
-            units.append(unit)
-        self.storage.store_instance(instance)
+        units = self._claim_units(instance, quantity)
+        try:
+            for i in xrange(quantity - len(units)):
+                unit = self._deploy_vm(instance)
+                instance.add_unit(unit)
+                units.append(unit)
+        finally:
+            self.storage.store_instance(instance)
         return units
 
     def _deploy_vm(self, instance):
@@ -69,9 +87,13 @@ class CloudStackManager(managers.BaseManager):
         network_ids = os.environ.get("CLOUDSTACK_NETWORK_IDS")
         if network_ids:
             data["networkids"] = network_ids
-        vm_job = self.client.deployVirtualMachine(data)
+        vm_job = self.throttle.call(self.client.deployVirtualMachine, data)
         max_tries = int(os.environ.get("CLOUDSTACK_MAX_TRIES", 100))
-        vm = self._wait_for_unit(vm_job, max_tries, project_id)
+        try:
+            vm = self._wait_for_unit(vm_job, max_tries, project_id)
+        except Exception:
+            self._destroy_vm(storage.Unit(id=vm_job["id"]))
+            raise
         return storage.Unit(id=vm["id"], dns_name=self._get_dns_name(vm),
                             state="creating", secret=secret)
 
@@ -92,7 +114,8 @@ class CloudStackManager(managers.BaseManager):
         tries = 0
         job_id = vm_job["jobid"]
         while tries < max_tries:
-            result = self.client.queryAsyncJobResult({"jobid": job_id})
+            result = self.throttle.call(self.client.queryAsyncJobResult,
+                                        {"jobid": job_id})
             status = result["jobstatus"]
             if status != 0:
                 break
@@ -103,13 +126,14 @@ class CloudStackManager(managers.BaseManager):
         data = {"id": vm_job["id"]}
         if project_id:
             data["projectid"] = project_id
-        vms = self.client.listVirtualMachines(data)
+        vms = self.throttle.call(self.client.listVirtualMachines, data)
         return vms["virtualmachine"][0]
 
     def _remove_units(self, instance, quantity):
         units = []
         for i in xrange(quantity):
-            self._destroy_vm(instance.units[i])
+            if not self._recycle_unit(instance.units[i]):
+                self._destroy_vm(instance.units[i])
             units.append(instance.units[i])
         for unit in units:
             instance.remove_unit(unit)
@@ -118,10 +142,12 @@ class CloudStackManager(managers.BaseManager):
 
     def _destroy_vm(self, unit):
         try:
-            self.client.destroyVirtualMachine({"id": unit.id})
+            self.throttle.call(self.client.destroyVirtualMachine, {"id": unit.id})
         except Exception as e:
             sys.stderr.write("[ERROR] Failed to terminate CloudStack VM: %s" %
                              " ".join([str(arg) for arg in e.args]))
+            return False
+        return True
 
 
 class MissConfigurationError(Exception):
@@ -134,3 +160,8 @@ class MaxTryExceededError(Exception):
         self.max_tries = max_tries
         msg = "exceeded {0} tries".format(max_tries)
         super(MaxTryExceededError, self).__init__(msg)
+
+
+metrics.instrument_methods(CloudStackManager, metrics.manager_seconds, metrics.manager_errors,
+                           managers.CLOUD_OPERATIONS)
+tracing.trace_methods(CloudStackManager, "manager", managers.CLOUD_OPERATIONS)
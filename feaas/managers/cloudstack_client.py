@@ -8,6 +8,13 @@ import json
 import urllib
 
 
+class CloudStackError(Exception):
+
+    def __init__(self, code, text):
+        self.code = code
+        super(CloudStackError, self).__init__(code, text)
+
+
 class CloudStack(object):
 
     def __init__(self, api_url, api_key, secret):
@@ -45,6 +52,7 @@ class CloudStack(object):
             if kwargs:
                 return self._make_request(name, kwargs)
             return self._make_request(name, args[0])
+        handler.__name__ = name
         return handler
 
     def _http_get(self, url):
@@ -57,4 +65,7 @@ class CloudStack(object):
         self.request(args)
         data = self._http_get(self.value)
         key = command.lower() + "response"
-        return json.loads(data)[key]
+        result = json.loads(data)[key]
+        if "errorcode" in result:
+            raise CloudStackError(result["errorcode"], result.get("errortext", ""))
+        return result
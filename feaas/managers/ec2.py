@@ -7,7 +7,14 @@ import urlparse
 import uuid
 import sys
 
-from feaas import managers, storage
+from feaas import managers, metrics, storage, tracing
+from feaas.managers import throttle
+
+THROTTLE_ERRORS = ("RequestLimitExceeded", "Throttling")
+
+
+def is_throttled(exc):
+    return getattr(exc, "error_code", None) in THROTTLE_ERRORS
 
 
 class EC2Manager(managers.BaseManager):
@@ -15,6 +22,7 @@ class EC2Manager(managers.BaseManager):
     def __init__(self, *args, **kwargs):
         super(EC2Manager, self).__init__(*args, **kwargs)
         self._connection = None
+        self.throttle = throttle.get("ec2", is_throttled)
 
     @property
     def connection(self):
@@ -45,16 +53,17 @@ class EC2Manager(managers.BaseManager):
 
     def start_instance(self, name):
         instance = self.storage.retrieve_instance(name=name)
-        self._add_units(instance, 1)
+        if not instance.units:
+            self._add_units(instance, 1)
         return instance
 
     def _run_unit(self):
         ami_id = os.environ.get("AMI_ID")
         subnet_id = os.environ.get("SUBNET_ID")
         secret = unicode(uuid.uuid4())
-        reservation = self.connection.run_instances(image_id=ami_id,
-                                                    subnet_id=subnet_id,
-                                                    user_data=self._user_data(secret))
+        reservation = self.throttle.call(self.connection.run_instances,
+                                         image_id=ami_id, subnet_id=subnet_id,
+                                         user_data=self._user_data(secret))
         ec2_instance = reservation.instances[0]
         return storage.Unit(id=ec2_instance.id, dns_name=ec2_instance.dns_name,
                             secret=secret, state="creating")
@@ -65,12 +74,24 @@ class EC2Manager(managers.BaseManager):
     def terminate_instance(self, name):
         instance = self.storage.retrieve_instance(name=name)
         for unit in instance.units:
-            self._terminate_unit(unit)
+            if not self._recycle_unit(unit):
+                self._terminate_unit(unit)
         return instance
 
+    def destroy_units(self, units):
+        try:
+            self.throttle.call(self.connection.terminate_instances,
+                               instance_ids=[unit.id for unit in units])
+        except Exception as e:
+            sys.stderr.write("[ERROR] Failed to terminate EC2 instances: %s" %
+                             " ".join([str(arg) for arg in e.args]))
+            return units
+        return []
+
     def _terminate_unit(self, unit):
         try:
-            self.connection.terminate_instances(instance_ids=[unit.id])
+            self.throttle.call(self.connection.terminate_instances,
+                               instance_ids=[unit.id])
         except Exception as e:
             sys.stderr.write("[ERROR] Failed to terminate EC2 instance: %s" %
                              " ".join([str(arg) for arg in e.args]))
@@ -81,21 +102,32 @@ class EC2Manager(managers.BaseManager):
             return self._remove_units(instance, -1 * new_units)
         return self._add_units(instance, new_units)
 
+    def boot_unit(self):
+        return self._run_unit()
+
     def _add_units(self, instance, quantity):
-        units = []
-        for i in xrange(quantity):
-            unit = self._run_unit()
-            instance.add_unit(unit)
-            units.append(unit)
-        self.storage.store_instance(instance)
+        units = self._claim_units(instance, quantity)
+        try:
+            for i in xrange(quantity - len(units)):
+                unit = self._run_unit()
+                instance.add_unit(unit)
+                units.append(unit)
+        finally:
+            self.storage.store_instance(instance)
         return units
 
     def _remove_units(self, instance, quantity):
         units = []
         for i in xrange(quantity):
-            self._terminate_unit(instance.units[i])
+            if not self._recycle_unit(instance.units[i]):
+                self._terminate_unit(instance.units[i])
             units.append(instance.units[i])
         for unit in units:
             instance.remove_unit(unit)
         self.storage.store_instance(instance)
         return units
+
+
+metrics.instrument_methods(EC2Manager, metrics.manager_seconds, metrics.manager_errors,
+                           managers.CLOUD_OPERATIONS)
+tracing.trace_methods(EC2Manager, "manager", managers.CLOUD_OPERATIONS)
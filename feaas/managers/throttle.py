@@ -0,0 +1,163 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import os
+import threading
+import time
+
+from feaas import metrics, tracing
+
+_throttles = {}
+_throttles_lock = threading.Lock()
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill()
+            self.rate = float(rate)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+
+class Throttle(object):
+    """
+    Throttle limits the calls made to a cloud provider with a token bucket and
+    an AIMD (additive increase, multiplicative decrease) concurrency limit.
+
+    Whenever the provider answers a call with a throttling error, both the rate
+    and the concurrency limit are halved and the call is retried after a
+    backoff. Every successful call slowly increases them back, up to the
+    configured maximums.
+    """
+
+    def __init__(self, name, rate, burst, max_concurrency, is_throttled,
+                 min_rate=0.1, max_retries=5, backoff=1):
+        self.name = name
+        self.max_rate = float(rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.max_concurrency = max_concurrency
+        self.is_throttled = is_throttled
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(rate, burst)
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.throttled = 0
+        self.cond = threading.Condition()
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    def call(self, fn, *args, **kwargs):
+        operation = getattr(fn, "__name__", "unknown")
+        labels = {"provider": self.name, "operation": operation}
+        with metrics.cloud_seconds.time(**labels), \
+                tracing.span("cloud.{}".format(operation), provider=self.name):
+            try:
+                return self._call(fn, *args, **kwargs)
+            except Exception:
+                metrics.cloud_errors.inc(**labels)
+                raise
+
+    def _call(self, fn, *args, **kwargs):
+        tries = 0
+        while True:
+            self._acquire()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                self._release()
+                if not self.is_throttled(e) or tries >= self.max_retries:
+                    raise
+                self._decrease()
+                time.sleep(self.backoff * 2 ** tries)
+                tries += 1
+                continue
+            self._release()
+            self._increase()
+            return result
+
+    def stats(self):
+        with self.cond:
+            return {"name": self.name, "rate": self.bucket.rate,
+                    "concurrency_limit": int(self.limit),
+                    "in_flight": self.in_flight, "throttled": self.throttled}
+
+    def _acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+        self.bucket.acquire()
+
+    def _release(self):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify()
+
+    def _increase(self):
+        with self.cond:
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.cond.notify()
+        rate = self.bucket.rate
+        if rate < self.max_rate:
+            self.bucket.set_rate(min(self.max_rate, rate + self.min_rate))
+
+    def _decrease(self):
+        with self.cond:
+            self.limit = max(1.0, self.limit / 2)
+            self.throttled += 1
+        metrics.cloud_throttled.inc(provider=self.name)
+        self.bucket.set_rate(max(self.min_rate, self.bucket.rate / 2))
+
+
+def get(name, is_throttled):
+    with _throttles_lock:
+        if name not in _throttles:
+            prefix = name.upper()
+            rate = float(os.environ.get(prefix + "_RATE_LIMIT", 10))
+            burst = float(os.environ.get(prefix + "_RATE_BURST", rate))
+            max_concurrency = int(os.environ.get(prefix + "_MAX_CONCURRENCY", 8))
+            _throttles[name] = Throttle(name, rate, burst, max_concurrency,
+                                        is_throttled)
+        return _throttles[name]
+
+
+def stats():
+    with _throttles_lock:
+        return [t.stats() for t in _throttles.values()]
+
+
+def collect():
+    for s in stats():
+        metrics.cloud_rate_limit.set(s["rate"], provider=s["name"])
+        metrics.cloud_concurrency_limit.set(s["concurrency_limit"], provider=s["name"])
+        metrics.cloud_in_flight.set(s["in_flight"], provider=s["name"])
+
+
+metrics.registry.add_collector(collect)
@@ -0,0 +1,103 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import os
+import sys
+import threading
+import time
+
+import httplib2
+
+
+class Template(object):
+
+    def __init__(self, content, etag=None, last_modified=None):
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = time.time()
+
+
+class TemplateCache(object):
+    """
+    TemplateCache keeps user data templates in memory, so launching a unit
+    does not need to download (or read) the template again.
+
+    Templates younger than ``ttl`` seconds are served directly. Older
+    templates are still served for ``stale_ttl`` seconds while they get
+    revalidated in background, and once they are too old they're revalidated
+    before being returned. If the revalidation fails, the cached template is
+    used.
+    """
+
+    def __init__(self, ttl=300, stale_ttl=3600):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.entries = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def get(self, key, fetch):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None:
+            age = time.time() - entry.fetched_at
+            if age < self.ttl:
+                return entry.content
+            if age < self.ttl + self.stale_ttl:
+                self._refresh_async(key, fetch, entry)
+                return entry.content
+        return self._refresh(key, fetch, entry).content
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def _refresh(self, key, fetch, entry):
+        try:
+            template = fetch(entry)
+        except Exception as e:
+            if entry is None:
+                raise
+            sys.stderr.write("[ERROR] failed to revalidate user data: {}\n".format(
+                " ".join([str(arg) for arg in e.args])))
+            return entry
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+        with self.lock:
+            self.entries[key] = template
+        return template
+
+    def _refresh_async(self, key, fetch, entry):
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        t = threading.Thread(target=self._refresh, args=(key, fetch, entry))
+        t.daemon = True
+        t.start()
+
+
+def url_fetcher(url):
+    def fetch(entry):
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        response, content = httplib2.Http().request(url, headers=headers)
+        if response.status == 304 and entry is not None:
+            return Template(entry.content, entry.etag, entry.last_modified)
+        if not 200 <= response.status < 300:
+            msg = "failed to fetch user data from {}: status {}"
+            raise ValueError(msg.format(url, response.status))
+        return Template(content, etag=response.get("etag"),
+                        last_modified=response.get("last-modified"))
+    return fetch
+
+
+cache = TemplateCache(ttl=int(os.environ.get("USER_DATA_TTL", 300)),
+                      stale_ttl=int(os.environ.get("USER_DATA_STALE_TTL", 3600)))
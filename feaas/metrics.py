@@ -0,0 +1,328 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import BaseHTTPServer
+import functools
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = unicode(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(u'{}="{}"'.format(name, value))
+    return u"{" + u",".join(pairs) + u"}"
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("{} expects labels {}".format(self.name, list(self.labelnames)))
+        return tuple(unicode(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, *extra):
+        return zip(self.labelnames, key) + list(extra)
+
+    def clear(self):
+        with self.lock:
+            self.values = {}
+
+    def render(self):
+        lines = [u"# HELP {} {}".format(self.name, self.help),
+                 u"# TYPE {} {}".format(self.name, self.kind)]
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [u"{}{} {}".format(self.name, _format_labels(self._labels(key)),
+                                  _format_value(value))]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = {"buckets": [0] * len(self.buckets),
+                                    "sum": 0.0, "count": 0}
+            sample = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    sample["buckets"][i] += 1
+            sample["sum"] += value
+            sample["count"] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), {"buckets": [0] * len(self.buckets),
+                                                   "sum": 0.0, "count": 0})
+
+    def _render_sample(self, key, value):
+        lines = []
+        for bound, count in zip(self.buckets, value["buckets"]):
+            labels = _format_labels(self._labels(key, ("le", _format_value(bound))))
+            lines.append(u"{}_bucket{} {}".format(self.name, labels, count))
+        labels = _format_labels(self._labels(key))
+        lines.append(u"{}_sum{} {}".format(self.name, labels, _format_value(value["sum"])))
+        lines.append(u"{}_count{} {}".format(self.name, labels, value["count"]))
+        return lines
+
+
+class Timer(object):
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric):
+                    raise ValueError("metric {} already registered".format(metric.name))
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def add_collector(self, collector):
+        with self.lock:
+            if collector not in self.collectors:
+                self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        with self.lock:
+            if collector in self.collectors:
+                self.collectors.remove(collector)
+
+    def render(self):
+        with self.lock:
+            collectors = list(self.collectors)
+        for collector in collectors:
+            collector()
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        lines = []
+        for _, metric in metrics:
+            lines.extend(metric.render())
+        return u"\n".join(lines) + u"\n"
+
+
+registry = Registry()
+
+
+def counter(name, help, labelnames=()):
+    return registry.register(Counter(name, help, labelnames))
+
+
+def gauge(name, help, labelnames=()):
+    return registry.register(Gauge(name, help, labelnames))
+
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, help, labelnames, buckets))
+
+
+def render():
+    return registry.render()
+
+
+def instrument(fn, histogram, errors, **labels):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            errors.inc(**labels)
+            raise
+        finally:
+            histogram.observe(time.time() - start, **labels)
+    return wrapper
+
+
+def instrument_methods(cls, histogram, errors, names=None, label="operation"):
+    if names is None:
+        names = [name for name, value in cls.__dict__.items()
+                 if not name.startswith("_") and callable(value)]
+    for name in names:
+        fn = cls.__dict__.get(name)
+        if fn is None:
+            continue
+        setattr(cls, name, instrument(fn, histogram, errors, **{label: name}))
+
+
+storage_seconds = histogram("feaas_storage_operation_duration_seconds",
+                            "Duration of storage operations.", ["operation"])
+storage_errors = counter("feaas_storage_operation_errors_total",
+                         "Storage operations that raised an error.", ["operation"])
+cloud_seconds = histogram("feaas_cloud_call_duration_seconds",
+                          "Duration of calls to the cloud provider, including retries.",
+                          ["provider", "operation"])
+cloud_errors = counter("feaas_cloud_call_errors_total",
+                       "Calls to the cloud provider that failed.", ["provider", "operation"])
+cloud_throttled = counter("feaas_cloud_throttled_total",
+                          "Calls to the cloud provider answered with a throttling error.",
+                          ["provider"])
+cloud_rate_limit = gauge("feaas_cloud_rate_limit",
+                         "Current rate limit of calls to the cloud provider (calls per second).",
+                         ["provider"])
+cloud_concurrency_limit = gauge("feaas_cloud_concurrency_limit",
+                                "Current limit of concurrent calls to the cloud provider.",
+                                ["provider"])
+cloud_in_flight = gauge("feaas_cloud_in_flight",
+                        "Calls to the cloud provider currently running.", ["provider"])
+manager_seconds = histogram("feaas_manager_operation_duration_seconds",
+                            "Duration of instance and unit operations in the cloud provider.",
+                            ["operation"])
+manager_errors = counter("feaas_manager_operation_errors_total",
+                         "Instance and unit operations in the cloud provider that failed.",
+                         ["operation"])
+varnish_seconds = histogram("feaas_varnishadm_duration_seconds",
+                            "Duration of varnishadm operations.", ["operation"])
+varnish_errors = counter("feaas_varnishadm_errors_total",
+                         "Varnishadm operations that failed.", ["operation"])
+http_seconds = histogram("feaas_http_request_duration_seconds",
+                         "Duration of HTTP requests handled by the API.",
+                         ["method", "endpoint"])
+http_requests = counter("feaas_http_requests_total",
+                        "HTTP requests handled by the API.", ["method", "endpoint", "status"])
+runner_tick_seconds = histogram("feaas_runner_tick_duration_seconds",
+                                "Duration of each run of a runner.", ["runner"])
+runner_errors = counter("feaas_runner_tick_errors_total",
+                        "Runs of a runner that raised an error.", ["runner"])
+cache_requests = counter("feaas_cache_requests_total",
+                         "Lookups of instances in the API cache, by result (hit or miss).",
+                         ["result"])
+queue_depth = gauge("feaas_queue_depth", "Items waiting to be handled, by queue and state.",
+                    ["queue", "state"])
+
+
+class QueueDepths(object):
+    """
+    QueueDepths exposes the size of the queues handled by runners (instances
+    by state, pending scale jobs, and binds and units being created).
+
+    The numbers come from one aggregation on instances (grouped by state)
+    and one indexed count for each of the other queues, cached for ``ttl``
+    seconds, so frequent scrapes don't hit the database on every request.
+    """
+
+    def __init__(self, strg, ttl=15):
+        self.storage = strg
+        self.ttl = ttl
+        self.updated_at = None
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            now = time.time()
+            if self.updated_at is not None and now - self.updated_at < self.ttl:
+                return
+            depths = self.storage.queue_depths()
+            self.updated_at = now
+        queue_depth.clear()
+        for state, count in depths["instances"].items():
+            queue_depth.set(count, queue="instances", state=state)
+        queue_depth.set(depths["scale_jobs"], queue="scale_jobs", state="pending")
+        queue_depth.set(depths["binds"], queue="binds", state="creating")
+        queue_depth.set(depths["units"], queue="units", state="creating")
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host=""):
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    t = threading.Thread(target=server.serve_forever, name="metrics")
+    t.daemon = True
+    t.start()
+    return server
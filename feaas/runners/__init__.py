@@ -2,28 +2,231 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
+import os
+import signal
+import sys
+import telnetlib
+import threading
 import time
 
-from feaas import storage
+from feaas import metrics, storage, tracing
+from feaas.runners import sharding
 
 
-class Base(object):
+def is_unit_up(unit):
+    try:
+        client = telnetlib.Telnet(unit.dns_name, "6082", timeout=3)
+        client.close()
+        return True
+    except:
+        return False
+
+
+def shutdown_deadline():
+    return int(os.environ.get("API_SHUTDOWN_DEADLINE", 30))
+
+
+def lease_timeout():
+    return int(os.environ.get("API_LEASE_TIMEOUT", 900))
+
+
+def lease_expiration():
+    return datetime.datetime.utcnow() + datetime.timedelta(seconds=lease_timeout())
+
+
+def fifo_every():
+    return int(os.environ.get("API_PRIORITY_FIFO_EVERY", 4))
+
+
+def due_query():
+    return {"$or": [{"next_attempt_at": None},
+                    {"next_attempt_at": {"$lte": datetime.datetime.utcnow()}}]}
+
+
+def is_due(instance):
+    return (instance.next_attempt_at is None or
+            instance.next_attempt_at <= datetime.datetime.utcnow())
+
+
+def schedule_retry(instance, error_msg):
+    max_attempts = int(os.environ.get("API_START_MAX_ATTEMPTS", 5))
+    backoff = int(os.environ.get("API_START_RETRY_BACKOFF", 30))
+    max_backoff = int(os.environ.get("API_START_RETRY_MAX_BACKOFF", 1800))
+    instance.attempts += 1
+    instance.last_error = error_msg
+    if instance.attempts >= max_attempts:
+        instance.state = "error"
+        instance.next_attempt_at = None
+        return
+    delay = min(max_backoff, backoff * 2 ** (instance.attempts - 1))
+    instance.state = "creating"
+    instance.next_attempt_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+
+
+def reset_retries(instance):
+    instance.attempts = 0
+    instance.last_error = None
+    instance.next_attempt_at = None
+
+
+class LeaseRenewer(object):
+    """
+    LeaseRenewer keeps the lease of an instance (and of its scale job) alive
+    while a runner works on it, renewing it from a background thread every
+    ``interval`` seconds (a third of the lease timeout, by default), so long
+    operations aren't released by the lease sweeper while they're running.
+    """
+
+    def __init__(self, storage, instance, job=None, interval=None):
+        self.storage = storage
+        self.instance = instance
+        self.job = job
+        self.interval = interval or lease_timeout() / 3.0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.renew()
+            except Exception as e:
+                error_msg = " ".join([str(arg) for arg in e.args])
+                msg = "[ERROR] failed to renew the lease of instance {}: {}\n"
+                sys.stderr.write(msg.format(self.instance.name, error_msg))
+
+    def renew(self):
+        lease_expires_at = lease_expiration()
+        if self.storage.transition_instance(self.instance.name, self.instance.state,
+                                            lease_expires_at=lease_expires_at):
+            self.instance.lease_expires_at = lease_expires_at
+        if self.job is not None:
+            self.storage.renew_scale_job(self.job, lease_expires_at)
+
+
+class GracefulShutdown(object):
+    """
+    GracefulShutdown handles SIGTERM and SIGINT by stopping the loop and
+    giving in-flight work ``deadline`` seconds to finish. Once the deadline
+    is exceeded, it checkpoints the in-flight work, releases the locks and
+    exits.
+    """
+    deadline_timer = None
+
+    def handle_signals(self, deadline=None):
+        handler = lambda signum, frame: self.shutdown(deadline)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, handler)
+            signal.siginterrupt(signum, False)
+
+    def shutdown(self, deadline=None):
+        if deadline is None:
+            deadline = shutdown_deadline()
+        self.stop()
+        if self.deadline_timer is None:
+            self.deadline_timer = threading.Timer(deadline, self.abort)
+            self.deadline_timer.daemon = True
+            self.deadline_timer.start()
+
+    def abort(self):
+        sys.stderr.write("[ERROR] shutdown deadline exceeded, checkpointing in-flight work\n")
+        try:
+            self.checkpoint()
+        except Exception as e:
+            error_msg = " ".join([str(arg) for arg in e.args])
+            sys.stderr.write("[ERROR] failed to checkpoint: {}\n".format(error_msg))
+        finally:
+            self.release_locks()
+            os._exit(1)
+
+    def stop(self):
+        raise NotImplementedError()
+
+    def checkpoint(self):
+        pass
+
+    def release_locks(self):
+        pass
+
+
+class Base(GracefulShutdown):
+    shard = None
+    locker = None
+    last_run_at = None
+    claims = 0
 
     def __init__(self, manager, interval, *locks):
         self.manager = manager
         self.storage = manager.storage
         self.interval = interval
+        self.stopped = threading.Event()
 
     def init_locker(self, *lock_names):
-        self.locker = storage.MultiLocker(self.storage)
+        self.locker = storage.new_locker(self.storage)
         for lock_name in lock_names:
             self.locker.init(lock_name)
 
+    def init_shard(self, group):
+        self.shard = sharding.Shard(self.storage, group)
+
+    def lock(self, lock_name):
+        if self.shard is None:
+            self.locker.lock(lock_name)
+
+    def unlock(self, lock_name):
+        if self.shard is None:
+            self.locker.unlock(lock_name)
+
+    def claim_sort(self):
+        self.claims += 1
+        if self.claims % fifo_every() == 0:
+            return storage.FIFO_SORT
+        return storage.PRIORITY_SORT
+
+    def shard_query(self):
+        if self.shard is None:
+            return {}
+        return self.shard.query()
+
     def loop(self):
         self.running = True
         while self.running:
-            self.run()
-            time.sleep(self.interval)
+            self.tick()
+            self.last_run_at = time.time()
+            self.stopped.wait(self.interval)
+        self.drain()
+        if self.deadline_timer is not None:
+            self.deadline_timer.cancel()
+        if self.shard is not None:
+            self.shard.leave()
+
+    def tick(self):
+        name = self.__class__.__name__
+        with metrics.runner_tick_seconds.time(runner=name), \
+                tracing.span("runner.tick", runner=name):
+            try:
+                self.run()
+            except Exception:
+                metrics.runner_errors.inc(runner=name)
+                raise
 
     def stop(self):
         self.running = False
+        self.stopped.set()
+
+    def drain(self):
+        pass
+
+    def release_locks(self):
+        if self.locker is not None:
+            self.locker.release_all()
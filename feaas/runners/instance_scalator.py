@@ -2,55 +2,147 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-from feaas import runners, storage
+import sys
+import threading
+
+from feaas import runners, storage, tracing
+
+TERMINAL_STATES = ("error", "removed", "terminating")
 
 
 class InstanceScalator(runners.Base):
     lock_name = "instance_scalator"
 
-    def __init__(self, *args, **kwargs):
-        super(InstanceScalator, self).__init__(*args, **kwargs)
+    def __init__(self, manager, interval, concurrency=1, sharded=False):
+        super(InstanceScalator, self).__init__(manager, interval)
         self.init_locker(self.lock_name)
+        self.concurrency = concurrency
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.workers = []
+        self.in_flight = {}
+        if sharded:
+            self.init_shard(self.lock_name)
 
     def run(self):
-        try:
-            instance, job = self.get_job()
+        if self.shard is not None:
+            self.shard.refresh()
+        if self.concurrency > 1:
+            return self.run_concurrently()
+        tried = set()
+        while not self.stopped.is_set():
+            try:
+                instance, job = self.get_job(tried)
+            except storage.InstanceNotFoundError:
+                continue
+            if not job:
+                return
+            if instance is None:
+                continue
+            try:
+                return self.process(instance, job)
+            finally:
+                self.in_flight.pop(instance.name, None)
+
+    def run_concurrently(self):
+        self.workers = [w for w in self.workers if w.is_alive()]
+        tried = set()
+        while not self.stopped.is_set() and self.slots.acquire(False):
+            try:
+                instance, job = self.get_job(tried)
+            except storage.InstanceNotFoundError:
+                self.slots.release()
+                continue
             if not job:
+                self.slots.release()
                 return
-            self.scale_instance(instance, job["quantity"])
+            if instance is None:
+                self.slots.release()
+                continue
+            worker = threading.Thread(target=self.run_job, args=(instance, job))
+            worker.start()
+            self.workers.append(worker)
+
+    def run_job(self, instance, job):
+        try:
+            self.process(instance, job)
+        except Exception as e:
+            error_msg = " ".join([str(arg) for arg in e.args])
+            msg = "[ERROR] failed to scale instance {}: {}\n"
+            sys.stderr.write(msg.format(instance.name, error_msg))
+            self.reset_job(instance, job)
+        finally:
+            self.in_flight.pop(instance.name, None)
+            self.slots.release()
+
+    def reset_job(self, instance, job):
+        try:
+            self.storage.reset_scale_job(job)
+        except Exception as e:
+            error_msg = " ".join([str(arg) for arg in e.args])
+            msg = "[ERROR] failed to reset scale job of instance {}: {}\n"
+            sys.stderr.write(msg.format(instance.name, error_msg))
+
+    def process(self, instance, job):
+        with tracing.span("instance_scalator.scale", trace_id=job.get("trace_id"),
+                          instance=instance.name, quantity=job["quantity"]):
+            self.scale_instance(instance, job["quantity"], job)
             self.storage.finish_scale_job(job)
-        except storage.InstanceNotFoundError:
-            pass
 
-    def get_job(self):
-        self.locker.lock(self.lock_name)
+    def drain(self):
+        for worker in self.workers:
+            worker.join()
+
+    def checkpoint(self):
+        for instance, job in self.in_flight.values():
+            instance.state = "started"
+            instance.lease_expires_at = None
+            self.storage.store_instance(instance, save_units=False)
+            self.storage.reset_scale_job(job)
+
+    def get_job(self, tried=None):
+        self.lock(self.lock_name)
         try:
-            job = self.storage.get_scale_job()
+            lease_expires_at = runners.lease_expiration()
+            query = dict(self.shard_query())
+            if tried:
+                query["instance"] = {"$nin": list(tried)}
+            job = self.storage.get_scale_job(lease_expires_at=lease_expires_at,
+                                             sort=self.claim_sort(), **query)
             if not job:
                 return None, None
+            if tried is not None:
+                tried.add(job["instance"])
             instance = self.storage.retrieve_instance(name=job["instance"],
                                                       check_liveness=True)
-            if instance.state != "started":
+            if instance.state in TERMINAL_STATES:
+                self.storage.finish_scale_job(job)
+                return None, job
+            claimed = instance.state == "started" and self.storage.transition_instance(
+                instance.name, "started", state="scaling", lease_expires_at=lease_expires_at)
+            if not claimed:
                 self.storage.reset_scale_job(job)
-                return None, None
+                return None, job
             instance.state = "scaling"
-            self.storage.store_instance(instance)
+            instance.lease_expires_at = lease_expires_at
+            self.in_flight[instance.name] = (instance, job)
             return instance, job
         except storage.InstanceNotFoundError:
             self.storage.finish_scale_job(job)
             raise
         finally:
-            self.locker.unlock(self.lock_name)
+            self.unlock(self.lock_name)
 
-    def scale_instance(self, instance, quantity):
+    def scale_instance(self, instance, quantity, job=None):
         lock_name = "%s/%s" % (self.lock_name, instance.name)
         self.locker.init(lock_name)
         self.locker.lock(lock_name)
         try:
             try:
-                self.manager.physical_scale(instance, quantity)
+                with runners.LeaseRenewer(self.storage, instance, job):
+                    self.manager.physical_scale(instance, quantity)
             finally:
                 instance.state = "started"
+                instance.lease_expires_at = None
                 self.storage.store_instance(instance, save_units=False)
         finally:
             self.locker.unlock(lock_name)
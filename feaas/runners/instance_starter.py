@@ -13,19 +13,34 @@ class InstanceStarter(runners.Base):
     def __init__(self, *args, **kwargs):
         super(InstanceStarter, self).__init__(*args, **kwargs)
         self.init_locker(self.lock_name)
+        self.in_flight = None
 
     def run(self):
         try:
-            instance = self.get_instance()
-            self.start_instance(instance)
+            self.in_flight = self.get_instance()
+            self.start_instance(self.in_flight)
         except storage.InstanceNotFoundError:
             pass
+        finally:
+            self.in_flight = None
+
+    def checkpoint(self):
+        instance = self.in_flight
+        if instance is None:
+            return
+        stored = self.storage.retrieve_instance(name=instance.name)
+        instance.state = "started" if stored.units else "creating"
+        instance.lease_expires_at = None
+        self.storage.store_instance(instance, save_units=False)
 
     def get_instance(self):
         self.locker.lock(self.lock_name)
         try:
-            instance = self.storage.retrieve_instance(state="creating")
+            instance = self.storage.retrieve_instance(state="creating",
+                                                      sort=self.claim_sort(),
+                                                      **runners.due_query())
             instance.state = "starting"
+            instance.lease_expires_at = runners.lease_expiration()
             self.storage.store_instance(instance)
             return instance
         finally:
@@ -35,12 +50,15 @@ class InstanceStarter(runners.Base):
         self.locker.lock(self.lock_name)
         try:
             try:
-                self.manager.start_instance(instance.name)
+                with runners.LeaseRenewer(self.storage, instance):
+                    self.manager.start_instance(instance.name)
                 instance.state = "started"
+                runners.reset_retries(instance)
             except Exception as e:
-                instance.state = "error"
-                error_msg = " ".join(e.args)
+                error_msg = " ".join([str(arg) for arg in e.args])
+                runners.schedule_retry(instance, error_msg)
                 sys.stderr.write("[ERROR] failed to start instance: {}\n".format(error_msg))
+            instance.lease_expires_at = None
             self.storage.store_instance(instance, save_units=False)
         finally:
             self.locker.unlock(self.lock_name)
@@ -11,19 +11,35 @@ class InstanceTerminator(runners.Base):
     def __init__(self, *args, **kwargs):
         super(InstanceTerminator, self).__init__(*args, **kwargs)
         self.init_locker(self.lock_name)
+        self.in_flight = None
 
     def run(self):
         try:
-            instance = self.get_instance()
-            self.terminate_instance(instance)
+            self.in_flight = self.get_instance()
+            self.terminate_instance(self.in_flight)
         except storage.InstanceNotFoundError:
             pass
+        finally:
+            self.in_flight = None
+
+    def checkpoint(self):
+        instance = self.in_flight
+        if instance is None:
+            return
+        try:
+            self.storage.retrieve_instance(name=instance.name)
+        except storage.InstanceNotFoundError:
+            return
+        instance.state = "removed"
+        instance.lease_expires_at = None
+        self.storage.store_instance(instance, save_units=False)
 
     def get_instance(self):
         self.locker.lock(self.lock_name)
         try:
             instance = self.storage.retrieve_instance(state="removed")
             instance.state = "terminating"
+            instance.lease_expires_at = runners.lease_expiration()
             self.storage.store_instance(instance)
             return instance
         finally:
@@ -32,7 +48,8 @@ class InstanceTerminator(runners.Base):
     def terminate_instance(self, instance):
         self.locker.lock(self.lock_name)
         try:
-            self.manager.terminate_instance(instance.name)
+            with runners.LeaseRenewer(self.storage, instance):
+                self.manager.terminate_instance(instance.name)
         finally:
             try:
                 self.storage.remove_instance(instance.name)
@@ -0,0 +1,27 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+from feaas import runners
+
+
+class LeaseSweeper(runners.Base):
+    """
+    LeaseSweeper recovers work abandoned by runners that died in the middle
+    of it. Runners write a lease when they claim an instance or a scale job,
+    renew it while they work, and clear it when they're done. Whenever a
+    lease expires, the sweeper moves the item back to a state that other
+    runners will pick up:
+
+        - starting instances go back to creating (or to started, when their
+          units were already stored)
+        - scaling instances go back to started
+        - terminating instances go back to removed
+        - processing scale jobs go back to pending
+    """
+
+    def __init__(self, manager, interval=10):
+        super(LeaseSweeper, self).__init__(manager, interval)
+
+    def run(self):
+        return self.storage.release_expired_leases()
@@ -0,0 +1,83 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import sys
+
+from feaas import runners
+
+
+class PoolReplenisher(runners.Base):
+    """
+    PoolReplenisher keeps the pool of idle units filled, so instances can be
+    started (or scaled) by claiming units that are already up:
+
+        - boots new units whenever the pool has less than ``size`` units
+        - marks booting units as ready as soon as Varnish accepts connections
+        - terminates recycled units that stayed in the pool for too long,
+          removing them from the pool only once they're terminated (units
+          that fail to terminate stay in the pool and are retried)
+    """
+
+    lock_name = "pool_replenisher"
+
+    def __init__(self, manager, interval=10, size=0, batch_size=50):
+        super(PoolReplenisher, self).__init__(manager, interval)
+        self.init_locker(self.lock_name)
+        self.size = size
+        self.batch_size = batch_size
+
+    def run(self):
+        self.locker.lock(self.lock_name)
+        try:
+            self.probe_units()
+            self.expire_units()
+            self.fill()
+        finally:
+            self.locker.unlock(self.lock_name)
+
+    def probe_units(self):
+        units = self.storage.retrieve_pool_units(state="booting")
+        up_units = [unit for unit in units if runners.is_unit_up(unit)]
+        if up_units:
+            self.storage.update_pool_units(up_units, state="ready")
+
+    def expire_units(self):
+        now = datetime.datetime.utcnow()
+        units = self.storage.retrieve_pool_units(state="expiring", limit=self.batch_size)
+        while True:
+            while len(units) < self.batch_size:
+                unit = self.storage.expire_pool_unit(expires_at={"$lt": now})
+                if not unit:
+                    break
+                units.append(unit)
+            if units and not self.destroy_units(units):
+                return
+            if len(units) < self.batch_size:
+                return
+            units = []
+
+    def destroy_units(self, units):
+        failed = self.manager.destroy_units(units) or []
+        failed_ids = set([unit.id for unit in failed])
+        destroyed = [unit for unit in units if unit.id not in failed_ids]
+        if destroyed:
+            self.storage.remove_pool_units(destroyed)
+        if failed:
+            self.storage.update_pool_units(failed, state="ready")
+            msg = "[ERROR] failed to destroy {} expired pool units, will retry\n"
+            sys.stderr.write(msg.format(len(failed)))
+        return not failed
+
+    def fill(self):
+        missing = self.size - self.storage.count_pool_units()
+        for i in xrange(missing):
+            try:
+                unit = self.manager.boot_unit()
+            except Exception as e:
+                error_msg = " ".join([str(arg) for arg in e.args])
+                sys.stderr.write("[ERROR] failed to boot pool unit: {}\n".format(error_msg))
+                return
+            unit.state = "booting"
+            self.storage.store_pool_unit(unit)
@@ -0,0 +1,227 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import sys
+from multiprocessing import pool
+
+from feaas import runners, storage
+
+
+class Plan(object):
+
+    def __init__(self, instance, binds=None, job=None):
+        self.instance = instance
+        self.binds = binds or []
+        self.job = job
+        self.actions = []
+
+    def diff(self):
+        instance = self.instance
+        if instance.state == "removed":
+            self.actions.append("terminate")
+            return self.actions
+        if instance.state == "creating":
+            if runners.is_due(instance):
+                self.actions.append("start")
+        elif self.job and instance.state == "started":
+            if self.job["quantity"] != len(instance.units):
+                self.actions.append("scale")
+            else:
+                self.actions.append("finish_job")
+        if [b for b in self.binds if b.state == "creating"]:
+            self.actions.append("write_binds")
+        if [b for b in self.binds if b.state == "removing"]:
+            self.actions.append("remove_binds")
+        if [u for u in instance.units if u.state == "creating"]:
+            self.actions.append("write_units")
+        return self.actions
+
+
+class Reconciler(runners.Base):
+    """
+    Reconciler replaces InstanceStarter, InstanceTerminator, InstanceScalator
+    and VCLWriter with a single loop that, on each pass:
+
+        - finds the instances that are not converged: instances being created
+          or removed, instances with pending scale jobs and instances with
+          binds or units that still need VCL (or binds whose VCL must be
+          removed)
+        - loads all these instances, with their units, binds and jobs, using
+          a handful of queries
+        - computes the actions needed by each instance and runs them in a
+          thread pool, running the actions of the same instance in order
+
+    The lock is only held while planning: instances whose plans are still
+    running in the pool are left out of the next plans.
+    """
+
+    lock_name = "reconciler"
+
+    def __init__(self, manager, interval=10, concurrency=8):
+        super(Reconciler, self).__init__(manager, interval)
+        self.init_locker(self.lock_name)
+        self.concurrency = concurrency
+        self.executor = pool.ThreadPool(concurrency)
+        self.in_flight = {}
+
+    def run(self):
+        self.locker.lock(self.lock_name)
+        try:
+            plans = self.plan()
+            for plan in plans:
+                self.in_flight[plan.instance.name] = plan
+        finally:
+            self.locker.unlock(self.lock_name)
+        for plan in plans:
+            self.executor.apply_async(self.reconcile, (plan,))
+
+    def drain(self):
+        self.executor.close()
+        self.executor.join()
+
+    def plan(self):
+        names = set()
+        for instance in self.storage.retrieve_instances(state={"$in": ["creating",
+                                                                       "removed"]}):
+            names.add(instance.name)
+        jobs = {}
+        for job in self.storage.retrieve_scale_jobs(state="pending"):
+            jobs[job["instance"]] = job
+        names.update(jobs.keys())
+        for bind in self.storage.retrieve_binds(state={"$in": ["creating", "removing"]}):
+            names.add(bind.instance.name)
+        for unit in self.storage.retrieve_units(state="creating"):
+            names.add(unit.instance.name)
+        names.difference_update(list(self.in_flight.keys()))
+        if not names:
+            return []
+        names = list(names)
+        binds = {}
+        for bind in self.storage.retrieve_binds(instance_name={"$in": names}):
+            binds.setdefault(bind.instance.name, []).append(bind)
+        plans = []
+        for instance in self.storage.retrieve_instances(name={"$in": names}):
+            plan = Plan(instance, binds.get(instance.name), jobs.get(instance.name))
+            if plan.diff():
+                plans.append(plan)
+        return plans
+
+    def reconcile(self, plan):
+        self.in_flight[plan.instance.name] = plan
+        try:
+            for action in plan.actions:
+                try:
+                    getattr(self, action)(plan)
+                except Exception as e:
+                    error_msg = " ".join([str(arg) for arg in e.args])
+                    msg = "[ERROR] failed to {} instance {}: {}\n"
+                    sys.stderr.write(msg.format(action, plan.instance.name, error_msg))
+                    return
+        finally:
+            self.in_flight.pop(plan.instance.name, None)
+
+    def checkpoint(self):
+        for plan in self.in_flight.values():
+            instance = plan.instance
+            if instance.state == "starting":
+                stored = self.storage.retrieve_instance(name=instance.name)
+                instance.state = "started" if stored.units else "creating"
+            elif instance.state == "scaling":
+                instance.state = "started"
+                self.storage.reset_scale_job(plan.job)
+            elif instance.state == "terminating":
+                try:
+                    self.storage.retrieve_instance(name=instance.name)
+                except storage.InstanceNotFoundError:
+                    continue
+                instance.state = "removed"
+            else:
+                continue
+            instance.lease_expires_at = None
+            self.storage.store_instance(instance, save_units=False)
+
+    def start(self, plan):
+        instance = plan.instance
+        instance.state = "starting"
+        instance.lease_expires_at = runners.lease_expiration()
+        self.storage.store_instance(instance, save_units=False)
+        try:
+            with runners.LeaseRenewer(self.storage, instance):
+                started = self.manager.start_instance(instance.name)
+            instance.units = started.units
+            instance.state = "started"
+            runners.reset_retries(instance)
+        except Exception as e:
+            runners.schedule_retry(instance, " ".join([str(arg) for arg in e.args]))
+            raise
+        finally:
+            instance.lease_expires_at = None
+            self.storage.store_instance(instance, save_units=False)
+
+    def terminate(self, plan):
+        instance = plan.instance
+        instance.state = "terminating"
+        instance.lease_expires_at = runners.lease_expiration()
+        self.storage.store_instance(instance, save_units=False)
+        try:
+            with runners.LeaseRenewer(self.storage, instance):
+                self.manager.terminate_instance(instance.name)
+        finally:
+            self.storage.remove_instance(instance.name)
+
+    def scale(self, plan):
+        instance, job = plan.instance, plan.job
+        instance.lease_expires_at = runners.lease_expiration()
+        self.storage.start_scale_job(job, instance.lease_expires_at)
+        instance.state = "scaling"
+        self.storage.store_instance(instance, save_units=False)
+        try:
+            with runners.LeaseRenewer(self.storage, instance, job):
+                self.manager.physical_scale(instance, job["quantity"])
+        except Exception:
+            self.storage.reset_scale_job(job)
+            raise
+        finally:
+            instance.state = "started"
+            instance.lease_expires_at = None
+            self.storage.store_instance(instance, save_units=False)
+        self.storage.finish_scale_job(job)
+
+    def finish_job(self, plan):
+        self.storage.finish_scale_job(plan.job)
+
+    def write_binds(self, plan):
+        units = [u for u in plan.instance.units if u.state == "started"]
+        binds = [b for b in plan.binds if b.state == "creating"]
+        if not binds:
+            return
+        for unit in units:
+            self.manager.write_vcl(unit.dns_name, unit.secret, binds[0].app_host)
+        for bind in binds:
+            self.storage.update_bind(bind, state="created")
+            bind.state = "created"
+
+    def remove_binds(self, plan):
+        units = [u for u in plan.instance.units if u.state == "started"]
+        binds = [b for b in plan.binds if b.state == "removing"]
+        if not binds:
+            return
+        for unit in units:
+            self.manager.remove_vcl(unit.dns_name, unit.secret)
+        for bind in binds:
+            self.storage.remove_bind(bind)
+            bind.state = "removed"
+
+    def write_units(self, plan):
+        units = [u for u in plan.instance.units
+                 if u.state == "creating" and runners.is_unit_up(u)]
+        if not units:
+            return
+        binds = [b for b in plan.binds if b.state == "created"]
+        if binds:
+            for unit in units:
+                self.manager.write_vcl(unit.dns_name, unit.secret, binds[0].app_host)
+        self.storage.update_units(units, state="started")
+        for unit in units:
+            unit.state = "started"
@@ -0,0 +1,78 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import bisect
+import datetime
+import hashlib
+import os
+import socket
+import uuid
+
+from feaas import storage
+
+
+def _hash(key):
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+
+    def __init__(self, nodes, vnodes=64):
+        self.nodes = sorted(nodes)
+        self.ring = []
+        for node in self.nodes:
+            for i in xrange(vnodes):
+                self.ring.append((_hash("{}#{}".format(node, i)), node))
+        self.ring.sort()
+        self.keys = [k for k, _ in self.ring]
+
+    def get_node(self, key):
+        if not self.ring:
+            return None
+        index = bisect.bisect(self.keys, _hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+
+class Shard(object):
+    """
+    Shard splits the work of a runner among all its replicas.
+
+    Each replica registers itself in the database, and keeps sending
+    heartbeats on every refresh. Replicas that miss heartbeats for ``ttl``
+    seconds are considered dead. The buckets computed by
+    :func:`feaas.storage.shard_of` are distributed among live replicas using
+    a consistent hash ring, so whenever a replica joins or dies only its share
+    of the buckets moves.
+    """
+
+    def __init__(self, strg, group, ttl=30, replica_id=None):
+        self.storage = strg
+        self.group = group
+        self.ttl = ttl
+        self.replica_id = replica_id or "{}:{}:{}".format(socket.gethostname(),
+                                                          os.getpid(),
+                                                          uuid.uuid4().hex[:8])
+        self.members = []
+        self.buckets = []
+
+    def refresh(self):
+        self.storage.store_replica(self.group, self.replica_id)
+        alive_since = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.ttl)
+        members = self.storage.retrieve_replicas(self.group, alive_since)
+        if self.replica_id not in members:
+            members = sorted(members + [self.replica_id])
+        if members != self.members:
+            ring = HashRing(members)
+            self.buckets = [b for b in xrange(storage.SHARDS)
+                            if ring.get_node(str(b)) == self.replica_id]
+            self.members = members
+        return self.buckets
+
+    def query(self):
+        return {"shard": {"$in": self.buckets}}
+
+    def leave(self):
+        self.storage.remove_replica(self.replica_id)
+        self.members = []
+        self.buckets = []
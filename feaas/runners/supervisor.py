@@ -0,0 +1,136 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import sys
+import threading
+import time
+
+from feaas import managers, runners
+from feaas.runners import (instance_scalator, instance_starter, instance_terminator,
+                           lease_sweeper, pool_replenisher, reconciler, vcl_writer)
+
+RUNNERS = {
+    "vcl_writer": vcl_writer.VCLWriter,
+    "instance_starter": instance_starter.InstanceStarter,
+    "instance_terminator": instance_terminator.InstanceTerminator,
+    "instance_scalator": instance_scalator.InstanceScalator,
+    "pool_replenisher": lambda manager, interval: pool_replenisher.PoolReplenisher(
+        manager, interval, managers.pool_size()),
+    "reconciler": reconciler.Reconciler,
+    "lease_sweeper": lease_sweeper.LeaseSweeper,
+}
+
+DEFAULT_RUNNERS = ["vcl_writer", "instance_starter", "instance_terminator",
+                   "instance_scalator", "lease_sweeper"]
+
+
+class Supervisor(runners.GracefulShutdown):
+    """
+    Supervisor runs many runners in the same process, each one in its own
+    thread, sharing the manager (and thus the storage and the cloud
+    connections):
+
+        - whenever a runner crashes, it's replaced by a new one after
+          ``restart_delay`` seconds
+        - it keeps track of the health of each runner (when it last ran, how
+          many times it was restarted and the last error), reporting runners
+          that haven't run for ``stall_timeout`` seconds
+        - on shutdown, it stops all runners and, once the deadline is
+          exceeded, checkpoints the in-flight work of each one of them
+    """
+
+    def __init__(self, manager, names=None, interval=10, restart_delay=5,
+                 stall_timeout=300):
+        self.manager = manager
+        self.names = names or DEFAULT_RUNNERS
+        for name in self.names:
+            if name not in RUNNERS:
+                raise ValueError("unknown runner: {}".format(name))
+        self.interval = interval
+        self.restart_delay = restart_delay
+        self.stall_timeout = stall_timeout
+        self.runners = {}
+        self.threads = {}
+        self.restarts = dict([(name, 0) for name in self.names])
+        self.errors = {}
+        self.started_at = {}
+        self.running = False
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.running = True
+        for name in self.names:
+            t = threading.Thread(target=self.supervise, args=(name,), name=name)
+            t.daemon = True
+            t.start()
+            self.threads[name] = t
+
+    def supervise(self, name):
+        while self.running:
+            runner = RUNNERS[name](self.manager, self.interval)
+            self.runners[name] = runner
+            self.started_at[name] = time.time()
+            try:
+                runner.loop()
+            except Exception as e:
+                error_msg = " ".join([str(arg) for arg in e.args])
+                self.errors[name] = error_msg
+                self.restarts[name] += 1
+                msg = "[ERROR] runner {} crashed, restarting: {}\n"
+                sys.stderr.write(msg.format(name, error_msg))
+                self.stopped.wait(self.restart_delay)
+            else:
+                return
+
+    def health(self):
+        result = {}
+        for name in self.names:
+            runner = self.runners.get(name)
+            last_run = getattr(runner, "last_run_at", None)
+            thread = self.threads.get(name)
+            result[name] = {"alive": thread is not None and thread.is_alive(),
+                            "last_run_at": last_run,
+                            "restarts": self.restarts[name],
+                            "last_error": self.errors.get(name)}
+        return result
+
+    def check(self):
+        now = time.time()
+        stalled = []
+        for name, status in self.health().items():
+            since = status["last_run_at"] or self.started_at.get(name, now)
+            if status["alive"] and now - since > self.stall_timeout:
+                stalled.append(name)
+                msg = "[ERROR] runner {} has not run for {} seconds\n"
+                sys.stderr.write(msg.format(name, int(now - since)))
+        return stalled
+
+    def loop(self):
+        self.start()
+        while self.running:
+            self.check()
+            self.stopped.wait(self.interval)
+        for thread in self.threads.values():
+            thread.join()
+        if self.deadline_timer is not None:
+            self.deadline_timer.cancel()
+
+    def stop(self):
+        self.running = False
+        self.stopped.set()
+        for runner in self.runners.values():
+            runner.stop()
+
+    def checkpoint(self):
+        for name, runner in self.runners.items():
+            try:
+                runner.checkpoint()
+            except Exception as e:
+                error_msg = " ".join([str(arg) for arg in e.args])
+                msg = "[ERROR] failed to checkpoint runner {}: {}\n"
+                sys.stderr.write(msg.format(name, error_msg))
+
+    def release_locks(self):
+        for runner in self.runners.values():
+            runner.release_locks()
@@ -2,13 +2,15 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-import telnetlib
+import sys
 import threading
+from multiprocessing import pool
 
-from feaas import runners
+from feaas import runners, storage, tracing
 
 UNITS_LOCKER = "units"
 BINDS_LOCKER = "binds"
+UNBINDS_LOCKER = "unbinds"
 
 
 class VCLWriter(runners.Base):
@@ -17,27 +19,45 @@ class VCLWriter(runners.Base):
 
         - whenever a new unit is added to an instance, bind this unit to all
           applications that are already bound to this unit
-        - whenever a new bind is made, connect all started units to the
-          application that is being created
+        - whenever new binds are made, connect all started units to the
+          applications that are being bound, pushing the VCL only once per
+          unit
+        - whenever a bind is removed, remove the VCL from all started units
+          of the instance (concurrently, up to ``concurrency`` units at a
+          time), keeping the bind until it succeeds in all of them
+
+    When ``sharded`` is True, the writer handles only the units and binds of
+    its own share of instances (see :class:`feaas.runners.sharding.Shard`),
+    without taking the global locks, so many writers can run in parallel.
     """
 
-    def __init__(self, manager, interval=10, max_items=None):
+    def __init__(self, manager, interval=10, max_items=None, sharded=False, concurrency=8):
         super(VCLWriter, self).__init__(manager, interval)
-        self.init_locker(UNITS_LOCKER, BINDS_LOCKER)
+        self.init_locker(UNITS_LOCKER, BINDS_LOCKER, UNBINDS_LOCKER)
         self.max_items = max_items
+        self.concurrency = concurrency
+        self.executor = None
+        if sharded:
+            self.init_shard("vcl_writer")
 
     def run(self):
+        if self.shard is not None:
+            self.shard.refresh()
         t1 = threading.Thread(target=self.run_units)
         t1.start()
         t2 = threading.Thread(target=self.run_binds)
         t2.start()
+        t3 = threading.Thread(target=self.run_unbinds)
+        t3.start()
         t1.join()
         t2.join()
+        t3.join()
 
     def run_units(self):
-        self.locker.lock(UNITS_LOCKER)
+        self.lock(UNITS_LOCKER)
         try:
-            units = self.storage.retrieve_units(state="creating", limit=self.max_items)
+            units = self.storage.retrieve_units(state="creating", limit=self.max_items,
+                                                **self.shard_query())
             up_units = []
             for unit in units:
                 if self._is_unit_up(unit):
@@ -46,7 +66,7 @@ class VCLWriter(runners.Base):
                 self.bind_units(up_units)
                 self.storage.update_units(up_units, state="started")
         finally:
-            self.locker.unlock(UNITS_LOCKER)
+            self.unlock(UNITS_LOCKER)
 
     def bind_units(self, units):
         binds_dict = {}
@@ -54,29 +74,73 @@ class VCLWriter(runners.Base):
             iname = unit.instance.name
             if iname not in binds_dict:
                 binds_dict[iname] = self.storage.retrieve_binds(instance_name=iname,
-                                                                state="created")
+                                                                state="created", limit=1,
+                                                                sort=storage.FIFO_SORT)
             binds = binds_dict[iname]
             for bind in binds:
                 self.manager.write_vcl(unit.dns_name, unit.secret, bind.app_host)
 
     def _is_unit_up(self, unit):
-        try:
-            client = telnetlib.Telnet(unit.dns_name, "6082", timeout=3)
-            client.close()
-            return True
-        except:
-            return False
+        return runners.is_unit_up(unit)
 
     def run_binds(self):
-        self.locker.lock(BINDS_LOCKER)
+        self.lock(BINDS_LOCKER)
         try:
-            binds = self.storage.retrieve_binds(state="creating", limit=self.max_items)
-            instance_names = [b.instance.name for b in binds]
-            units = self.storage.retrieve_units(state="started",
-                                                instance_name={"$in": instance_names})
+            binds = self.storage.retrieve_binds(state="creating", limit=self.max_items,
+                                                sort=self.claim_sort(),
+                                                **self.shard_query())
+            instance_names = sorted(set([b.instance.name for b in binds]))
+            units = {}
+            for unit in self.storage.retrieve_units(state="started",
+                                                    instance_name={"$in": instance_names}):
+                units.setdefault(unit.instance.name, []).append(unit)
+            pushed = set()
+            for bind in binds:
+                with tracing.span("vcl_writer.bind", trace_id=bind.trace_id,
+                                  instance=bind.instance.name, app_host=bind.app_host):
+                    if bind.instance.name not in pushed:
+                        for unit in units.get(bind.instance.name, []):
+                            self.manager.write_vcl(unit.dns_name, unit.secret, bind.app_host)
+                        pushed.add(bind.instance.name)
+                    self.storage.update_bind(bind, state="created")
+        finally:
+            self.unlock(BINDS_LOCKER)
+
+    def run_unbinds(self):
+        self.lock(UNBINDS_LOCKER)
+        try:
+            binds = self.storage.retrieve_binds(state="removing", limit=self.max_items,
+                                                sort=self.claim_sort(),
+                                                **self.shard_query())
+            if not binds:
+                return
+            removing = {}
             for bind in binds:
-                for unit in units:
-                    self.manager.write_vcl(unit.dns_name, unit.secret, bind.app_host)
-                self.storage.update_bind(bind, state="created")
+                removing.setdefault(bind.instance.name, []).append(bind)
+            units = self.storage.retrieve_units(state="started",
+                                                instance_name={"$in": sorted(removing)})
+            tasks = [(removing[unit.instance.name][0], unit) for unit in units]
+            if self.executor is None:
+                self.executor = pool.ThreadPool(self.concurrency)
+            failed = set([bind.instance.name
+                          for bind, error in self.executor.map(self.remove_vcl, tasks)
+                          if error is not None])
+            for name, binds in removing.items():
+                if name not in failed:
+                    for bind in binds:
+                        self.storage.remove_bind(bind)
         finally:
-            self.locker.unlock(BINDS_LOCKER)
+            self.unlock(UNBINDS_LOCKER)
+
+    def remove_vcl(self, task):
+        bind, unit = task
+        try:
+            with tracing.span("vcl_writer.unbind", trace_id=bind.trace_id,
+                              instance=bind.instance.name, unit=unit.id):
+                self.manager.remove_vcl(unit.dns_name, unit.secret)
+        except Exception as e:
+            msg = "[ERROR] failed to remove VCL from unit {} of instance {}: {}\n"
+            sys.stderr.write(msg.format(unit.id, bind.instance.name,
+                                        " ".join([str(arg) for arg in e.args])))
+            return bind, e
+        return bind, None
@@ -2,10 +2,54 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import copy
 import datetime
+import functools
+import heapq
+import itertools
+import operator
+import os
+import sys
+import threading
+import time
+import zlib
 
+import bson
 import pymongo
 
+from feaas import metrics, tracing
+
+_indexed = set()
+_notifiers = {}
+_notifiers_lock = threading.Lock()
+
+SHARDS = 1024
+
+PRIORITY_BULK = 0
+PRIORITY_INTERACTIVE = 10
+PRIORITIES = {"bulk": PRIORITY_BULK, "interactive": PRIORITY_INTERACTIVE}
+
+PRIORITY_SORT = [("priority", pymongo.DESCENDING), ("_id", pymongo.ASCENDING)]
+FIFO_SORT = [("_id", pymongo.ASCENDING)]
+
+SCAN_KINDS = ["instances", "units", "binds"]
+
+LEASED_STATES = {"starting": "creating", "scaling": "started",
+                 "terminating": "removed"}
+
+
+def shard_of(instance_name):
+    return (zlib.crc32(instance_name.encode("utf-8")) & 0xffffffff) % SHARDS
+
+
+def _bind_item(bind):
+    item = dict(bind.to_dict(), shard=shard_of(bind.instance.name))
+    if bind.priority is not None:
+        item["priority"] = bind.priority
+    if bind.trace_id is not None:
+        item["trace_id"] = bind.trace_id
+    return item
+
 
 class InstanceNotFoundError(Exception):
     pass
@@ -21,15 +65,30 @@ class DoubleUnlockError(Exception):
 
 class Instance(object):
 
-    def __init__(self, name=None, state="creating", units=None):
+    def __init__(self, name=None, state="creating", units=None, lease_expires_at=None,
+                 attempts=0, last_error=None, next_attempt_at=None, priority=None):
         self.name = name
         self.state = state
+        self.priority = priority
         self.units = units or []
+        self.lease_expires_at = lease_expires_at
+        self.attempts = attempts
+        self.last_error = last_error
+        self.next_attempt_at = next_attempt_at
         for unit in self.units:
             unit.instance = self
 
     def to_dict(self):
-        return {"name": self.name, "state": self.state}
+        data = {"name": self.name, "state": self.state}
+        if self.priority is not None:
+            data["priority"] = self.priority
+        if self.lease_expires_at:
+            data["lease_expires_at"] = self.lease_expires_at
+        if self.attempts:
+            data["attempts"] = self.attempts
+            data["last_error"] = self.last_error
+            data["next_attempt_at"] = self.next_attempt_at
+        return data
 
     def add_unit(self, unit):
         unit.instance = self
@@ -59,10 +118,12 @@ class Unit(object):
 class Bind(object):
 
     def __init__(self, app_host, instance, created_at=None,
-                 state="creating"):
+                 state="creating", priority=None, trace_id=None):
         self.app_host = app_host
         self.instance = instance
         self.state = state
+        self.priority = priority
+        self.trace_id = trace_id
         self.created_at = created_at or datetime.datetime.utcnow()
 
     def to_dict(self):
@@ -70,7 +131,137 @@ class Bind(object):
                 "created_at": self.created_at, "state": self.state}
 
 
-class MongoDBStorage(object):
+class BaseStorage(object):
+    """
+    BaseStorage defines the interface of storage backends, implemented by
+    :class:`MongoDBStorage` and :class:`MemoryStorage`. Backends are
+    registered in the API with :func:`feaas.api.register_storage`, and must
+    pass the contract tests in ``tests/test_storage.py``.
+
+    Queries are given as keyword arguments, using MongoDB's syntax for
+    operators (``$in``, ``$nin``, ``$lt``, ``$gte``, ``$or``...), and sorts
+    as lists of ``(field, direction)`` pairs, like :data:`PRIORITY_SORT`.
+
+    ``transition_instance`` applies ``changes`` to an instance only if it's
+    still in ``from_state``, atomically, returning whether it did. Runners use it
+    to claim instances without holding a global lock.
+
+    ``scan`` iterates over the raw documents of ``kind`` (one of
+    :data:`SCAN_KINDS`) in insertion order, yielding ``(cursor, document)``
+    pairs. The cursor is a string, and passing it as ``after`` resumes the
+    scan after that document.
+    """
+
+    def store_instance(self, instance, save_units=True):
+        raise NotImplementedError()
+
+    def retrieve_instance(self, check_liveness=False, sort=None, **query):
+        raise NotImplementedError()
+
+    def retrieve_instances(self, **query):
+        raise NotImplementedError()
+
+    def retrieve_units(self, limit=None, **query):
+        raise NotImplementedError()
+
+    def transition_instance(self, name, from_state, **changes):
+        raise NotImplementedError()
+
+    def remove_instance(self, name):
+        raise NotImplementedError()
+
+    def ensure_indexes(self):
+        pass
+
+    def store_scale_job(self, job):
+        raise NotImplementedError()
+
+    def get_scale_job(self, lease_expires_at=None, sort=None, **query):
+        raise NotImplementedError()
+
+    def start_scale_job(self, job, lease_expires_at=None):
+        raise NotImplementedError()
+
+    def retrieve_scale_jobs(self, **query):
+        raise NotImplementedError()
+
+    def reset_scale_job(self, job):
+        raise NotImplementedError()
+
+    def finish_scale_job(self, job):
+        raise NotImplementedError()
+
+    def renew_scale_job(self, job, lease_expires_at):
+        raise NotImplementedError()
+
+    def release_expired_leases(self, now=None):
+        raise NotImplementedError()
+
+    def store_bind(self, bind):
+        raise NotImplementedError()
+
+    def store_binds(self, binds):
+        raise NotImplementedError()
+
+    def retrieve_binds(self, limit=None, sort=None, **query):
+        raise NotImplementedError()
+
+    def remove_bind(self, bind):
+        raise NotImplementedError()
+
+    def update_units(self, units, **changes):
+        raise NotImplementedError()
+
+    def update_bind(self, bind, **changes):
+        raise NotImplementedError()
+
+    def update_binds(self, query, **changes):
+        raise NotImplementedError()
+
+    def store_pool_unit(self, unit, expires_at=None):
+        raise NotImplementedError()
+
+    def retrieve_pool_units(self, limit=None, **query):
+        raise NotImplementedError()
+
+    def update_pool_units(self, units, **changes):
+        raise NotImplementedError()
+
+    def claim_pool_unit(self, **query):
+        raise NotImplementedError()
+
+    def expire_pool_unit(self, **query):
+        raise NotImplementedError()
+
+    def remove_pool_units(self, units):
+        raise NotImplementedError()
+
+    def count_pool_units(self, **query):
+        raise NotImplementedError()
+
+    def store_replica(self, group, replica_id):
+        raise NotImplementedError()
+
+    def retrieve_replicas(self, group, alive_since):
+        raise NotImplementedError()
+
+    def remove_replica(self, replica_id):
+        raise NotImplementedError()
+
+    def queue_depths(self):
+        raise NotImplementedError()
+
+    def scan(self, kind, after=None, limit=None, batch_size=1000, **query):
+        raise NotImplementedError()
+
+    def new_locker(self):
+        raise NotImplementedError()
+
+    def new_notifier(self):
+        return None
+
+
+class MongoDBStorage(BaseStorage):
 
     def __init__(self, mongo_uri=None, dbname=None):
         self.mongo_uri = mongo_uri or "mongodb://localhost:27017/"
@@ -78,25 +269,44 @@ class MongoDBStorage(object):
         client = pymongo.MongoClient(self.mongo_uri)
         self.db = client[self.dbname]
         self.collection_name = "instances"
+        if (self.mongo_uri, self.dbname) not in _indexed:
+            self.ensure_indexes()
+            _indexed.add((self.mongo_uri, self.dbname))
 
     def store_instance(self, instance, save_units=True):
-        self.db[self.collection_name].update({"name": instance.name}, instance.to_dict(),
+        shard = shard_of(instance.name)
+        self.db[self.collection_name].update({"name": instance.name},
+                                             dict(instance.to_dict(), shard=shard),
                                              upsert=True)
         if save_units:
             self.db.units.remove({"instance_name": instance.name})
             if instance.units:
-                self.db.units.insert([u.to_dict() for u in instance.units])
+                self.db.units.insert([dict(u.to_dict(), shard=shard)
+                                      for u in instance.units])
 
-    def retrieve_instance(self, check_liveness=False, **query):
+    def retrieve_instance(self, check_liveness=False, sort=None, **query):
         if check_liveness:
             query["state"] = {"$nin": ["removed", "terminating"]}
-        instance = self.db[self.collection_name].find_one(query)
+        instance = self.db[self.collection_name].find_one(query, sort=sort)
         if not instance:
             raise InstanceNotFoundError()
         del instance["_id"]
+        instance.pop("shard", None)
         instance["units"] = self.retrieve_units(instance_name=instance["name"])
         return Instance(**instance)
 
+    def retrieve_instances(self, **query):
+        instances = []
+        for item in self.db[self.collection_name].find(query):
+            del item["_id"]
+            item.pop("shard", None)
+            instances.append(Instance(**item))
+        if instances:
+            names = dict([(i.name, i) for i in instances])
+            for unit in self.retrieve_units(instance_name={"$in": names.keys()}):
+                names[unit.instance.name].add_unit(unit)
+        return instances
+
     def retrieve_units(self, limit=None, **query):
         cursor = self.db.units.find(query)
         if limit:
@@ -106,48 +316,161 @@ class MongoDBStorage(object):
             unit["instance"] = Instance(name=unit["instance_name"])
             del unit["instance_name"]
             del unit["_id"]
+            unit.pop("shard", None)
             units.append(Unit(**unit))
         return units
 
+    def transition_instance(self, name, from_state, **changes):
+        r = self.db[self.collection_name].update({"name": name, "state": from_state},
+                                                 {"$set": changes})
+        return r["n"] > 0
+
     def remove_instance(self, name):
         self.db.binds.remove({"instance_name": name})
         self.db.units.remove({"instance_name": name})
         self.db[self.collection_name].remove({"name": name})
 
+    def ensure_indexes(self):
+        ttl = int(os.environ.get("API_SCALE_JOB_TTL", 86400))
+        self.db.scale_jobs.ensure_index([("instance", pymongo.ASCENDING),
+                                         ("state", pymongo.ASCENDING)])
+        self._ensure_ttl_index("scale_jobs", "finished_at", ttl)
+        for collection in (self.collection_name, "units", "binds", "scale_jobs"):
+            self.db[collection].ensure_index([("shard", pymongo.ASCENDING),
+                                              ("state", pymongo.ASCENDING)])
+        self._backfill_shards()
+        self._ensure_ttl_index("runner_replicas", "heartbeat_at", 3600)
+        for collection in (self.collection_name, "scale_jobs"):
+            self.db[collection].ensure_index([("state", pymongo.ASCENDING),
+                                              ("lease_expires_at", pymongo.ASCENDING)])
+        self.db[self.collection_name].ensure_index([("state", pymongo.ASCENDING),
+                                                    ("next_attempt_at", pymongo.ASCENDING)])
+        for collection in (self.collection_name, "binds", "scale_jobs"):
+            self.db[collection].ensure_index([("state", pymongo.ASCENDING)] + PRIORITY_SORT)
+        self.db.units.ensure_index("state")
+
+    def _backfill_shards(self):
+        fields = ((self.collection_name, "name"), ("units", "instance_name"),
+                  ("binds", "instance_name"), ("scale_jobs", "instance"))
+        for collection, field in fields:
+            for name in self.db[collection].find({"shard": None}).distinct(field):
+                self.db[collection].update({field: name, "shard": None},
+                                           {"$set": {"shard": shard_of(name)}}, multi=True)
+
+    def _ensure_ttl_index(self, collection, field, ttl):
+        index = self.db[collection].index_information().get(field + "_1")
+        if index is not None and index.get("expireAfterSeconds") != ttl:
+            self.db.command("collMod", collection,
+                            index={"keyPattern": {field: 1}, "expireAfterSeconds": ttl})
+        else:
+            self.db[collection].ensure_index(field, expireAfterSeconds=ttl)
+
     def store_scale_job(self, job):
         if "state" not in job:
             job["state"] = "pending"
-        self.db.scale_jobs.insert(job)
-
-    def get_scale_job(self):
-        job = self.db.scale_jobs.find_one({"state": "pending"})
-        if not job:
+        job.setdefault("shard", shard_of(job["instance"]))
+        if job["state"] != "pending":
+            self.db.scale_jobs.insert(job)
             return
-        job["state"] = "processing"
-        self.db.scale_jobs.update({"_id": job["_id"]},
-                                  {"$set": {"state": job["state"]}})
-        return job
+        changes = dict([(k, v) for k, v in job.items()
+                        if k not in ("_id", "instance", "state")])
+        job.update(self.db.scale_jobs.find_and_modify({"instance": job["instance"],
+                                                       "state": "pending"},
+                                                      {"$set": changes},
+                                                      upsert=True, new=True))
+
+    def get_scale_job(self, lease_expires_at=None, sort=None, **query):
+        query["state"] = "pending"
+        changes = {"state": "processing"}
+        if lease_expires_at:
+            changes["lease_expires_at"] = lease_expires_at
+        return self.db.scale_jobs.find_and_modify(query, {"$set": changes}, sort=sort,
+                                                  new=True)
+
+    def start_scale_job(self, job, lease_expires_at=None):
+        if "_id" not in job:
+            raise ValueError("job is not persisted")
+        changes = {"state": "processing"}
+        if lease_expires_at:
+            changes["lease_expires_at"] = lease_expires_at
+        claimed = self.db.scale_jobs.find_and_modify({"_id": job["_id"], "state": "pending"},
+                                                     {"$set": changes}, new=True)
+        if claimed is None:
+            raise ValueError("job is not pending")
+        job.update(claimed)
+
+    def retrieve_scale_jobs(self, **query):
+        return list(self.db.scale_jobs.find(query))
 
     def reset_scale_job(self, job):
         if "_id" not in job:
             raise ValueError("job is not persisted")
+        newer_job = self.db.scale_jobs.find_one({"instance": job["instance"],
+                                                 "state": "pending"})
+        if newer_job:
+            return self.finish_scale_job(job)
         job["state"] = "pending"
+        job.pop("lease_expires_at", None)
         self.db.scale_jobs.update({"_id": job["_id"]},
-                                  {"$set": {"state": job["state"]}})
+                                  {"$set": {"state": job["state"]},
+                                   "$unset": {"lease_expires_at": 1}})
 
     def finish_scale_job(self, job):
         if "_id" not in job:
             raise ValueError("job is not persisted")
         job["state"] = "done"
+        job["finished_at"] = datetime.datetime.utcnow()
         self.db.scale_jobs.update({"_id": job["_id"]},
-                                  {"$set": {"state": job["state"]}})
+                                  {"$set": {"state": job["state"],
+                                            "finished_at": job["finished_at"]}})
+
+    def renew_scale_job(self, job, lease_expires_at):
+        if "_id" not in job:
+            raise ValueError("job is not persisted")
+        r = self.db.scale_jobs.update({"_id": job["_id"], "state": "processing"},
+                                      {"$set": {"lease_expires_at": lease_expires_at}})
+        if r["n"] > 0:
+            job["lease_expires_at"] = lease_expires_at
+        return r["n"] > 0
+
+    def release_expired_leases(self, now=None):
+        now = now or datetime.datetime.utcnow()
+        released = {"starting": 0}
+        expired = {"state": "starting", "lease_expires_at": {"$lt": now}}
+        names = [i["name"] for i in self.db[self.collection_name].find(expired, fields=["name"])]
+        if names:
+            started = self.db.units.find({"instance_name": {"$in": names}}).distinct(
+                "instance_name")
+            if started:
+                r = self.db[self.collection_name].update(
+                    dict(expired, name={"$in": started}),
+                    {"$set": {"state": "started"}, "$unset": {"lease_expires_at": 1}},
+                    multi=True)
+                released["starting"] = r["n"]
+        for state, retry_state in LEASED_STATES.items():
+            r = self.db[self.collection_name].update(
+                {"state": state, "lease_expires_at": {"$lt": now}},
+                {"$set": {"state": retry_state}, "$unset": {"lease_expires_at": 1}},
+                multi=True)
+            released[state] = released.get(state, 0) + r["n"]
+        expired_jobs = self.db.scale_jobs.find({"state": "processing",
+                                                "lease_expires_at": {"$lt": now}})
+        released["processing"] = 0
+        for job in expired_jobs:
+            self.reset_scale_job(job)
+            released["processing"] += 1
+        return released
 
     def store_bind(self, bind):
-        self.db.binds.insert(bind.to_dict())
+        self.db.binds.insert(_bind_item(bind))
+
+    def store_binds(self, binds):
+        if binds:
+            self.db.binds.insert([_bind_item(bind) for bind in binds])
 
-    def retrieve_binds(self, limit=None, **query):
+    def retrieve_binds(self, limit=None, sort=None, **query):
         binds = []
-        cursor = self.db.binds.find(query)
+        cursor = self.db.binds.find(query, sort=sort)
         if limit:
             cursor = cursor.limit(limit)
         for item in cursor:
@@ -155,7 +478,9 @@ class MongoDBStorage(object):
             binds.append(Bind(app_host=item["app_host"],
                               instance=instance,
                               created_at=item["created_at"],
-                              state=item["state"]))
+                              state=item["state"],
+                              priority=item.get("priority"),
+                              trace_id=item.get("trace_id")))
         return binds
 
     def remove_bind(self, bind):
@@ -170,11 +495,110 @@ class MongoDBStorage(object):
     def update_bind(self, bind, **changes):
         self.db.binds.update(bind.to_dict(), {"$set": changes}, multi=True)
 
+    def update_binds(self, query, **changes):
+        self.db.binds.update(query, {"$set": changes}, multi=True)
+
+    def store_pool_unit(self, unit, expires_at=None):
+        item = {"id": unit.id, "dns_name": unit.dns_name,
+                "secret": unit.secret, "state": unit.state,
+                "created_at": datetime.datetime.utcnow()}
+        if expires_at:
+            item["expires_at"] = expires_at
+        self.db.unit_pool.insert(item)
+
+    def retrieve_pool_units(self, limit=None, **query):
+        cursor = self.db.unit_pool.find(query)
+        if limit:
+            cursor = cursor.limit(limit)
+        return [self._pool_unit(item) for item in cursor]
+
+    def update_pool_units(self, units, **changes):
+        ids = [u.id for u in units]
+        self.db.unit_pool.update({"id": {"$in": ids}}, {"$set": changes},
+                                 multi=True)
+
+    def claim_pool_unit(self, **query):
+        query.setdefault("state", "ready")
+        item = self.db.unit_pool.find_and_modify(query, remove=True,
+                                                 sort=[("created_at", 1)])
+        if item:
+            return self._pool_unit(item)
+
+    def expire_pool_unit(self, **query):
+        query.setdefault("state", "ready")
+        item = self.db.unit_pool.find_and_modify(query, {"$set": {"state": "expiring"}},
+                                                 sort=[("created_at", 1)], new=True)
+        if item:
+            return self._pool_unit(item)
+
+    def remove_pool_units(self, units):
+        self.db.unit_pool.remove({"id": {"$in": [u.id for u in units]}})
+
+    def count_pool_units(self, **query):
+        return self.db.unit_pool.find(query).count()
+
+    def _pool_unit(self, item):
+        return Unit(id=item["id"], dns_name=item["dns_name"],
+                    secret=item["secret"], state=item["state"])
+
+    def store_replica(self, group, replica_id):
+        self.db.runner_replicas.update({"_id": replica_id},
+                                       {"_id": replica_id, "group": group,
+                                        "heartbeat_at": datetime.datetime.utcnow()},
+                                       upsert=True)
+
+    def retrieve_replicas(self, group, alive_since):
+        cursor = self.db.runner_replicas.find({"group": group,
+                                               "heartbeat_at": {"$gte": alive_since}})
+        return sorted([item["_id"] for item in cursor])
+
+    def remove_replica(self, replica_id):
+        self.db.runner_replicas.remove({"_id": replica_id})
+
+    def scan(self, kind, after=None, limit=None, batch_size=1000, **query):
+        if kind not in SCAN_KINDS:
+            raise ValueError("unknown kind: {}".format(kind))
+        if after is not None:
+            try:
+                query["_id"] = {"$gt": bson.ObjectId(after)}
+            except (bson.errors.InvalidId, TypeError):
+                raise ValueError("invalid cursor: {}".format(after))
+        collection = self.collection_name if kind == "instances" else kind
+        cursor = self.db[collection].find(query, sort=FIFO_SORT, limit=limit or 0)
+        return self._scan(cursor.batch_size(batch_size))
+
+    def _scan(self, cursor):
+        for item in cursor:
+            cursor_id = str(item.pop("_id"))
+            item.pop("shard", None)
+            yield cursor_id, item
+
+    def new_locker(self):
+        return MultiLocker(self)
+
+    def new_notifier(self):
+        key = (self.mongo_uri, self.dbname)
+        with _notifiers_lock:
+            if key not in _notifiers:
+                _notifiers[key] = MongoDBNotifier(self)
+            return _notifiers[key]
+
+    def queue_depths(self):
+        result = self.db[self.collection_name].aggregate([
+            {"$group": {"_id": "$state", "count": {"$sum": 1}}},
+        ])
+        instances = dict([(item["_id"], item["count"]) for item in result["result"]])
+        return {"instances": instances,
+                "scale_jobs": self.db.scale_jobs.find({"state": "pending"}).count(),
+                "binds": self.db.binds.find({"state": "creating"}).count(),
+                "units": self.db.units.find({"state": "creating"}).count()}
+
 
 class MultiLocker(object):
 
     def __init__(self, storage):
         self.db = storage.db
+        self.held = set()
 
     def init(self, lock_name):
         try:
@@ -191,9 +615,617 @@ class MultiLocker(object):
             r = self.db.multi_locker.update({"_id": lock_name, "state": 0},
                                             {"_id": lock_name, "state": 1})
             n = r["n"]
+        self.held.add(lock_name)
 
     def unlock(self, lock_name):
+        self.held.discard(lock_name)
         r = self.db.multi_locker.update({"_id": lock_name, "state": 1},
                                         {"_id": lock_name, "state": 0})
         if r["n"] < 1:
             raise DoubleUnlockError(lock_name)
+
+    def release_all(self):
+        for lock_name in list(self.held):
+            try:
+                self.unlock(lock_name)
+            except DoubleUnlockError:
+                pass
+
+
+class MongoDBNotifier(object):
+    """
+    MongoDBNotifier publishes the names of changed instances in a capped
+    collection, and delivers the names published by every process to the
+    subscribed callback, using a tailable cursor. Whenever tailing restarts,
+    the callback gets ``"*"``, as some names may have been missed.
+    """
+
+    def __init__(self, storage, size=1024 * 1024, interval=1):
+        self.db = storage.db
+        self.interval = interval
+        try:
+            self.db.create_collection("instance_changes", capped=True, size=size)
+            self.db.instance_changes.insert({"name": None})
+        except pymongo.errors.CollectionInvalid:
+            pass
+        self.collection = self.db.instance_changes
+
+    def publish(self, name):
+        self.collection.insert({"name": name,
+                                "published_at": datetime.datetime.utcnow()})
+
+    def subscribe(self, callback):
+        t = threading.Thread(target=self._tail, args=(callback,), name="MongoDBNotifier")
+        t.daemon = True
+        t.start()
+        return t
+
+    def _last_id(self):
+        for item in self.collection.find().sort("$natural", -1).limit(1):
+            return item["_id"]
+
+    def _tail(self, callback):
+        last_id = None
+        while True:
+            try:
+                if last_id is None:
+                    last_id = self._last_id()
+                query = {"_id": {"$gt": last_id}} if last_id else {}
+                cursor = self.collection.find(query, tailable=True, await_data=True)
+                while cursor.alive:
+                    for item in cursor:
+                        last_id = item["_id"]
+                        if item["name"] is not None:
+                            callback(item["name"])
+            except Exception as e:
+                sys.stderr.write("[ERROR] failed to read instance changes: {}\n".format(
+                    " ".join([str(arg) for arg in e.args])))
+            callback("*")
+            time.sleep(self.interval)
+
+
+def _compare(op):
+    def compare(exists, value, arg):
+        return value is not None and op(value, arg)
+    return compare
+
+
+_OPERATORS = {
+    "$in": lambda exists, value, arg: value in arg,
+    "$nin": lambda exists, value, arg: value not in arg,
+    "$ne": lambda exists, value, arg: value != arg,
+    "$exists": lambda exists, value, arg: exists == bool(arg),
+    "$lt": _compare(lambda a, b: a < b),
+    "$lte": _compare(lambda a, b: a <= b),
+    "$gt": _compare(lambda a, b: a > b),
+    "$gte": _compare(lambda a, b: a >= b),
+}
+
+
+def _is_operator(cond):
+    return isinstance(cond, dict) and bool(cond) and all(k.startswith("$") for k in cond)
+
+
+def _matches(doc, query):
+    for key, cond in query.items():
+        if key == "$or":
+            if not any(_matches(doc, q) for q in cond):
+                return False
+        elif _is_operator(cond):
+            for op, arg in cond.items():
+                if not _OPERATORS[op](key in doc, doc.get(key), arg):
+                    return False
+        elif doc.get(key) != cond:
+            return False
+    return True
+
+
+class _Collection(object):
+    """
+    _Collection keeps documents in a dict keyed by ``_id``, along with a
+    secondary index (value -> set of ids) for each of the given fields.
+    Queries with an equality or ``$in`` on an indexed field only look at the
+    documents in the index. Only matching documents are ordered, and queries
+    with a ``limit`` keep just the first ``limit`` of them, instead of
+    sorting all the candidates.
+    """
+
+    def __init__(self, ids, indexes=()):
+        self.ids = ids
+        self.docs = {}
+        self.indexes = dict([(field, {}) for field in indexes])
+
+    def _index(self, doc):
+        for field, index in self.indexes.items():
+            index.setdefault(doc.get(field), set()).add(doc["_id"])
+
+    def _unindex(self, doc):
+        for field, index in self.indexes.items():
+            ids = index.get(doc.get(field))
+            if ids is not None:
+                ids.discard(doc["_id"])
+                if not ids:
+                    del index[doc.get(field)]
+
+    def insert(self, doc):
+        if "_id" not in doc:
+            doc["_id"] = next(self.ids)
+        item = copy.deepcopy(doc)
+        self.docs[item["_id"]] = item
+        self._index(item)
+        return item
+
+    def _candidates(self, query):
+        best = None
+        for field, index in self.indexes.items():
+            if field not in query:
+                continue
+            cond = query[field]
+            if isinstance(cond, (dict, list)) and not _is_operator(cond):
+                continue
+            if not _is_operator(cond):
+                ids = index.get(cond, set())
+            elif "$in" in cond:
+                ids = set()
+                for value in cond["$in"]:
+                    ids.update(index.get(value, ()))
+            else:
+                continue
+            if best is None or len(ids) < len(best):
+                best = ids
+        if best is None:
+            return self.docs.keys()
+        return best
+
+    def find(self, query=None, sort=None, limit=None):
+        query = query or {}
+        docs = [self.docs[i] for i in self._candidates(query) if _matches(self.docs[i], query)]
+        key = _sort_key(sort)
+        if limit:
+            return heapq.nsmallest(limit, docs, key=key)
+        return sorted(docs, key=key)
+
+    def find_one(self, query=None, sort=None):
+        docs = self.find(query, sort, limit=1)
+        if docs:
+            return docs[0]
+
+    def update(self, doc, changes=None, unset=()):
+        self._unindex(doc)
+        doc.update(copy.deepcopy(changes or {}))
+        for field in unset:
+            doc.pop(field, None)
+        self._index(doc)
+
+    def replace(self, doc, new):
+        self._unindex(doc)
+        _id = doc["_id"]
+        doc.clear()
+        doc.update(copy.deepcopy(new))
+        doc["_id"] = _id
+        self._index(doc)
+
+    def remove(self, query):
+        docs = self.find(query)
+        for doc in docs:
+            self._unindex(doc)
+            del self.docs[doc["_id"]]
+        return len(docs)
+
+
+def _sort_key(sort):
+    if not sort:
+        return operator.itemgetter("_id")
+
+    def compare(a, b):
+        for field, direction in sort:
+            x, y = a.get(field), b.get(field)
+            if x is None and y is None:
+                continue
+            if x is None or y is None:
+                result = -1 if x is None else 1
+            else:
+                result = cmp(x, y)
+            if result:
+                return result if direction > 0 else -result
+        return cmp(a["_id"], b["_id"])
+    return functools.cmp_to_key(compare)
+
+
+def _public(doc):
+    item = copy.deepcopy(doc)
+    item.pop("_id", None)
+    return item
+
+
+class MemoryStorage(BaseStorage):
+    """
+    MemoryStorage keeps everything in memory, with the same contract as
+    :class:`MongoDBStorage`. It's thread-safe, but it's not shared among
+    processes, so the API and the runners must run in the same process (see
+    :class:`feaas.runners.supervisor.Supervisor`). Meant for tests, local
+    experiments and benchmarks.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        ids = itertools.count(1)
+        self.instances = _Collection(ids, ["name", "state"])
+        self.units = _Collection(ids, ["id", "instance_name", "state"])
+        self.binds = _Collection(ids, ["instance_name", "state"])
+        self.scale_jobs = _Collection(ids, ["instance", "state"])
+        self.unit_pool = _Collection(ids, ["id", "state"])
+        self.replicas = _Collection(ids, ["group"])
+        self.locks = {}
+        self.locks_cond = threading.Condition(self.lock)
+
+    def store_instance(self, instance, save_units=True):
+        shard = shard_of(instance.name)
+        item = dict(instance.to_dict(), shard=shard)
+        with self.lock:
+            doc = self.instances.find_one({"name": instance.name})
+            if doc is None:
+                self.instances.insert(item)
+            else:
+                self.instances.replace(doc, item)
+            if save_units:
+                self.units.remove({"instance_name": instance.name})
+                for unit in instance.units:
+                    self.units.insert(dict(unit.to_dict(), shard=shard))
+
+    def retrieve_instance(self, check_liveness=False, sort=None, **query):
+        if check_liveness:
+            query["state"] = {"$nin": ["removed", "terminating"]}
+        with self.lock:
+            doc = self.instances.find_one(query, sort=sort)
+            if doc is None:
+                raise InstanceNotFoundError()
+            item = _public(doc)
+            item.pop("shard", None)
+            item["units"] = self.retrieve_units(instance_name=item["name"])
+        return Instance(**item)
+
+    def retrieve_instances(self, **query):
+        with self.lock:
+            instances = []
+            for doc in self.instances.find(query):
+                item = _public(doc)
+                item.pop("shard", None)
+                instances.append(Instance(**item))
+            if instances:
+                names = dict([(i.name, i) for i in instances])
+                for unit in self.retrieve_units(instance_name={"$in": names.keys()}):
+                    names[unit.instance.name].add_unit(unit)
+        return instances
+
+    def retrieve_units(self, limit=None, **query):
+        units = []
+        with self.lock:
+            docs = self.units.find(query, limit=limit)
+            for doc in docs:
+                item = _public(doc)
+                item["instance"] = Instance(name=item.pop("instance_name"))
+                item.pop("shard", None)
+                units.append(Unit(**item))
+        return units
+
+    def transition_instance(self, name, from_state, **changes):
+        with self.lock:
+            doc = self.instances.find_one({"name": name, "state": from_state})
+            if doc is None:
+                return False
+            self.instances.update(doc, changes)
+            return True
+
+    def remove_instance(self, name):
+        with self.lock:
+            self.binds.remove({"instance_name": name})
+            self.units.remove({"instance_name": name})
+            self.instances.remove({"name": name})
+
+    def store_scale_job(self, job):
+        if "state" not in job:
+            job["state"] = "pending"
+        job.setdefault("shard", shard_of(job["instance"]))
+        with self.lock:
+            if job["state"] != "pending":
+                self.scale_jobs.insert(job)
+                return
+            doc = self.scale_jobs.find_one({"instance": job["instance"], "state": "pending"})
+            changes = dict([(k, v) for k, v in job.items()
+                            if k not in ("_id", "instance", "state")])
+            if doc is None:
+                doc = self.scale_jobs.insert(dict(changes, instance=job["instance"],
+                                                  state="pending"))
+            else:
+                self.scale_jobs.update(doc, changes)
+            job.update(copy.deepcopy(doc))
+
+    def get_scale_job(self, lease_expires_at=None, sort=None, **query):
+        query["state"] = "pending"
+        with self.lock:
+            doc = self.scale_jobs.find_one(query, sort=sort)
+            if doc is None:
+                return
+            job = copy.deepcopy(doc)
+            self.start_scale_job(job, lease_expires_at)
+        return job
+
+    def _job(self, job):
+        if "_id" not in job:
+            raise ValueError("job is not persisted")
+        return self.scale_jobs.docs.get(job["_id"])
+
+    def start_scale_job(self, job, lease_expires_at=None):
+        with self.lock:
+            doc = self._job(job)
+            if doc is None or doc["state"] != "pending":
+                raise ValueError("job is not pending")
+            changes = {"state": "processing"}
+            if lease_expires_at:
+                changes["lease_expires_at"] = lease_expires_at
+            self.scale_jobs.update(doc, changes)
+            job.update(copy.deepcopy(doc))
+
+    def retrieve_scale_jobs(self, **query):
+        with self.lock:
+            return [copy.deepcopy(doc) for doc in self.scale_jobs.find(query)]
+
+    def reset_scale_job(self, job):
+        with self.lock:
+            doc = self._job(job)
+            newer_job = self.scale_jobs.find_one({"instance": job["instance"],
+                                                  "state": "pending"})
+            if newer_job:
+                return self.finish_scale_job(job)
+            job["state"] = "pending"
+            job.pop("lease_expires_at", None)
+            if doc is not None:
+                self.scale_jobs.update(doc, {"state": job["state"]},
+                                       unset=["lease_expires_at"])
+
+    def finish_scale_job(self, job):
+        with self.lock:
+            doc = self._job(job)
+            job["state"] = "done"
+            job["finished_at"] = datetime.datetime.utcnow()
+            if doc is not None:
+                self.scale_jobs.update(doc, {"state": job["state"],
+                                             "finished_at": job["finished_at"]})
+
+    def renew_scale_job(self, job, lease_expires_at):
+        with self.lock:
+            doc = self._job(job)
+            if doc is None or doc["state"] != "processing":
+                return False
+            self.scale_jobs.update(doc, {"lease_expires_at": lease_expires_at})
+            job["lease_expires_at"] = lease_expires_at
+            return True
+
+    def release_expired_leases(self, now=None):
+        now = now or datetime.datetime.utcnow()
+        released = {}
+        with self.lock:
+            for state, retry_state in LEASED_STATES.items():
+                docs = self.instances.find({"state": state, "lease_expires_at": {"$lt": now}})
+                for doc in docs:
+                    new_state = retry_state
+                    if state == "starting" and self.units.find_one({"instance_name":
+                                                                    doc["name"]}):
+                        new_state = "started"
+                    self.instances.update(doc, {"state": new_state},
+                                          unset=["lease_expires_at"])
+                released[state] = len(docs)
+            expired_jobs = self.scale_jobs.find({"state": "processing",
+                                                 "lease_expires_at": {"$lt": now}})
+            for doc in expired_jobs:
+                self.reset_scale_job(copy.deepcopy(doc))
+            released["processing"] = len(expired_jobs)
+        return released
+
+    def store_bind(self, bind):
+        item = _bind_item(bind)
+        with self.lock:
+            self.binds.insert(item)
+
+    def store_binds(self, binds):
+        items = [_bind_item(bind) for bind in binds]
+        with self.lock:
+            for item in items:
+                self.binds.insert(item)
+
+    def retrieve_binds(self, limit=None, sort=None, **query):
+        with self.lock:
+            docs = self.binds.find(query, sort=sort, limit=limit)
+            return [Bind(app_host=doc["app_host"],
+                         instance=Instance(name=doc["instance_name"]),
+                         created_at=doc["created_at"],
+                         state=doc["state"],
+                         priority=doc.get("priority"),
+                         trace_id=doc.get("trace_id")) for doc in docs]
+
+    def remove_bind(self, bind):
+        with self.lock:
+            self.binds.remove({"app_host": bind.app_host,
+                               "instance_name": bind.instance.name})
+
+    def update_units(self, units, **changes):
+        with self.lock:
+            for doc in self.units.find({"id": {"$in": [u.id for u in units]}}):
+                self.units.update(doc, changes)
+
+    def update_bind(self, bind, **changes):
+        with self.lock:
+            for doc in self.binds.find(bind.to_dict()):
+                self.binds.update(doc, changes)
+
+    def update_binds(self, query, **changes):
+        with self.lock:
+            for doc in self.binds.find(query):
+                self.binds.update(doc, changes)
+
+    def store_pool_unit(self, unit, expires_at=None):
+        item = {"id": unit.id, "dns_name": unit.dns_name,
+                "secret": unit.secret, "state": unit.state,
+                "created_at": datetime.datetime.utcnow()}
+        if expires_at:
+            item["expires_at"] = expires_at
+        with self.lock:
+            self.unit_pool.insert(item)
+
+    def retrieve_pool_units(self, limit=None, **query):
+        with self.lock:
+            return [self._pool_unit(doc) for doc in self.unit_pool.find(query, limit=limit)]
+
+    def update_pool_units(self, units, **changes):
+        with self.lock:
+            for doc in self.unit_pool.find({"id": {"$in": [u.id for u in units]}}):
+                self.unit_pool.update(doc, changes)
+
+    def claim_pool_unit(self, **query):
+        query.setdefault("state", "ready")
+        with self.lock:
+            doc = self.unit_pool.find_one(query, sort=[("created_at", 1)])
+            if doc is not None:
+                self.unit_pool.remove({"_id": doc["_id"]})
+                return self._pool_unit(doc)
+
+    def expire_pool_unit(self, **query):
+        query.setdefault("state", "ready")
+        with self.lock:
+            doc = self.unit_pool.find_one(query, sort=[("created_at", 1)])
+            if doc is not None:
+                self.unit_pool.update(doc, {"state": "expiring"})
+                return self._pool_unit(doc)
+
+    def remove_pool_units(self, units):
+        with self.lock:
+            self.unit_pool.remove({"id": {"$in": [u.id for u in units]}})
+
+    def count_pool_units(self, **query):
+        with self.lock:
+            return len(self.unit_pool.find(query))
+
+    def _pool_unit(self, item):
+        return Unit(id=item["id"], dns_name=item["dns_name"],
+                    secret=item["secret"], state=item["state"])
+
+    def store_replica(self, group, replica_id):
+        item = {"_id": replica_id, "group": group,
+                "heartbeat_at": datetime.datetime.utcnow()}
+        with self.lock:
+            doc = self.replicas.docs.get(replica_id)
+            if doc is None:
+                self.replicas.insert(item)
+            else:
+                self.replicas.replace(doc, item)
+
+    def retrieve_replicas(self, group, alive_since):
+        with self.lock:
+            docs = self.replicas.find({"group": group, "heartbeat_at": {"$gte": alive_since}})
+            return sorted([doc["_id"] for doc in docs])
+
+    def remove_replica(self, replica_id):
+        with self.lock:
+            self.replicas.remove({"_id": replica_id})
+
+    def scan(self, kind, after=None, limit=None, batch_size=1000, **query):
+        if kind not in SCAN_KINDS:
+            raise ValueError("unknown kind: {}".format(kind))
+        if after is not None:
+            try:
+                query["_id"] = {"$gt": int(after)}
+            except ValueError:
+                raise ValueError("invalid cursor: {}".format(after))
+        collection = getattr(self, kind)
+        with self.lock:
+            ids = [doc["_id"] for doc in collection.find(query, limit=limit)]
+        return self._scan(collection, ids, batch_size)
+
+    def _scan(self, collection, ids, batch_size):
+        for start in xrange(0, len(ids), batch_size):
+            with self.lock:
+                docs = [collection.docs.get(i) for i in ids[start:start + batch_size]]
+                docs = [(str(doc["_id"]), _public(doc)) for doc in docs if doc is not None]
+            for cursor_id, doc in docs:
+                doc.pop("shard", None)
+                yield cursor_id, doc
+
+    def new_locker(self):
+        return MemoryLocker(self)
+
+    def queue_depths(self):
+        with self.lock:
+            instances = dict([(state, len(ids))
+                              for state, ids in self.instances.indexes["state"].items()])
+            return {"instances": instances,
+                    "scale_jobs": len(self.scale_jobs.indexes["state"].get("pending", ())),
+                    "binds": len(self.binds.indexes["state"].get("creating", ())),
+                    "units": len(self.units.indexes["state"].get("creating", ()))}
+
+
+class MemoryLocker(object):
+    """
+    MemoryLocker is the counterpart of :class:`MultiLocker` for
+    :class:`MemoryStorage`: locks are kept in the storage, so all lockers
+    sharing a storage see the same locks.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.cond = storage.locks_cond
+        self.held = set()
+
+    def init(self, lock_name):
+        with self.cond:
+            self.storage.locks.setdefault(lock_name, 0)
+
+    def destroy(self, lock_name):
+        with self.cond:
+            self.storage.locks.pop(lock_name, None)
+            self.cond.notify_all()
+
+    def lock(self, lock_name):
+        with self.cond:
+            while self.storage.locks.get(lock_name) != 0:
+                self.cond.wait()
+            self.storage.locks[lock_name] = 1
+        self.held.add(lock_name)
+
+    def unlock(self, lock_name):
+        self.held.discard(lock_name)
+        with self.cond:
+            if self.storage.locks.get(lock_name) != 1:
+                raise DoubleUnlockError(lock_name)
+            self.storage.locks[lock_name] = 0
+            self.cond.notify_all()
+
+    def release_all(self):
+        for lock_name in list(self.held):
+            try:
+                self.unlock(lock_name)
+            except DoubleUnlockError:
+                pass
+
+
+def new_locker(storage):
+    if isinstance(storage, BaseStorage):
+        return storage.new_locker()
+    return MultiLocker(storage)
+
+
+_memory_storage = None
+_memory_storage_lock = threading.Lock()
+
+
+def memory_storage():
+    global _memory_storage
+    with _memory_storage_lock:
+        if _memory_storage is None:
+            _memory_storage = MemoryStorage()
+        return _memory_storage
+
+
+for cls in (MongoDBStorage, MemoryStorage):
+    metrics.instrument_methods(cls, metrics.storage_seconds, metrics.storage_errors)
+    tracing.trace_methods(cls, "storage")
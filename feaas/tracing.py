@@ -0,0 +1,164 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+
+_local = threading.local()
+_exporter = None
+
+
+def _new_id():
+    return uuid.uuid4().hex[:16]
+
+
+class JSONLinesExporter(object):
+    """
+    JSONLinesExporter appends each finished span as a JSON document to a file,
+    one span per line.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span, sort_keys=True) + "\n"
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(line)
+
+
+def configure():
+    global _exporter
+    _exporter = None
+    if os.environ.get("API_TRACING", "0") in ("True", "true", "1"):
+        _exporter = JSONLinesExporter(os.environ.get("API_TRACE_FILE", "traces.jsonl"))
+
+
+def set_exporter(exporter):
+    global _exporter
+    _exporter = exporter
+
+
+def enabled():
+    return _exporter is not None
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def current_span():
+    stack = _stack()
+    if stack:
+        return stack[-1]
+
+
+def current_trace_id():
+    span = current_span()
+    if span is not None:
+        return span.trace_id
+
+
+class Span(object):
+
+    def __init__(self, name, trace_id=None, **attributes):
+        parent = current_span()
+        if trace_id is None and parent is not None:
+            trace_id = parent.trace_id
+        self.name = name
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.span_id = _new_id()
+        self.parent_id = None
+        if parent is not None and parent.trace_id == self.trace_id:
+            self.parent_id = parent.span_id
+        self.attributes = attributes
+        self.error = None
+        self.started_at = None
+
+    def start(self):
+        self.started_at = time.time()
+        _stack().append(self)
+        return self
+
+    def finish(self, error=None):
+        duration = time.time() - self.started_at
+        stack = _stack()
+        if self in stack:
+            stack.remove(self)
+        if error is not None:
+            self.error = " ".join([unicode(arg) for arg in error.args]) or type(error).__name__
+        exporter = _exporter
+        if exporter is not None:
+            exporter.export(self.to_dict(duration))
+
+    def to_dict(self, duration):
+        started_at = datetime.datetime.utcfromtimestamp(self.started_at)
+        return {"name": self.name, "trace_id": self.trace_id, "span_id": self.span_id,
+                "parent_id": self.parent_id, "started_at": started_at.isoformat(),
+                "duration": duration, "attributes": self.attributes, "error": self.error}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish(exc_value)
+
+
+class NoopSpan(object):
+    trace_id = None
+    span_id = None
+
+    def start(self):
+        return self
+
+    def finish(self, error=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_noop = NoopSpan()
+
+
+def span(name, trace_id=None, **attributes):
+    if _exporter is None:
+        return _noop
+    return Span(name, trace_id, **attributes)
+
+
+def trace(fn, name):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if _exporter is None:
+            return fn(*args, **kwargs)
+        with Span(name):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def trace_methods(cls, prefix, names=None):
+    if names is None:
+        names = [name for name, value in cls.__dict__.items()
+                 if not name.startswith("_") and callable(value)]
+    for name in names:
+        fn = cls.__dict__.get(name)
+        if fn is None:
+            continue
+        setattr(cls, name, trace(fn, "{}.{}".format(prefix, name)))
+
+
+configure()
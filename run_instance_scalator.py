@@ -4,7 +4,7 @@
 
 import argparse
 
-from feaas import api
+from feaas import api, metrics
 from feaas.runners import instance_scalator
 
 
@@ -13,8 +13,21 @@ def run(manager):
     parser.add_argument("-i", "--interval",
                         help="Interval for running InstanceTerminator (in seconds)",
                         default=10, type=int)
+    parser.add_argument("-c", "--concurrency",
+                        help="Maximum number of instances to scale at a time",
+                        default=1, type=int)
+    parser.add_argument("-s", "--sharded",
+                        help="Split scale jobs among all sharded scalators",
+                        action="store_true")
+    parser.add_argument("-m", "--metrics-port",
+                        help="Port for serving metrics on /metrics (disabled by default)",
+                        type=int)
     args = parser.parse_args()
-    scalator = instance_scalator.InstanceScalator(manager, args.interval)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    scalator = instance_scalator.InstanceScalator(manager, args.interval,
+                                                  args.concurrency, args.sharded)
+    scalator.handle_signals()
     scalator.loop()
 
 if __name__ == "__main__":
@@ -4,7 +4,7 @@
 
 import argparse
 
-from feaas import api
+from feaas import api, metrics
 from feaas.runners import instance_starter
 
 
@@ -13,8 +13,14 @@ def run(manager):
     parser.add_argument("-i", "--interval",
                         help="Interval for running InstanceStarter (in seconds)",
                         default=10, type=int)
+    parser.add_argument("-m", "--metrics-port",
+                        help="Port for serving metrics on /metrics (disabled by default)",
+                        type=int)
     args = parser.parse_args()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
     starter = instance_starter.InstanceStarter(manager, args.interval)
+    starter.handle_signals()
     starter.loop()
 
 if __name__ == "__main__":
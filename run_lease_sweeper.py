@@ -0,0 +1,28 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import argparse
+
+from feaas import api, metrics
+from feaas.runners import lease_sweeper
+
+
+def run(manager):
+    parser = argparse.ArgumentParser("Lease sweeper runner")
+    parser.add_argument("-i", "--interval",
+                        help="Interval for running LeaseSweeper (in seconds)",
+                        default=10, type=int)
+    parser.add_argument("-m", "--metrics-port",
+                        help="Port for serving metrics on /metrics (disabled by default)",
+                        type=int)
+    args = parser.parse_args()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    sweeper = lease_sweeper.LeaseSweeper(manager, args.interval)
+    sweeper.handle_signals()
+    sweeper.loop()
+
+if __name__ == "__main__":
+    manager = api.get_manager()
+    run(manager)
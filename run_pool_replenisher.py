@@ -0,0 +1,31 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import argparse
+
+from feaas import api, managers, metrics
+from feaas.runners import pool_replenisher
+
+
+def run(manager):
+    parser = argparse.ArgumentParser("Pool replenisher runner")
+    parser.add_argument("-i", "--interval",
+                        help="Interval for running PoolReplenisher (in seconds)",
+                        default=10, type=int)
+    parser.add_argument("-s", "--size",
+                        help="Number of idle units to keep in the pool",
+                        default=managers.pool_size(), type=int)
+    parser.add_argument("-m", "--metrics-port",
+                        help="Port for serving metrics on /metrics (disabled by default)",
+                        type=int)
+    args = parser.parse_args()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    replenisher = pool_replenisher.PoolReplenisher(manager, args.interval, args.size)
+    replenisher.handle_signals()
+    replenisher.loop()
+
+if __name__ == "__main__":
+    manager = api.get_manager()
+    run(manager)
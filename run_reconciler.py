@@ -0,0 +1,31 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import argparse
+
+from feaas import api, metrics
+from feaas.runners import reconciler
+
+
+def run(manager):
+    parser = argparse.ArgumentParser("Reconciler runner")
+    parser.add_argument("-i", "--interval",
+                        help="Interval for running Reconciler (in seconds)",
+                        default=10, type=int)
+    parser.add_argument("-c", "--concurrency",
+                        help="Maximum number of instances to reconcile at a time",
+                        default=8, type=int)
+    parser.add_argument("-m", "--metrics-port",
+                        help="Port for serving metrics on /metrics (disabled by default)",
+                        type=int)
+    args = parser.parse_args()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    runner = reconciler.Reconciler(manager, args.interval, args.concurrency)
+    runner.handle_signals()
+    runner.loop()
+
+if __name__ == "__main__":
+    manager = api.get_manager()
+    run(manager)
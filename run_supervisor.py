@@ -0,0 +1,37 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import argparse
+
+from feaas import api, metrics
+from feaas.runners import supervisor
+
+
+def run(manager):
+    parser = argparse.ArgumentParser("Supervisor for running many runners in one process")
+    parser.add_argument("runners", nargs="*", metavar="runner",
+                        help="Runners to start, among: {} (default: {})".format(
+                            ", ".join(sorted(supervisor.RUNNERS.keys())),
+                            " ".join(supervisor.DEFAULT_RUNNERS)),
+                        default=supervisor.DEFAULT_RUNNERS)
+    parser.add_argument("-i", "--interval",
+                        help="Interval for running each runner (in seconds)",
+                        default=10, type=int)
+    parser.add_argument("-r", "--restart-delay",
+                        help="Time to wait before restarting a crashed runner (in seconds)",
+                        default=5, type=int)
+    parser.add_argument("-m", "--metrics-port",
+                        help="Port for serving metrics on /metrics (disabled by default)",
+                        type=int)
+    args = parser.parse_args()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    sup = supervisor.Supervisor(manager, args.runners, args.interval,
+                                args.restart_delay)
+    sup.handle_signals()
+    sup.loop()
+
+if __name__ == "__main__":
+    manager = api.get_manager()
+    run(manager)
@@ -4,7 +4,7 @@
 
 import argparse
 
-from feaas import api
+from feaas import api, metrics
 from feaas.runners import vcl_writer
 
 
@@ -16,8 +16,21 @@ def run(manager):
     parser.add_argument("-n", "--max-items",
                         help="Maximum number of units to process at a time",
                         type=int)
+    parser.add_argument("-s", "--sharded",
+                        help="Split units and binds among all sharded writers",
+                        action="store_true")
+    parser.add_argument("-c", "--concurrency",
+                        help="Number of units to remove VCL from at the same time",
+                        default=8, type=int)
+    parser.add_argument("-m", "--metrics-port",
+                        help="Port for serving metrics on /metrics (disabled by default)",
+                        type=int)
     args = parser.parse_args()
-    writer = vcl_writer.VCLWriter(manager, args.interval, args.max_items)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    writer = vcl_writer.VCLWriter(manager, args.interval, args.max_items,
+                                  args.sharded, args.concurrency)
+    writer.handle_signals()
     writer.loop()
 
 if __name__ == "__main__":
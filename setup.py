@@ -22,7 +22,7 @@ setup(
     classifiers=[
         "Programming Language :: Python :: 2.7",
     ],
-    packages=find_packages(exclude=["docs", "tests", "samples"]),
+    packages=find_packages(exclude=["docs", "tests", "samples", "benchmarks"]),
     include_package_data=True,
     install_requires=["Flask==0.9", "boto==2.25.0", "pymongo==2.6.3",
                       "python-varnish==0.2.1", "httplib2==0.9"],
@@ -2,7 +2,7 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-from feaas import storage
+from feaas import storage, tracing
 
 
 class FakeInstance(object):
@@ -12,6 +12,8 @@ class FakeInstance(object):
         self.state = state
         self.units = 1
         self.bound = []
+        self.priorities = []
+        self.trace_ids = []
 
     def bind(self, app_host):
         self.bound.append(app_host)
@@ -25,14 +27,27 @@ class FakeManager(object):
     def __init__(self, storage=None):
         self.instances = []
 
-    def new_instance(self, name, state="running"):
-        self.instances.append(FakeInstance(name, state))
+    def new_instance(self, name, state="running", priority=None):
+        instance = FakeInstance(name, state)
+        instance.priorities.append(priority)
+        self.instances.append(instance)
 
-    def bind(self, name, app_host):
+    def bind(self, name, app_host, priority=None):
         index, instance = self.find_instance(name)
         if index < 0:
             raise storage.InstanceNotFoundError()
         instance.bind(app_host)
+        instance.priorities.append(priority)
+        instance.trace_ids.append(tracing.current_trace_id())
+
+    def bind_many(self, name, app_hosts, priority=None):
+        index, instance = self.find_instance(name)
+        if index < 0:
+            raise storage.InstanceNotFoundError()
+        for app_host in app_hosts:
+            instance.bind(app_host)
+        instance.priorities.append(priority)
+        instance.trace_ids.append(tracing.current_trace_id())
 
     def unbind(self, name, app_host):
         index, instance = self.find_instance(name)
@@ -40,6 +55,14 @@ class FakeManager(object):
             raise storage.InstanceNotFoundError()
         instance.unbind(app_host)
 
+    def unbind_many(self, name, app_hosts):
+        index, instance = self.find_instance(name)
+        if index < 0:
+            raise storage.InstanceNotFoundError()
+        for app_host in app_hosts:
+            if app_host in instance.bound:
+                instance.unbind(app_host)
+
     def remove_instance(self, name):
         index, _ = self.find_instance(name)
         if index == -1:
@@ -58,12 +81,18 @@ class FakeManager(object):
             raise storage.InstanceNotFoundError()
         return instance.state
 
-    def scale_instance(self, name, quantity):
+    def describe_instances(self, names):
+        return [{"name": i.name, "state": i.state, "address": "{}.cloud.tsuru.io".format(i.name),
+                 "units": [{"id": "i-{}".format(n)} for n in xrange(i.units)]}
+                for i in self.instances if i.name in names]
+
+    def scale_instance(self, name, quantity, priority=None):
         if quantity < 1:
             raise ValueError("invalid quantity: %d" % quantity)
         index, instance = self.find_instance(name)
         if index < 0:
             raise storage.InstanceNotFoundError()
+        instance.priorities.append(priority)
         difference = quantity - instance.units
         instance.units += difference
         self.instances[index] = instance
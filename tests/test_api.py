@@ -3,12 +3,17 @@
 # license that can be found in the LICENSE file.
 
 import base64
+import datetime
 import inspect
 import json
 import os
+import threading
+import time
 import unittest
 
-from feaas import api, plugin, storage
+import mock
+
+from feaas import api, cache, metrics, plugin, storage, tracing
 from feaas.managers import ec2
 from . import managers
 
@@ -29,6 +34,20 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(201, resp.status_code)
         self.assertEqual("someapp", self.manager.instances[0].name)
 
+    def test_start_instance_priority(self):
+        resp = self.api.post("/resources", data={"name": "someapp"})
+        self.assertEqual(201, resp.status_code)
+        resp = self.api.post("/resources", data={"name": "otherapp", "priority": "bulk"})
+        self.assertEqual(201, resp.status_code)
+        self.assertEqual([storage.PRIORITY_INTERACTIVE], self.manager.instances[0].priorities)
+        self.assertEqual([storage.PRIORITY_BULK], self.manager.instances[1].priorities)
+
+    def test_start_instance_invalid_priority(self):
+        resp = self.api.post("/resources", data={"name": "someapp", "priority": "urgent"})
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("invalid priority", resp.data)
+        self.assertEqual([], self.manager.instances)
+
     def test_start_instance_without_name(self):
         resp = self.api.post("/resources", data={"names": "someapp"})
         self.assertEqual(400, resp.status_code)
@@ -75,6 +94,14 @@ class APITestCase(unittest.TestCase):
         bind = self.manager.instances[0].bound[0]
         self.assertEqual("someapp.cloud.tsuru.io", bind)
 
+    def test_bind_app_priority_header(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.post("/resources/someapp/bind-app",
+                             data={"app-host": "someapp.cloud.tsuru.io"},
+                             headers={"X-Priority": "bulk"})
+        self.assertEqual(201, resp.status_code)
+        self.assertEqual([None, storage.PRIORITY_BULK], self.manager.instances[0].priorities)
+
     def test_bind_without_app_host(self):
         resp = self.api.post("/resources/someapp/bind-app",
                              data={"app_hooost": "someapp.cloud.tsuru.io"})
@@ -122,6 +149,89 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(401, resp.status_code)
         self.assertEqual("you do not have access to this resource", resp.data)
 
+    def test_bind_many(self):
+        self.manager.new_instance("someapp")
+        app_hosts = "b.cloud.tsuru.io, a.cloud.tsuru.io,b.cloud.tsuru.io"
+        resp = self.api.post("/resources/someapp/bind-apps", data={"app-hosts": app_hosts},
+                             headers={"X-Priority": "bulk"})
+        self.assertEqual(201, resp.status_code)
+        self.assertEqual({"binds": 2}, json.loads(resp.data))
+        instance = self.manager.instances[0]
+        self.assertEqual(["a.cloud.tsuru.io", "b.cloud.tsuru.io"], instance.bound)
+        self.assertEqual([None, storage.PRIORITY_BULK], instance.priorities)
+
+    def test_bind_many_json(self):
+        self.manager.new_instance("someapp")
+        body = json.dumps({"app-hosts": ["a.cloud.tsuru.io", "b.cloud.tsuru.io"]})
+        resp = self.api.post("/resources/someapp/bind-apps", data=body,
+                             content_type="application/json")
+        self.assertEqual(201, resp.status_code)
+        self.assertEqual(["a.cloud.tsuru.io", "b.cloud.tsuru.io"],
+                         self.manager.instances[0].bound)
+
+    def test_bind_many_defaults_to_bulk_priority(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.post("/resources/someapp/bind-apps",
+                             data={"app-hosts": "a.cloud.tsuru.io"})
+        self.assertEqual(201, resp.status_code)
+        self.assertEqual([None, storage.PRIORITY_BULK], self.manager.instances[0].priorities)
+
+    def test_bind_many_interactive_priority(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.post("/resources/someapp/bind-apps",
+                             data={"app-hosts": "a.cloud.tsuru.io"},
+                             headers={"X-Priority": "interactive"})
+        self.assertEqual(201, resp.status_code)
+        self.assertEqual([None, storage.PRIORITY_INTERACTIVE],
+                         self.manager.instances[0].priorities)
+
+    def test_bind_many_invalid(self):
+        resp = self.api.post("/resources/someapp/bind-apps", data={"app-hosts": " , "})
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("app-hosts is required", resp.data)
+        app_hosts = ",".join(["app%d.cloud.tsuru.io" % i for i in xrange(api.BATCH_LIMIT + 1)])
+        resp = self.api.post("/resources/someapp/bind-apps", data={"app-hosts": app_hosts})
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("at most 1000 app-hosts are allowed", resp.data)
+        resp = self.api.post("/resources/someapp/bind-apps",
+                             data={"app-hosts": "a.cloud.tsuru.io", "priority": "urgent"})
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("invalid priority", resp.data)
+
+    def test_bind_many_invalid_json(self):
+        for body in ({"app-hosts": ["a.cloud.tsuru.io", 1]}, {"app-hosts": [["a"]]}):
+            resp = self.api.post("/resources/someapp/bind-apps", data=json.dumps(body),
+                                 content_type="application/json")
+            self.assertEqual(400, resp.status_code)
+            self.assertEqual("invalid app-hosts: expected a list of strings", resp.data)
+        resp = self.api.delete("/resources/someapp/bind-apps", data=json.dumps(["a"]),
+                               content_type="application/json")
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("invalid body: expected a JSON object", resp.data)
+
+    def test_bind_many_instance_not_found(self):
+        resp = self.api.post("/resources/someapp/bind-apps",
+                             data={"app-hosts": "a.cloud.tsuru.io"})
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("Instance not found", resp.data)
+
+    def test_unbind_many(self):
+        self.manager.new_instance("someapp")
+        self.manager.bind_many("someapp", ["a.cloud.tsuru.io", "b.cloud.tsuru.io",
+                                           "c.cloud.tsuru.io"])
+        resp = self.api.delete("/resources/someapp/bind-apps",
+                               data={"app-hosts": "a.cloud.tsuru.io,c.cloud.tsuru.io"},
+                               headers={"Content-Type": "application/x-www-form-urlencoded"})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(["b.cloud.tsuru.io"], self.manager.instances[0].bound)
+
+    def test_unbind_many_instance_not_found(self):
+        resp = self.api.delete("/resources/someapp/bind-apps",
+                               data={"app-hosts": "a.cloud.tsuru.io"},
+                               headers={"Content-Type": "application/x-www-form-urlencoded"})
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("Instance not found", resp.data)
+
     def test_info(self):
         self.manager.new_instance("someapp")
         resp = self.api.get("/resources/someapp")
@@ -163,6 +273,187 @@ class APITestCase(unittest.TestCase):
         resp = self.api.get("/resources/someapp/status")
         self.assertEqual(204, resp.status_code)
 
+    def test_status_wait_until(self):
+        os.environ["API_STATUS_MAX_WAIT"] = "5"
+        self.addCleanup(os.environ.pop, "API_STATUS_MAX_WAIT")
+        self.manager.new_instance("someapp", state="pending")
+        instance = self.manager.instances[0]
+
+        def start():
+            time.sleep(0.05)
+            instance.state = "scaling"
+            cache.watchers.notify("someapp")
+            time.sleep(0.05)
+            instance.state = "started"
+            cache.watchers.notify(cache.ALL)
+
+        t = threading.Thread(target=start)
+        t.start()
+        self.addCleanup(t.join)
+        started = time.time()
+        resp = self.api.get("/resources/someapp/status?wait=10&until=started")
+        self.assertEqual(204, resp.status_code)
+        self.assertLess(time.time() - started, 5)
+
+    def test_status_wait_for_change(self):
+        os.environ["API_STATUS_MAX_WAIT"] = "5"
+        self.addCleanup(os.environ.pop, "API_STATUS_MAX_WAIT")
+        self.manager.new_instance("someapp", state="pending")
+        instance = self.manager.instances[0]
+        t = threading.Timer(0.05, lambda: (setattr(instance, "state", "error"),
+                                           cache.watchers.notify("someapp")))
+        t.start()
+        self.addCleanup(t.join)
+        resp = self.api.get("/resources/someapp/status?wait=5")
+        self.assertEqual(500, resp.status_code)
+        self.assertEqual({}, cache.watchers.events)
+
+    def test_status_wait_timeout(self):
+        os.environ["API_STATUS_MAX_WAIT"] = "0.1"
+        self.addCleanup(os.environ.pop, "API_STATUS_MAX_WAIT")
+        self.manager.new_instance("someapp", state="pending")
+        started = time.time()
+        resp = self.api.get("/resources/someapp/status?wait=30&until=started")
+        self.assertEqual(202, resp.status_code)
+        self.assertGreaterEqual(time.time() - started, 0.1)
+
+    def test_status_wait_too_many_waiters(self):
+        os.environ["API_STATUS_MAX_WAIT"] = "5"
+        self.addCleanup(os.environ.pop, "API_STATUS_MAX_WAIT")
+        os.environ["API_STATUS_MAX_WAITERS"] = "1"
+        self.addCleanup(os.environ.pop, "API_STATUS_MAX_WAITERS")
+        event = cache.watchers.watch("otherapp")
+        self.addCleanup(cache.watchers.unwatch, "otherapp", event)
+        self.manager.new_instance("someapp", state="pending")
+        started = time.time()
+        resp = self.api.get("/resources/someapp/status?wait=30&until=started")
+        self.assertEqual(202, resp.status_code)
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual({"otherapp": set([event])}, cache.watchers.events)
+
+    def test_status_wait_disabled(self):
+        self.manager.new_instance("someapp", state="pending")
+        started = time.time()
+        resp = self.api.get("/resources/someapp/status?wait=30&until=started")
+        self.assertEqual(202, resp.status_code)
+        self.assertLess(time.time() - started, 1)
+
+    def test_status_invalid_wait(self):
+        self.manager.new_instance("someapp", state="pending")
+        resp = self.api.get("/resources/someapp/status?wait=wat")
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("invalid wait: wat", resp.data)
+
+    def test_list_instances(self):
+        self.manager.new_instance("b", state="started")
+        self.manager.new_instance("a", state="pending")
+        resp = self.api.get("/resources?names=a,b,c")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("application/json", resp.mimetype)
+        expected = {"instances": [{"name": "a", "state": "pending",
+                                   "address": "a.cloud.tsuru.io"},
+                                  {"name": "b", "state": "started",
+                                   "address": "b.cloud.tsuru.io"}],
+                    "missing": ["c"], "next": None}
+        self.assertEqual(expected, json.loads(resp.data))
+
+    def test_list_instances_fields_and_pages(self):
+        for name in ("a", "b", "c"):
+            self.manager.new_instance(name, state="started")
+        resp = self.api.get("/resources?names=c,b,a&fields=name,units&limit=2")
+        data = json.loads(resp.data)
+        self.assertEqual([{"name": "a", "units": [{"id": "i-0"}]},
+                          {"name": "b", "units": [{"id": "i-0"}]}], data["instances"])
+        self.assertEqual("b", data["next"])
+        resp = self.api.get("/resources?names=c,b,a&fields=name&limit=2&after=b")
+        data = json.loads(resp.data)
+        self.assertEqual(([{"name": "c"}], None), (data["instances"], data["next"]))
+
+    def test_list_instances_invalid_params(self):
+        resp = self.api.get("/resources")
+        self.assertEqual((400, "names is required"), (resp.status_code, resp.data))
+        resp = self.api.get("/resources?names=a&fields=name,secret")
+        self.assertEqual((400, "unknown fields: secret"), (resp.status_code, resp.data))
+        for limit in ("0", "1001", "wat"):
+            resp = self.api.get("/resources?names=a&limit=" + limit)
+            self.assertEqual((400, "limit must be between 1 and 1000"),
+                             (resp.status_code, resp.data))
+
+    def test_list_instances_unauthorized(self):
+        self.set_auth_env("varnishapi", "varnish123")
+        self.addCleanup(self.delete_auth_env)
+        resp = self.open_with_auth("/resources?names=a", method="GET",
+                                   user="varnishapi", password="wat")
+        self.assertEqual(401, resp.status_code)
+
+    def test_batch_status(self):
+        self.manager.new_instance("a", state="pending")
+        self.manager.new_instance("b", state="started")
+        resp = self.api.post("/resources/status:batch", data={"names": "a,b"})
+        self.assertEqual(200, resp.status_code)
+        expected = [{"name": "a", "state": "pending", "status": 202},
+                    {"name": "b", "state": "started", "status": 204}]
+        self.assertEqual(expected, json.loads(resp.data)["instances"])
+
+    def test_batch_status_json(self):
+        self.manager.new_instance("a", state="error")
+        body = json.dumps({"names": ["a", "b"], "fields": ["status"], "limit": 10})
+        resp = self.api.post("/resources/status:batch", data=body,
+                             content_type="application/json")
+        data = json.loads(resp.data)
+        self.assertEqual([{"status": 500}], data["instances"])
+        self.assertEqual(["b"], data["missing"])
+
+    def test_batch_status_invalid_json(self):
+        body = json.dumps({"names": ["a", None]})
+        resp = self.api.post("/resources/status:batch", data=body,
+                             content_type="application/json")
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("invalid names: expected a list of strings", resp.data)
+
+    def scan_storage(self):
+        strg = storage.MemoryStorage()
+        self.manager.storage = strg
+        self.addCleanup(delattr, self.manager, "storage")
+        for name in ("a", "b", "c"):
+            units = [storage.Unit(id="i-" + name, secret="abc", state="started")]
+            strg.store_instance(storage.Instance(name=name, state="started", units=units))
+        strg.store_bind(storage.Bind("a.cloud.tsuru.io", storage.Instance(name="a"),
+                                     created_at=datetime.datetime(2015, 3, 10, 12, 0)))
+        return strg
+
+    def test_scan(self):
+        self.scan_storage()
+        resp = self.api.get("/admin/units?limit=2")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("application/x-ndjson", resp.mimetype)
+        lines = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(["i-a", "i-b"], [line.get("id") for line in lines[:2]])
+        self.assertNotIn("secret", lines[0])
+        self.assertEqual({"next": lines[1]["cursor"]}, lines[2])
+        resp = self.api.get("/admin/units?limit=2&after=" + lines[2]["next"])
+        lines = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(["i-c"], [line["id"] for line in lines])
+
+    def test_scan_filters(self):
+        self.scan_storage()
+        resp = self.api.get("/admin/binds?instance_name=a&state=creating")
+        lines = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(1, len(lines))
+        self.assertEqual("2015-03-10T12:00:00", lines[0]["created_at"])
+        resp = self.api.get("/admin/instances?instance_name=b")
+        lines = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(["b"], [line["name"] for line in lines])
+
+    def test_scan_invalid(self):
+        self.scan_storage()
+        resp = self.api.get("/admin/scale_jobs")
+        self.assertEqual(404, resp.status_code)
+        resp = self.api.get("/admin/units?limit=wat")
+        self.assertEqual((400, "invalid limit: wat"), (resp.status_code, resp.data))
+        resp = self.api.get("/admin/units?after=wat")
+        self.assertEqual((400, "invalid cursor: wat"), (resp.status_code, resp.data))
+
     def test_status_not_found(self):
         resp = self.api.get("/resources/someapp/status")
         self.assertEqual(404, resp.status_code)
@@ -184,6 +475,13 @@ class APITestCase(unittest.TestCase):
         _, instance = self.manager.find_instance("someapp")
         self.assertEqual(3, instance.units)
 
+    def test_scale_instance_invalid_priority(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.post("/resources/someapp/scale",
+                             data={"quantity": "3", "priority": "whenever"})
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("invalid priority", resp.data)
+
     def test_scale_instance_invalid_quantity(self):
         self.manager.new_instance("someapp")
         resp = self.api.post("/resources/someapp/scale",
@@ -232,6 +530,40 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(200, resp.status_code)
         self.assertEqual(expected, resp.data)
 
+    def test_metrics(self):
+        self.api.get("/plugin")
+        depths = lambda: metrics.queue_depth.set(3, queue="instances", state="creating")
+        original, api.queue_depths = api.queue_depths, depths
+        self.addCleanup(setattr, api, "queue_depths", original)
+        resp = self.api.get("/metrics")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(metrics.CONTENT_TYPE, resp.headers["Content-Type"])
+        self.assertIn('feaas_http_requests_total{method="GET",endpoint="/plugin",status="200"}',
+                      resp.data)
+        self.assertIn('feaas_http_request_duration_seconds_count{method="GET",'
+                      'endpoint="/plugin"}', resp.data)
+
+    def test_metrics_records_routes(self):
+        labels = {"method": "GET", "endpoint": "/resources/<name>", "status": "404"}
+        before = metrics.http_requests.get(**labels)
+        resp = self.api.get("/resources/wat")
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual(before + 1, metrics.http_requests.get(**labels))
+
+    def test_trace_id_propagates_to_bind(self):
+        exporter = mock.Mock()
+        tracing.set_exporter(exporter)
+        self.addCleanup(tracing.set_exporter, None)
+        self.manager.new_instance("someapp")
+        resp = self.api.post("/resources/someapp/bind-app", data={"app-host": "someapp.io"},
+                             headers={"X-Trace-Id": "abc123"})
+        self.assertEqual(201, resp.status_code)
+        self.assertEqual("abc123", resp.headers["X-Trace-Id"])
+        self.assertEqual(["abc123"], self.manager.instances[0].trace_ids)
+        span = exporter.export.call_args[0][0]
+        self.assertEqual("http POST /resources/<name>/bind-app", span["name"])
+        self.assertEqual("abc123", span["trace_id"])
+
     def open_with_auth(self, url, method, user, password, data=None, headers=None):
         encoded = base64.b64encode(user + ":" + password)
         if not headers:
@@ -256,10 +588,17 @@ class ManagerTestCase(unittest.TestCase):
     def setUp(self):
         if "waaat" in api.managers:
             del api.managers["waaat"]
+        if "waaat" in api.storages:
+            del api.storages["waaat"]
 
     def tearDown(self):
         if "API_MANAGER" in os.environ:
             del os.environ["API_MANAGER"]
+        if "API_STORAGE" in os.environ:
+            del os.environ["API_STORAGE"]
+        if "API_CACHE_SIZE" in os.environ:
+            del os.environ["API_CACHE_SIZE"]
+            cache.configure()
 
     def test_register_manager(self):
         manager = lambda x: x
@@ -302,3 +641,46 @@ class ManagerTestCase(unittest.TestCase):
         manager = api.get_manager()
         self.assertIsInstance(manager, ec2.EC2Manager)
         self.assertIsInstance(manager.storage, storage.MongoDBStorage)
+
+    def test_get_manager_memory_storage(self):
+        os.environ["API_STORAGE"] = "memory"
+        manager = api.get_manager()
+        self.assertIsInstance(manager.storage, storage.MemoryStorage)
+        self.assertIs(manager.storage, api.get_manager().storage)
+
+    def test_get_manager_unknown_storage(self):
+        os.environ["API_STORAGE"] = "redis"
+        with self.assertRaises(ValueError) as cm:
+            api.get_manager()
+        self.assertEqual(("redis is not a valid storage",), cm.exception.args)
+
+    def test_register_storage(self):
+        strg = storage.MemoryStorage()
+        api.register_storage("waaat", lambda: strg)
+        os.environ["API_STORAGE"] = "waaat"
+        self.assertIs(strg, api.get_manager().storage)
+
+    def test_register_storage_without_override(self):
+        api.register_storage("waaat", storage.MemoryStorage)
+        with self.assertRaises(ValueError) as cm:
+            api.register_storage("waaat", storage.MemoryStorage, override=False)
+        self.assertEqual(("Storage already registered",), cm.exception.args)
+        api.register_storage("waaat", storage.BaseStorage, override=True)
+        self.assertEqual(storage.BaseStorage, api.storages["waaat"])
+
+    def test_status_served_from_cache(self):
+        os.environ["API_CACHE_SIZE"] = "10"
+        cache.configure()
+        strg = storage.MemoryStorage()
+        strg.store_instance(storage.Instance(name="years", state="started"))
+        api.register_storage("waaat", lambda: strg)
+        os.environ["API_STORAGE"] = "waaat"
+        client = api.api.test_client()
+        with mock.patch.object(strg, "retrieve_instance",
+                               wraps=strg.retrieve_instance) as retrieve_instance:
+            for i in xrange(10):
+                self.assertEqual(204, client.get("/resources/years/status").status_code)
+            self.assertEqual(1, retrieve_instance.call_count)
+            api.get_manager().remove_instance("years")
+            self.assertEqual(500, client.get("/resources/years/status").status_code)
+            self.assertEqual(3, retrieve_instance.call_count)
@@ -6,7 +6,7 @@ import unittest
 
 import mock
 
-from feaas import managers, storage as api_storage
+from feaas import managers, metrics, storage as api_storage, tracing
 
 
 class BaseManagerTestCase(unittest.TestCase):
@@ -41,11 +41,39 @@ class BaseManagerTestCase(unittest.TestCase):
         manager.bind("someapp", "myapp.cloud.tsuru.io")
         storage.retrieve_instance.assert_called_with(name="someapp")
         storage.store_bind.assert_called_with("abacaxi")
-        Bind.assert_called_with("myapp.cloud.tsuru.io", instance)
+        Bind.assert_called_with("myapp.cloud.tsuru.io", instance, priority=None,
+                                trace_id=None)
 
-    @mock.patch("feaas.storage.Bind")
-    def test_unbind_instance(self, Bind):
-        Bind.return_value = "abacaxi"
+    def test_bind_instance_with_priority(self):
+        instance = api_storage.Instance(name="myinstance")
+        storage = mock.Mock()
+        storage.retrieve_instance.return_value = instance
+        manager = managers.BaseManager(storage)
+        manager.bind("someapp", "myapp.cloud.tsuru.io", priority=api_storage.PRIORITY_BULK)
+        bind = storage.store_bind.call_args[0][0]
+        self.assertEqual(api_storage.PRIORITY_BULK, bind.priority)
+
+    def test_bind_instance_propagates_trace(self):
+        instance = api_storage.Instance(name="myinstance")
+        storage = mock.Mock()
+        storage.retrieve_instance.return_value = instance
+        manager = managers.BaseManager(storage)
+        tracing.set_exporter(mock.Mock())
+        self.addCleanup(tracing.set_exporter, None)
+        with tracing.span("http POST", trace_id="abc123"):
+            manager.bind("someapp", "myapp.cloud.tsuru.io")
+        bind = storage.store_bind.call_args[0][0]
+        self.assertEqual("abc123", bind.trace_id)
+
+    def test_new_instance_with_priority(self):
+        storage = mock.Mock()
+        storage.retrieve_instance.side_effect = api_storage.InstanceNotFoundError()
+        manager = managers.BaseManager(storage)
+        instance = manager.new_instance("someapp", priority=api_storage.PRIORITY_INTERACTIVE)
+        self.assertEqual(api_storage.PRIORITY_INTERACTIVE, instance.priority)
+        storage.store_instance.assert_called_with(instance)
+
+    def test_unbind_instance(self):
         instance = api_storage.Instance(name="myinstance",
                                         units=[api_storage.Unit(id="i-0800",
                                                                 secret="abc-123",
@@ -53,13 +81,44 @@ class BaseManagerTestCase(unittest.TestCase):
         storage = mock.Mock()
         storage.retrieve_instance.return_value = instance
         manager = managers.BaseManager(storage)
-        remove_vcl = mock.Mock()
-        manager.remove_vcl = remove_vcl
-        manager.unbind("someapp", "myapp.cloud.tsuru.io")
-        storage.retrieve_instance.assert_called_with(name="someapp")
-        storage.remove_bind.assert_called_with("abacaxi")
-        Bind.assert_called_with("myapp.cloud.tsuru.io", instance)
-        remove_vcl.assert_called_with("10.1.1.2", "abc-123")
+        manager.remove_vcl = mock.Mock()
+        tracing.set_exporter(mock.Mock())
+        self.addCleanup(tracing.set_exporter, None)
+        with tracing.span("http DELETE", trace_id="abc123"):
+            manager.unbind("myinstance", "myapp.cloud.tsuru.io")
+        storage.retrieve_instance.assert_called_with(name="myinstance")
+        storage.update_binds.assert_called_once_with({"instance_name": "myinstance",
+                                                      "app_host": "myapp.cloud.tsuru.io"},
+                                                     state="removing", trace_id="abc123")
+        self.assertFalse(storage.remove_bind.called)
+        self.assertFalse(manager.remove_vcl.called)
+
+    def test_bind_many(self):
+        instance = api_storage.Instance(name="myinstance")
+        storage = mock.Mock()
+        storage.retrieve_instance.return_value = instance
+        manager = managers.BaseManager(storage)
+        manager.bind_many("myinstance", ["a.cloud.tsuru.io", "b.cloud.tsuru.io"],
+                          priority=api_storage.PRIORITY_BULK)
+        storage.retrieve_instance.assert_called_once_with(name="myinstance")
+        self.assertFalse(storage.store_bind.called)
+        binds = storage.store_binds.call_args[0][0]
+        self.assertEqual(["a.cloud.tsuru.io", "b.cloud.tsuru.io"], [b.app_host for b in binds])
+        self.assertEqual([instance, instance], [b.instance for b in binds])
+        self.assertEqual([api_storage.PRIORITY_BULK] * 2, [b.priority for b in binds])
+
+    def test_unbind_many(self):
+        instance = api_storage.Instance(name="myinstance")
+        storage = mock.Mock()
+        storage.retrieve_instance.return_value = instance
+        manager = managers.BaseManager(storage)
+        manager.unbind_many("myinstance", ["a.cloud.tsuru.io", "b.cloud.tsuru.io"])
+        storage.update_binds.assert_called_once_with(
+            {"instance_name": "myinstance",
+             "app_host": {"$in": ["a.cloud.tsuru.io", "b.cloud.tsuru.io"]}},
+            state="removing")
+        self.assertFalse(storage.retrieve_binds.called)
+        self.assertFalse(storage.update_bind.called)
 
     def test_vcl_template(self):
         manager = managers.BaseManager(None)
@@ -83,6 +142,17 @@ class BaseManagerTestCase(unittest.TestCase):
         varnish_handler.vcl_use.assert_called_with("feaas")
         varnish_handler.quit.assert_called()
 
+    @mock.patch("varnish.VarnishHandler")
+    def test_write_vcl_records_metrics(self, VarnishHandler):
+        before = metrics.varnish_seconds.get(operation="write_vcl")["count"]
+        errors = metrics.varnish_errors.get(operation="write_vcl")
+        VarnishHandler.return_value.vcl_use.side_effect = AssertionError("wat")
+        manager = managers.BaseManager(None)
+        with self.assertRaises(AssertionError):
+            manager.write_vcl("10.2.1.2", "abc-def", "yeah.cloud.tsuru.io")
+        self.assertEqual(before + 1, metrics.varnish_seconds.get(operation="write_vcl")["count"])
+        self.assertEqual(errors + 1, metrics.varnish_errors.get(operation="write_vcl"))
+
     @mock.patch("varnish.VarnishHandler")
     def test_write_vcl_ignores_106(self, VarnishHandler):
         varnish_handler = mock.Mock()
@@ -118,6 +188,19 @@ class BaseManagerTestCase(unittest.TestCase):
         varnish_handler.vcl_discard.assert_called_with("feaas")
         varnish_handler.quit.assert_called()
 
+    @mock.patch("varnish.VarnishHandler")
+    def test_remove_vcl_ignores_missing_configuration(self, VarnishHandler):
+        varnish_handler = mock.Mock()
+        exc = AssertionError("106 No configuration named feaas known.")
+        varnish_handler.vcl_discard.side_effect = exc
+        VarnishHandler.return_value = varnish_handler
+        manager = managers.BaseManager(None)
+        manager.remove_vcl("10.2.2.1", "abc123")
+        self.assertEqual(1, varnish_handler.quit.call_count)
+        varnish_handler.vcl_discard.side_effect = AssertionError("Something went wrong")
+        with self.assertRaises(AssertionError):
+            manager.remove_vcl("10.2.2.1", "abc123")
+
     def test_info(self):
         instance = api_storage.Instance(name="secret",
                                         units=[api_storage.Unit(dns_name="secret.cloud.tsuru.io",
@@ -142,6 +225,21 @@ class BaseManagerTestCase(unittest.TestCase):
         self.assertEqual(expected, manager.info("secret"))
         storage.retrieve_instance.assert_called_with(name="secret")
 
+    def test_describe_instances(self):
+        units = [api_storage.Unit(dns_name="secret.cloud.tsuru.io", id="i-0800",
+                                  state="started", secret="abc")]
+        instances = [api_storage.Instance(name="secret", state="started", units=units),
+                     api_storage.Instance(name="other")]
+        storage = mock.Mock()
+        storage.retrieve_instances.return_value = instances
+        manager = managers.BaseManager(storage)
+        expected = [{"name": "secret", "state": "started", "address": "secret.cloud.tsuru.io",
+                     "units": [{"id": "i-0800", "dns_name": "secret.cloud.tsuru.io",
+                                "state": "started"}]},
+                    {"name": "other", "state": "creating", "address": None, "units": []}]
+        self.assertEqual(expected, manager.describe_instances(["secret", "other"]))
+        storage.retrieve_instances.assert_called_with(name={"$in": ["secret", "other"]})
+
     def test_info_instance_not_found(self):
         storage = mock.Mock()
         storage.retrieve_instance.side_effect = api_storage.InstanceNotFoundError()
@@ -176,6 +274,17 @@ class BaseManagerTestCase(unittest.TestCase):
                                                     "quantity": 2,
                                                     "state": "pending"})
 
+    def test_scale_instance_with_priority(self):
+        instance = api_storage.Instance(name="secret", state="started")
+        storage = mock.Mock()
+        storage.retrieve_instance.return_value = instance
+        manager = managers.BaseManager(storage)
+        manager.scale_instance("secret", 2, priority=api_storage.PRIORITY_BULK)
+        storage.store_scale_job.assert_called_with({"instance": "secret",
+                                                    "quantity": 2,
+                                                    "state": "pending",
+                                                    "priority": 0})
+
     def test_scale_instance_already_scaling(self):
         instance = api_storage.Instance(name="secret", state="scaling")
         storage = mock.Mock()
@@ -215,6 +324,28 @@ class BaseManagerTestCase(unittest.TestCase):
         exc = cm.exception
         self.assertEqual(("quantity must be a positive integer",), exc.args)
 
+    def test_claim_units_pool_disabled(self):
+        storage = mock.Mock()
+        manager = managers.BaseManager(storage)
+        instance = api_storage.Instance(name="secret")
+        self.assertEqual([], manager._claim_units(instance, 2))
+        self.assertFalse(storage.claim_pool_unit.called)
+
+    def test_boot_unit(self):
+        with self.assertRaises(NotImplementedError):
+            self.manager.boot_unit()
+
+    def test_recycle_unit_disabled(self):
+        storage = mock.Mock()
+        manager = managers.BaseManager(storage)
+        manager.remove_vcl = mock.Mock()
+        self.assertFalse(manager._recycle_unit(api_storage.Unit(id="i-0800")))
+        self.assertFalse(manager.remove_vcl.called)
+
+    def test_destroy_units(self):
+        with self.assertRaises(NotImplementedError):
+            self.manager.destroy_units([])
+
     def test_start_instance(self):
         with self.assertRaises(NotImplementedError):
             self.manager.start_instance("something")
@@ -0,0 +1,200 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import StringIO
+import os
+import unittest
+
+import mock
+import varnish
+
+from benchmarks import e2e, fakes, storage_bench
+from feaas import managers, storage
+from feaas.managers import cloudstack, ec2
+
+
+class FakeVarnishadmTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.secrets = fakes.Secrets()
+        self.secrets.add_from_user_data("echo abc-123 > /etc/varnish/secret\n")
+        self.varnishadm = fakes.FakeVarnishadm(port=0, secrets=self.secrets).start()
+        self.addCleanup(self.varnishadm.stop)
+        self.addr = "{}:{}".format(self.varnishadm.host, self.varnishadm.port)
+
+    def test_write_vcl(self):
+        manager = managers.BaseManager(None)
+        handler_class = varnish.VarnishHandler
+        with mock.patch("varnish.VarnishHandler") as VarnishHandler:
+            VarnishHandler.side_effect = lambda addr, secret: handler_class(self.addr,
+                                                                            secret=secret)
+            manager.write_vcl("127.0.0.1", "abc-123", "myapp.cloud.tsuru.io")
+        self.assertEqual(1, self.varnishadm.pushes)
+        self.assertIn("myapp.cloud.tsuru.io", self.varnishadm.applied_at)
+
+    def test_configs_per_unit(self):
+        self.secrets.add_from_user_data("echo def-456 > /etc/varnish/secret\n")
+        handler = varnish.VarnishHandler(self.addr, secret="abc-123")
+        handler.vcl_inline("feaas", '"vcl 4.0;"')
+        with self.assertRaises(AssertionError) as cm:
+            handler.vcl_inline("feaas", '"vcl 4.0;"')
+        self.assertIn("106 Already a VCL program named feaas", cm.exception.args[0])
+        handler.vcl_use("feaas")
+        with self.assertRaises(AssertionError) as cm:
+            handler.vcl_discard("feaas")
+        self.assertIn("106 Cannot discard active VCL program", cm.exception.args[0])
+        handler.quit()
+        other = varnish.VarnishHandler(self.addr, secret="def-456")
+        other.vcl_inline("feaas", '"vcl 4.0;"')
+        other.quit()
+        self.assertEqual(2, self.varnishadm.pushes)
+
+    def test_remove_vcl(self):
+        manager = managers.BaseManager(None)
+        handler_class = varnish.VarnishHandler
+        with mock.patch("varnish.VarnishHandler") as VarnishHandler:
+            VarnishHandler.side_effect = lambda addr, secret: handler_class(self.addr,
+                                                                            secret=secret)
+            manager.write_vcl("127.0.0.1", "abc-123", "myapp.cloud.tsuru.io")
+            manager.remove_vcl("127.0.0.1", "abc-123")
+            manager.remove_vcl("127.0.0.1", "abc-123")
+        handler = varnish.VarnishHandler(self.addr, secret="abc-123")
+        with self.assertRaises(AssertionError) as cm:
+            handler.vcl_discard("feaas")
+        self.assertIn("106 No configuration named feaas known.", cm.exception.args[0])
+        handler.quit()
+        self.assertEqual({"boot"}, self.varnishadm.configs["abc-123"]["loaded"])
+
+    def test_wrong_secret(self):
+        with self.assertRaises(AssertionError):
+            varnish.VarnishHandler(self.addr, secret="wat")
+        self.assertEqual(1, self.varnishadm.auth_failures)
+
+
+class FakeEC2TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.secrets = fakes.Secrets()
+        self.ec2 = fakes.FakeEC2(secrets=self.secrets).start()
+        self.addCleanup(self.ec2.stop)
+        env = {"EC2_ENDPOINT": "http://{}:{}/".format(self.ec2.host, self.ec2.port),
+               "EC2_ACCESS_KEY": "bench", "EC2_SECRET_KEY": "bench",
+               "API_PACKAGES": "varnish"}
+        patcher = mock.patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_run_and_terminate(self):
+        manager = ec2.EC2Manager(mock.Mock())
+        unit = manager._run_unit()
+        self.assertEqual("127.0.0.1", unit.dns_name)
+        self.assertEqual(set([unit.secret]), self.secrets.secrets)
+        manager.destroy_units([unit])
+        self.assertEqual({"RunInstances": 1, "TerminateInstances": 1}, self.ec2.calls)
+
+
+class FakeCloudStackTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cloudstack = fakes.FakeCloudStack(job_latency=0).start()
+        self.addCleanup(self.cloudstack.stop)
+        env = {"CLOUDSTACK_API_URL": "http://{}:{}/client/api".format(self.cloudstack.host,
+                                                                      self.cloudstack.port),
+               "CLOUDSTACK_API_KEY": "bench", "CLOUDSTACK_SECRET_KEY": "bench",
+               "CLOUDSTACK_TEMPLATE_ID": "t", "CLOUDSTACK_ZONE_ID": "z",
+               "CLOUDSTACK_SERVICE_OFFERING_ID": "o", "API_PACKAGES": "varnish"}
+        patcher = mock.patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_boot_unit(self):
+        manager = cloudstack.CloudStackManager(mock.Mock())
+        unit = manager.boot_unit()
+        self.assertEqual("127.0.0.1", unit.dns_name)
+        self.assertEqual("creating", unit.state)
+        manager.destroy_units([unit])
+        self.assertEqual({}, self.cloudstack.vms)
+
+    @mock.patch("time.time")
+    def test_job_latency(self, time):
+        time.return_value = 100
+        service = fakes.FakeCloudStack(job_latency=5)
+        self.addCleanup(service.server.server_close)
+        job = service.deployVirtualMachine({})
+        self.assertEqual(0, service.queryAsyncJobResult(job)["jobstatus"])
+        time.return_value = 105
+        self.assertEqual(1, service.queryAsyncJobResult(job)["jobstatus"])
+
+
+class E2ETestCase(unittest.TestCase):
+
+    def test_percentiles(self):
+        result = e2e.percentiles(range(1, 101))
+        self.assertEqual({"count": 100, "max": 100, "p50": 51, "p90": 90, "p99": 99}, result)
+        self.assertIsNone(e2e.percentiles([]))
+
+    def test_wait_for(self):
+        strg = mock.Mock()
+        strg.retrieve_instances.return_value = [storage.Instance(name="a", state="started")]
+        with mock.patch("time.time") as time:
+            time.return_value = 110
+            done = e2e.wait_for({"a": 100}, e2e.started_instances(strg), timeout=1)
+        self.assertEqual({"a": 10}, done)
+
+    def test_wait_for_leaves_timed_out_items_pending(self):
+        strg = mock.Mock()
+        strg.retrieve_instances.return_value = [storage.Instance(name="a", state="started")]
+        pending = {"a": 100, "b": 100}
+        with mock.patch("time.time") as time, mock.patch("time.sleep"):
+            time.side_effect = [100, 101, 101, 102]
+            done = e2e.wait_for(pending, e2e.started_instances(strg), timeout=1.5)
+        self.assertEqual({"a": 1}, done)
+        self.assertEqual({"b": 100}, pending)
+
+    def test_first_binds(self):
+        binds = [("a", "a-app0"), ("a", "a-app1"), ("b", "b-app0")]
+        self.assertEqual({"a-app0": 10, "b-app0": 12}, e2e.first_binds(binds, [10, 11, 12]))
+
+    def test_report_timeouts(self):
+        args = mock.Mock(instances=2, binds=1, scale=0)
+        varnishadm = mock.Mock(pushes=1, auth_failures=0)
+        results = {"time_to_started": {"a": 1.0}, "time_to_scaled": {}}
+        timed_out = {"time_to_started": 1, "time_to_scaled": 0}
+        data = e2e.report(args, results, timed_out, e2e.Recorder(), varnishadm, 5)
+        self.assertEqual(1, data["timings"]["time_to_started"]["timeouts"])
+        self.assertEqual({"count": 0, "timeouts": 0}, data["timings"]["time_to_scaled"])
+        out = StringIO.StringIO()
+        e2e.print_report(data, out)
+        self.assertIn("timeouts", out.getvalue())
+
+
+class StorageBenchTestCase(unittest.TestCase):
+
+    def test_measure(self):
+        fn = mock.Mock()
+        result = storage_bench.measure(fn, iterations=10, warmup=2)
+        self.assertEqual(12, fn.call_count)
+        self.assertEqual(10, result["count"])
+        for key in ("min", "mean", "p50", "p90", "p99", "max", "ops_per_second"):
+            self.assertIn(key, result)
+
+    def test_compare(self):
+        baseline = {"results": [{"case": "retrieve_instance", "documents": 1000, "p50": 0.001},
+                                {"case": "update_units", "documents": 1000, "p50": 0.002}]}
+        current = {"results": [{"case": "retrieve_instance", "documents": 1000, "p50": 0.0015},
+                               {"case": "update_units", "documents": 1000, "p50": 0.0021},
+                               {"case": "locker_cycle", "documents": 1000, "p50": 0.01}]}
+        regressions = storage_bench.compare(baseline, current, threshold=0.2)
+        self.assertEqual(1, len(regressions))
+        self.assertEqual("retrieve_instance", regressions[0]["case"])
+        self.assertAlmostEqual(0.5, regressions[0]["change"])
+
+    def test_seed_memory(self):
+        strg = storage_bench.seed(storage.MemoryStorage(), 10)
+        self.assertEqual(10, len(strg.retrieve_instances(state="started")))
+        self.assertEqual(20, len(strg.retrieve_units()))
+        cases = storage_bench.Cases(strg, 10, storage_bench.random.Random(1))
+        for case in storage_bench.CASES:
+            cases.prepare(case)()
+        self.assertEqual(1, len(strg.retrieve_binds(instance_name="instance3")))
@@ -0,0 +1,256 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import os
+import unittest
+
+import mock
+
+from feaas import cache, metrics, storage
+
+
+class FakeNotifier(object):
+
+    def __init__(self):
+        self.published = []
+        self.callbacks = []
+
+    def publish(self, name):
+        self.published.append(name)
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_get_and_set(self):
+        lru = cache.LRUCache(max_size=2, ttl=5)
+        self.assertIsNone(lru.get("a"))
+        lru.set("a", 1)
+        self.assertEqual(1, lru.get("a"))
+
+    def test_evicts_least_recently_used(self):
+        lru = cache.LRUCache(max_size=2, ttl=5)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")
+        lru.set("c", 3)
+        self.assertEqual(["a", "c"], sorted(lru.entries.keys()))
+
+    @mock.patch("time.time")
+    def test_ttl(self, time):
+        time.return_value = 100
+        lru = cache.LRUCache(max_size=2, ttl=5)
+        lru.set("a", 1)
+        time.return_value = 104.9
+        self.assertEqual(1, lru.get("a"))
+        time.return_value = 105
+        self.assertIsNone(lru.get("a"))
+        self.assertEqual(0, len(lru))
+
+    def test_invalidate(self):
+        lru = cache.LRUCache()
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.invalidate("a")
+        self.assertEqual(["b"], lru.entries.keys())
+        lru.invalidate(cache.ALL)
+        self.assertEqual(0, len(lru))
+
+    def test_set_after_invalidation(self):
+        lru = cache.LRUCache()
+        version = lru.version
+        lru.invalidate("a")
+        lru.set("a", 1, version=version)
+        self.assertIsNone(lru.get("a"))
+
+    def test_metrics(self):
+        lru = cache.LRUCache()
+        hits = metrics.cache_requests.get(result="hit")
+        misses = metrics.cache_requests.get(result="miss")
+        lru.get("a")
+        lru.set("a", 1)
+        lru.get("a")
+        self.assertEqual(hits + 1, metrics.cache_requests.get(result="hit"))
+        self.assertEqual(misses + 1, metrics.cache_requests.get(result="miss"))
+
+
+class CachedStorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.inner = storage.MemoryStorage()
+        self.inner.store_instance(storage.Instance(name="years", state="creating",
+                                                   units=[storage.Unit(id="i-1")]))
+        self.notifier = FakeNotifier()
+        self.cache = cache.LRUCache()
+        self.storage = cache.CachedStorage(self.inner, self.cache, self.notifier)
+
+    def spy(self):
+        patcher = mock.patch.object(self.inner, "retrieve_instance",
+                                    wraps=self.inner.retrieve_instance)
+        retrieve = patcher.start()
+        self.addCleanup(patcher.stop)
+        return retrieve
+
+    def test_cached_reads(self):
+        retrieve = self.spy()
+        with cache.reads():
+            for i in xrange(3):
+                instance = self.storage.retrieve_instance(name="years")
+        self.assertEqual(1, retrieve.call_count)
+        self.assertEqual(["i-1"], [u.id for u in instance.units])
+        self.assertEqual(instance, instance.units[0].instance)
+
+    def test_uncached_reads(self):
+        retrieve = self.spy()
+        self.storage.retrieve_instance(name="years")
+        with cache.reads():
+            self.storage.retrieve_instance(state="creating")
+            self.storage.retrieve_instance(name="years", sort=storage.FIFO_SORT)
+        self.assertEqual(3, retrieve.call_count)
+        self.assertEqual(0, len(self.cache))
+
+    def test_returns_copies(self):
+        with cache.reads():
+            self.storage.retrieve_instance(name="years").state = "removed"
+            self.assertEqual("creating", self.storage.retrieve_instance(name="years").state)
+
+    def test_check_liveness(self):
+        self.inner.store_instance(storage.Instance(name="days", state="removed"))
+        with cache.reads():
+            self.storage.retrieve_instance(name="days")
+            with self.assertRaises(storage.InstanceNotFoundError):
+                self.storage.retrieve_instance(name="days", check_liveness=True)
+            with self.assertRaises(storage.InstanceNotFoundError):
+                self.storage.retrieve_instance(name="weeks")
+
+    def test_writes_invalidate(self):
+        with cache.reads():
+            instance = self.storage.retrieve_instance(name="years")
+            instance.state = "started"
+            self.storage.store_instance(instance)
+            self.assertEqual("started", self.storage.retrieve_instance(name="years").state)
+            self.storage.update_units(instance.units, state="started")
+            unit = self.storage.retrieve_instance(name="years").units[0]
+            self.assertEqual("started", unit.state)
+            self.assertFalse(self.storage.transition_instance("years", "creating",
+                                                              state="scaling"))
+            self.assertTrue(self.storage.transition_instance("years", "started",
+                                                             state="scaling"))
+            self.assertEqual("scaling", self.storage.retrieve_instance(name="years").state)
+            self.storage.remove_instance("years")
+            with self.assertRaises(storage.InstanceNotFoundError):
+                self.storage.retrieve_instance(name="years")
+        self.assertEqual(["years"] * 4, self.notifier.published)
+
+    def test_release_expired_leases(self):
+        expired = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+        self.storage.release_expired_leases()
+        self.assertEqual([], self.notifier.published)
+        self.inner.store_instance(storage.Instance(name="days", state="starting",
+                                                   lease_expires_at=expired))
+        self.storage.release_expired_leases()
+        self.assertEqual([cache.ALL], self.notifier.published)
+
+    def test_delegates(self):
+        self.storage.store_bind(storage.Bind("myapp.io", storage.Instance(name="years")))
+        self.assertEqual(["myapp.io"], [b.app_host for b in self.inner.retrieve_binds()])
+        self.assertIsInstance(self.storage.new_locker(), storage.MemoryLocker)
+
+
+class WrapTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        os.environ.pop("API_CACHE_SIZE", None)
+        os.environ.pop("API_CACHE_TTL", None)
+        cache.configure()
+
+    def test_disabled(self):
+        cache.configure()
+        self.assertFalse(cache.enabled())
+        strg = storage.MemoryStorage()
+        self.assertIs(strg, cache.wrap(strg))
+
+    def test_wrap(self):
+        os.environ["API_CACHE_SIZE"] = "10"
+        os.environ["API_CACHE_TTL"] = "0.5"
+        cache.configure()
+        notifier = FakeNotifier()
+        strg = storage.MemoryStorage()
+        strg.new_notifier = lambda: notifier
+        wrapped = cache.wrap(strg)
+        self.assertIsInstance(wrapped, cache.CachedStorage)
+        self.assertIs(wrapped, cache.wrap(wrapped))
+        self.assertEqual((10, 0.5), (wrapped.cache.max_size, wrapped.cache.ttl))
+        self.assertIs(notifier, wrapped.notifier)
+        cache.wrap(strg)
+        self.assertEqual(1, len(notifier.callbacks))
+        wrapped.cache.set("years", 1)
+        notifier.callbacks[0]("years")
+        self.assertIsNone(wrapped.cache.get("years"))
+
+    def test_cached_reads(self):
+        @cache.cached_reads
+        def view():
+            return cache.reading()
+
+        self.assertTrue(view())
+        self.assertFalse(cache.reading())
+
+    def test_wrap_notifications_only(self):
+        os.environ["API_STATUS_MAX_WAIT"] = "30"
+        self.addCleanup(os.environ.pop, "API_STATUS_MAX_WAIT")
+        cache.configure()
+        self.assertFalse(cache.enabled())
+        wrapped = cache.wrap(storage.MemoryStorage())
+        self.assertIsNone(wrapped.cache)
+        wrapped.store_instance(storage.Instance(name="years"))
+        with cache.reads():
+            self.assertEqual("years", wrapped.retrieve_instance(name="years").name)
+
+
+class WatchersTestCase(unittest.TestCase):
+
+    def test_notify(self):
+        watchers = cache.Watchers()
+        years = watchers.watch("years")
+        days = watchers.watch("days")
+        watchers.notify("years")
+        self.assertTrue(years.is_set())
+        self.assertFalse(days.is_set())
+        watchers.notify(cache.ALL)
+        self.assertTrue(days.is_set())
+        watchers.unwatch("years", years)
+        watchers.unwatch("days", days)
+        self.assertEqual({}, watchers.events)
+
+    def test_watch_limit(self):
+        watchers = cache.Watchers()
+        years = watchers.watch("years", limit=2)
+        days = watchers.watch("days", limit=2)
+        self.assertIsNone(watchers.watch("weeks", limit=2))
+        self.assertEqual(2, watchers.count)
+        watchers.unwatch("years", years)
+        watchers.unwatch("years", years)
+        self.assertEqual(1, watchers.count)
+        weeks = watchers.watch("weeks", limit=2)
+        self.assertIsNotNone(weeks)
+        watchers.unwatch("days", days)
+        watchers.unwatch("weeks", weeks)
+        self.assertEqual(0, watchers.count)
+
+    def test_max_waiters(self):
+        self.assertEqual(16, cache.max_waiters())
+        os.environ["API_STATUS_MAX_WAITERS"] = "4"
+        self.addCleanup(os.environ.pop, "API_STATUS_MAX_WAITERS")
+        self.assertEqual(4, cache.max_waiters())
+
+    def test_storage_writes_notify(self):
+        event = cache.watchers.watch("years")
+        self.addCleanup(cache.watchers.unwatch, "years", event)
+        strg = cache.CachedStorage(storage.MemoryStorage(), None)
+        strg.store_instance(storage.Instance(name="years"))
+        self.assertTrue(event.is_set())
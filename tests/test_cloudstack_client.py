@@ -15,3 +15,14 @@ class CloudStackClientTestCase(unittest.TestCase):
                                               "secret!")
         expected = base64.b64encode("some user data")
         self.assertEqual(expected, client.encode_user_data("some user data"))
+
+    def test_make_request_error(self):
+        client = cloudstack_client.CloudStack("http://localhost", "api_key",
+                                              "secret!")
+        body = '{"deployvirtualmachineresponse": {"errorcode": 431, "errortext": "wat"}}'
+        client._http_get = lambda url: body
+        with self.assertRaises(cloudstack_client.CloudStackError) as cm:
+            client.deployVirtualMachine({"zoneid": "zone1"})
+        exc = cm.exception
+        self.assertEqual(431, exc.code)
+        self.assertEqual((431, "wat"), exc.args)
@@ -9,7 +9,7 @@ import unittest
 import mock
 
 from feaas import storage
-from feaas.managers import cloudstack
+from feaas.managers import cloudstack, cloudstack_client
 
 
 class CloudStackManagerTestCase(unittest.TestCase):
@@ -298,6 +298,21 @@ class CloudStackManagerTestCase(unittest.TestCase):
             manager.start_instance("some_instance")
         exc = cm.exception
         self.assertEqual(1, exc.max_tries)
+        client_mock.destroyVirtualMachine.assert_called_once_with({"id": "abc123"})
+        self.assertEqual([], instance.units)
+        strg_mock.store_instance.assert_called_once_with(instance)
+
+    def test_start_instance_with_units(self):
+        self.set_api_envs()
+        self.addCleanup(self.del_api_envs)
+        instance = storage.Instance(name="some_instance", units=[storage.Unit(id="vm-123")])
+        strg_mock = mock.Mock()
+        strg_mock.retrieve_instance.return_value = instance
+        manager = cloudstack.CloudStackManager(storage=strg_mock)
+        manager.client = client_mock = mock.Mock()
+        self.assertEqual(instance, manager.start_instance("some_instance"))
+        self.assertFalse(client_mock.deployVirtualMachine.called)
+        self.assertEqual(["vm-123"], [u.id for u in instance.units])
 
     def test_terminate_instance(self):
         self.set_api_envs()
@@ -331,6 +346,24 @@ class CloudStackManagerTestCase(unittest.TestCase):
         self.assertEqual(instance, got_instance)
         stderr.write.assert_called_with("[ERROR] Failed to terminate CloudStack VM: wat wot")
 
+    @mock.patch("time.sleep")
+    def test_terminate_instance_retries_when_throttled(self, sleep):
+        self.set_api_envs()
+        self.addCleanup(self.del_api_envs)
+        instance = storage.Instance(name="some_instance",
+                                    units=[storage.Unit(id="vm-123")])
+        strg_mock = mock.Mock()
+        strg_mock.retrieve_instance.return_value = instance
+        client_mock = mock.Mock()
+        client_mock.destroyVirtualMachine.side_effect = [
+            cloudstack_client.CloudStackError(431, "too many requests"), {}]
+        manager = cloudstack.CloudStackManager(storage=strg_mock)
+        manager.client = client_mock
+        manager.terminate_instance("some_instance")
+        expected_calls = [mock.call({"id": "vm-123"}), mock.call({"id": "vm-123"})]
+        self.assertEqual(expected_calls, client_mock.destroyVirtualMachine.call_args_list)
+        self.assertTrue(sleep.called)
+
     @mock.patch("uuid.uuid4")
     def test_physical_scale_up(self, uuid):
         self.set_api_envs()
@@ -384,6 +417,27 @@ class CloudStackManagerTestCase(unittest.TestCase):
         expected_calls = [mock.call({"id": "vm-123"}), mock.call({"id": "vm-456"})]
         self.assertEqual(expected_calls, client_mock.destroyVirtualMachine.call_args_list)
 
+    def test_destroy_units(self):
+        self.set_api_envs()
+        self.addCleanup(self.del_api_envs)
+        manager = cloudstack.CloudStackManager(storage=None)
+        manager.client = client_mock = mock.Mock()
+        failed = manager.destroy_units([storage.Unit(id="vm-123"), storage.Unit(id="vm-456")])
+        expected_calls = [mock.call({"id": "vm-123"}), mock.call({"id": "vm-456"})]
+        self.assertEqual(expected_calls, client_mock.destroyVirtualMachine.call_args_list)
+        self.assertEqual([], failed)
+
+    @mock.patch("sys.stderr")
+    def test_destroy_units_failure(self, stderr):
+        self.set_api_envs()
+        self.addCleanup(self.del_api_envs)
+        manager = cloudstack.CloudStackManager(storage=None)
+        manager.client = client_mock = mock.Mock()
+        client_mock.destroyVirtualMachine.side_effect = [None, ValueError("vm is busy")]
+        units = [storage.Unit(id="vm-123"), storage.Unit(id="vm-456")]
+        self.assertEqual([units[1]], manager.destroy_units(units))
+        stderr.write.assert_called_with("[ERROR] Failed to terminate CloudStack VM: vm is busy")
+
 
 class MaxTryExceededErrorTestCase(unittest.TestCase):
 
@@ -2,9 +2,12 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
 import os
 import unittest
 
+import freezegun
+import httplib2
 import mock
 
 from feaas import managers, storage as api_storage
@@ -113,6 +116,15 @@ class EC2ManagerTestCase(unittest.TestCase):
         self.assertEqual(instance, created_instance)
         manager._add_units.assert_called_with(instance, 1)
 
+    def test_start_instance_with_units(self):
+        instance = api_storage.Instance(name="myapp", units=[api_storage.Unit(id="i-0800")])
+        storage = mock.Mock()
+        storage.retrieve_instance.return_value = instance
+        manager = ec2.EC2Manager(storage)
+        manager._add_units = mock.Mock()
+        self.assertEqual(instance, manager.start_instance("myapp"))
+        self.assertFalse(manager._add_units.called)
+
     def test_start_instance_not_found(self):
         storage = mock.Mock()
         storage.retrieve_instance.side_effect = api_storage.InstanceNotFoundError()
@@ -124,6 +136,7 @@ class EC2ManagerTestCase(unittest.TestCase):
     def test_start_instance_ec2_default_userdata(self, uuid4):
         uuid4.return_value = u"abacaxi"
         os.environ["API_PACKAGES"] = "varnish vim-nox"
+        self.addCleanup(managers.user_data.cache.clear)
 
         def recover():
             del os.environ["API_PACKAGES"]
@@ -165,8 +178,9 @@ cat > /etc/cron.hourly/dump_vcls <<'END'
 END
 chmod +x /etc/cron.hourly/dump_vcls
 """.format(open(managers.DUMP_VCL_FILE).read())
-        request.return_value = (200, return_content)
+        request.return_value = (httplib2.Response({"status": "200"}), return_content)
         os.environ["USER_DATA_URL"] = "http://localhost/custom_user_data_script"
+        self.addCleanup(managers.user_data.cache.clear)
 
         def recover():
             del os.environ["USER_DATA_URL"]
@@ -244,6 +258,23 @@ chmod +x /etc/cron.hourly/dump_vcls
         msg = "[ERROR] Failed to terminate EC2 instance: Something went wrong"
         stderr_mock.write.assert_called_with(msg)
 
+    @mock.patch("time.sleep")
+    def test_terminate_instance_retries_when_throttled(self, sleep):
+        conn = mock.Mock()
+        exc = Exception("Request limit exceeded.")
+        exc.error_code = "RequestLimitExceeded"
+        conn.terminate_instances.side_effect = [exc, None]
+        unit = api_storage.Unit(id="i-0800")
+        storage = mock.Mock()
+        storage.retrieve_instance.return_value = api_storage.Instance(name="secret",
+                                                                      units=[unit])
+        manager = ec2.EC2Manager(storage)
+        manager._connection = conn
+        manager.terminate_instance("secret")
+        expected = [mock.call(instance_ids=["i-0800"])] * 2
+        self.assertEqual(expected, conn.terminate_instances.call_args_list)
+        self.assertTrue(sleep.called)
+
     def test_physical_scale_add_units(self):
         instance = api_storage.Instance(name="secret",
                                         units=[api_storage.Unit(dns_name="secret.cloud.tsuru.io",
@@ -258,6 +289,44 @@ chmod +x /etc/cron.hourly/dump_vcls
         storage.store_instance.assert_called_with(instance)
         self.assertEqual(fake_data["units"], units)
 
+    def test_physical_scale_stores_units_added_before_failure(self):
+        instance = api_storage.Instance(name="secret", units=[])
+        unit = api_storage.Unit(dns_name="secret.cloud.tsuru.io", id="i-0800")
+        storage = mock.Mock()
+        manager = ec2.EC2Manager(storage)
+        manager._run_unit = mock.Mock(side_effect=[unit, ValueError("no capacity")])
+        with self.assertRaises(ValueError):
+            manager.physical_scale(instance, 2)
+        self.assertEqual([unit], instance.units)
+        storage.store_instance.assert_called_once_with(instance)
+
+    def test_physical_scale_claims_pool_units(self):
+        os.environ["API_POOL_SIZE"] = "2"
+
+        def recover():
+            del os.environ["API_POOL_SIZE"]
+        self.addCleanup(recover)
+        pool_unit = api_storage.Unit(dns_name="pool.cloud.tsuru.io", id="i-0900",
+                                     secret="pool-secret", state="ready")
+        instance = api_storage.Instance(name="secret", units=[])
+        fake_run_unit, fake_data = self.get_fake_run_unit()
+        storage = mock.Mock()
+        storage.claim_pool_unit.side_effect = [pool_unit, None]
+        manager = ec2.EC2Manager(storage)
+        manager._run_unit = fake_run_unit
+        units = manager.physical_scale(instance, 3)
+        self.assertEqual(2, fake_data["calls"])
+        self.assertEqual([pool_unit] + fake_data["units"], units)
+        self.assertEqual(units, instance.units)
+        self.assertEqual("creating", pool_unit.state)
+        self.assertEqual(instance, pool_unit.instance)
+        storage.store_instance.assert_called_with(instance)
+
+    def test_boot_unit(self):
+        manager = ec2.EC2Manager(None)
+        manager._run_unit = mock.Mock(return_value="unit")
+        self.assertEqual("unit", manager.boot_unit())
+
     def test_physical_scale_remove_units(self):
         unit1 = api_storage.Unit(dns_name="secret1.cloud.tsuru.io", id="i-0800")
         unit2 = api_storage.Unit(dns_name="secret2.cloud.tsuru.io", id="i-0801")
@@ -274,6 +343,93 @@ chmod +x /etc/cron.hourly/dump_vcls
         storage.store_instance.assert_called_with(instance)
         self.assertEqual([unit1, unit2], units)
 
+    @freezegun.freeze_time("2015-03-11 10:00:00")
+    def test_physical_scale_recycles_removed_units(self):
+        os.environ["API_RECYCLE_POOL_SIZE"] = "2"
+
+        def recover():
+            del os.environ["API_RECYCLE_POOL_SIZE"]
+        self.addCleanup(recover)
+        unit1 = api_storage.Unit(dns_name="secret1.cloud.tsuru.io", id="i-0800",
+                                 secret="abc123")
+        unit2 = api_storage.Unit(dns_name="secret2.cloud.tsuru.io", id="i-0801",
+                                 secret="abc321")
+        unit3 = api_storage.Unit(dns_name="secret3.cloud.tsuru.io", id="i-0802")
+        instance = api_storage.Instance(name="secret", units=[unit1, unit2, unit3])
+        storage = mock.Mock()
+        storage.count_pool_units.side_effect = [1, 2]
+        manager = ec2.EC2Manager(storage)
+        manager._terminate_unit = mock.Mock()
+        manager.remove_vcl = mock.Mock()
+        manager.physical_scale(instance, 1)
+        manager.remove_vcl.assert_called_once_with("secret1.cloud.tsuru.io", "abc123")
+        expires_at = datetime.datetime(2015, 3, 11, 11)
+        storage.store_pool_unit.assert_called_once_with(unit1, expires_at=expires_at)
+        self.assertEqual("ready", unit1.state)
+        manager._terminate_unit.assert_called_once_with(unit2)
+        storage.count_pool_units.assert_called_with(expires_at={"$exists": True})
+        self.assertEqual([unit3], instance.units)
+
+    @mock.patch("sys.stderr")
+    def test_terminate_instance_recycling_unreachable_unit(self, stderr):
+        os.environ["API_RECYCLE_POOL_SIZE"] = "2"
+
+        def recover():
+            del os.environ["API_RECYCLE_POOL_SIZE"]
+        self.addCleanup(recover)
+        unit = api_storage.Unit(dns_name="secret1.cloud.tsuru.io", id="i-0800")
+        storage = mock.Mock()
+        storage.retrieve_instance.return_value = api_storage.Instance(name="secret",
+                                                                      units=[unit])
+        storage.count_pool_units.return_value = 0
+        manager = ec2.EC2Manager(storage)
+        manager._terminate_unit = mock.Mock()
+        manager.remove_vcl = mock.Mock(side_effect=IOError("connection refused"))
+        manager.terminate_instance("secret")
+        manager._terminate_unit.assert_called_once_with(unit)
+        self.assertFalse(storage.store_pool_unit.called)
+        msg = "[ERROR] Failed to clean unit for recycling: connection refused\n"
+        stderr.write.assert_called_with(msg)
+
+    def test_terminate_instance_recycles_unit_without_vcl(self):
+        os.environ["API_RECYCLE_POOL_SIZE"] = "2"
+
+        def recover():
+            del os.environ["API_RECYCLE_POOL_SIZE"]
+        self.addCleanup(recover)
+        unit = api_storage.Unit(dns_name="secret1.cloud.tsuru.io", id="i-0800")
+        storage = mock.Mock()
+        storage.retrieve_instance.return_value = api_storage.Instance(name="secret",
+                                                                      units=[unit])
+        storage.count_pool_units.return_value = 0
+        manager = ec2.EC2Manager(storage)
+        manager._terminate_unit = mock.Mock()
+        exc = AssertionError("106 No configuration named feaas known.")
+        manager.remove_vcl = mock.Mock(side_effect=exc)
+        manager.terminate_instance("secret")
+        self.assertFalse(manager._terminate_unit.called)
+        self.assertEqual(1, storage.store_pool_unit.call_count)
+
+    def test_destroy_units(self):
+        conn = mock.Mock()
+        manager = ec2.EC2Manager(None)
+        manager._connection = conn
+        failed = manager.destroy_units([api_storage.Unit(id="i-0800"),
+                                        api_storage.Unit(id="i-0801")])
+        conn.terminate_instances.assert_called_once_with(instance_ids=["i-0800", "i-0801"])
+        self.assertEqual([], failed)
+
+    @mock.patch("sys.stderr")
+    def test_destroy_units_failure(self, stderr):
+        conn = mock.Mock()
+        conn.terminate_instances.side_effect = ValueError("request limit exceeded")
+        manager = ec2.EC2Manager(None)
+        manager._connection = conn
+        units = [api_storage.Unit(id="i-0800"), api_storage.Unit(id="i-0801")]
+        self.assertEqual(units, manager.destroy_units(units))
+        stderr.write.assert_called_with("[ERROR] Failed to terminate EC2 instances: "
+                                        "request limit exceeded")
+
     def get_fake_reservation(self, instances):
         reservation = mock.Mock(instances=[])
         for instance in instances:
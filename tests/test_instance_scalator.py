@@ -2,11 +2,13 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
+import threading
 import unittest
 
 import mock
 
-from feaas import runners, storage
+from feaas import runners, storage, tracing
 from feaas.runners import instance_scalator
 
 
@@ -40,9 +42,24 @@ class InstanceScalatorTestCase(unittest.TestCase):
         scalator.scale_instance = mock.Mock()
         scalator.run()
         get_job.assert_called_once()
-        scalator.scale_instance.assert_called_with(instance, 2)
+        scalator.scale_instance.assert_called_with(instance, 2, job)
         strg.finish_scale_job.assert_called_with(job)
 
+    def test_run_continues_trace(self):
+        exporter = mock.Mock()
+        tracing.set_exporter(exporter)
+        self.addCleanup(tracing.set_exporter, None)
+        job = {"instance": "something", "quantity": 2, "trace_id": "abc123"}
+        scalator = instance_scalator.InstanceScalator(mock.Mock(storage=mock.Mock()),
+                                                      interval=3)
+        scalator.get_job = mock.Mock(return_value=(storage.Instance(name="something"), job))
+        scalator.scale_instance = mock.Mock()
+        scalator.run()
+        spans = dict([(c[0][0]["name"], c[0][0]) for c in exporter.export.call_args_list])
+        self.assertEqual("abc123", spans["instance_scalator.scale"]["trace_id"])
+        self.assertEqual({"instance": "something", "quantity": 2},
+                         spans["instance_scalator.scale"]["attributes"])
+
     def test_run_no_job(self):
         get_job = mock.Mock()
         get_job.return_value = None, None
@@ -56,14 +73,15 @@ class InstanceScalatorTestCase(unittest.TestCase):
 
     def test_run_instance_not_found(self):
         get_job = mock.Mock()
-        get_job.side_effect = storage.InstanceNotFoundError()
+        get_job.side_effect = [storage.InstanceNotFoundError(), (None, None)]
         strg = mock.Mock()
         manager = mock.Mock(storage=strg)
         scalator = instance_scalator.InstanceScalator(manager, interval=3)
         scalator.get_job = get_job
         scalator.scale_instance = mock.Mock()
         scalator.run()
-        scalator.scale_instance.assert_not_called()
+        self.assertFalse(scalator.scale_instance.called)
+        self.assertEqual(2, get_job.call_count)
 
     def test_get_job(self):
         instance = storage.Instance(name="something", state="started")
@@ -82,9 +100,95 @@ class InstanceScalatorTestCase(unittest.TestCase):
         strg.get_scale_job.assert_called_once()
         strg.retrieve_instance.assert_called_with(name="something",
                                                   check_liveness=True)
-        strg.store_instance.assert_called_with(got_instance)
+        strg.transition_instance.assert_called_once_with(
+            "something", "started", state="scaling",
+            lease_expires_at=got_instance.lease_expires_at)
+        self.assertFalse(strg.store_instance.called)
         scalator.locker.unlock.assert_called_with(scalator.lock_name)
 
+    def test_get_job_instance_claimed_by_another_replica(self):
+        instance = storage.Instance(name="something", state="started")
+        job = {"instance": "something", "quantity": 3}
+        strg = mock.Mock()
+        strg.get_scale_job.return_value = job
+        strg.retrieve_instance.return_value = instance
+        strg.transition_instance.return_value = False
+        manager = mock.Mock(storage=strg)
+        scalator = instance_scalator.InstanceScalator(manager, interval=3, sharded=True)
+        scalator.shard = mock.Mock()
+        scalator.shard.query.return_value = {"shard": {"$in": [3]}}
+        self.assertEqual((None, job), scalator.get_job())
+        strg.reset_scale_job.assert_called_once_with(job)
+        self.assertEqual({}, scalator.in_flight)
+
+    @mock.patch("feaas.runners.lease_expiration")
+    def test_get_job_sharded(self, lease_expiration):
+        lease_expiration.return_value = datetime.datetime(2015, 3, 10, 12, 15)
+        instance = storage.Instance(name="something", state="started")
+        job = {"instance": "something", "quantity": 3}
+        strg = mock.Mock()
+        strg.get_scale_job.return_value = job
+        strg.retrieve_instance.return_value = instance
+        manager = mock.Mock(storage=strg)
+        scalator = instance_scalator.InstanceScalator(manager, interval=3, sharded=True)
+        self.assertEqual(scalator.lock_name, scalator.shard.group)
+        scalator.shard = mock.Mock()
+        scalator.shard.query.return_value = {"shard": {"$in": [3, 4]}}
+        scalator.locker = mock.Mock()
+        got_instance, got_job = scalator.get_job()
+        self.assertEqual(job, got_job)
+        self.assertFalse(scalator.locker.lock.called)
+        self.assertFalse(scalator.locker.unlock.called)
+        strg.get_scale_job.assert_called_once_with(
+            lease_expires_at=datetime.datetime(2015, 3, 10, 12, 15),
+            sort=storage.PRIORITY_SORT, shard={"$in": [3, 4]})
+        self.assertEqual(datetime.datetime(2015, 3, 10, 12, 15), got_instance.lease_expires_at)
+
+    def test_get_job_tracks_in_flight_instance(self):
+        instance = storage.Instance(name="something", state="started")
+        job = {"instance": "something", "quantity": 3}
+        strg = mock.Mock()
+        strg.get_scale_job.return_value = job
+        strg.retrieve_instance.return_value = instance
+        manager = mock.Mock(storage=strg)
+        scalator = instance_scalator.InstanceScalator(manager, interval=3)
+        scalator.locker = mock.Mock()
+        scalator.get_job()
+        self.assertEqual({"something": (instance, job)}, scalator.in_flight)
+        scalator.scale_instance = mock.Mock()
+        scalator.get_job = mock.Mock(return_value=(instance, job))
+        scalator.run()
+        self.assertEqual({}, scalator.in_flight)
+
+    def test_checkpoint(self):
+        instance = storage.Instance(name="something", state="scaling")
+        job = {"instance": "something", "quantity": 3, "state": "processing"}
+        strg = mock.Mock()
+        manager = mock.Mock(storage=strg)
+        scalator = instance_scalator.InstanceScalator(manager, interval=3)
+        scalator.in_flight = {"something": (instance, job)}
+        scalator.checkpoint()
+        self.assertEqual("started", instance.state)
+        strg.store_instance.assert_called_with(instance, save_units=False)
+        strg.reset_scale_job.assert_called_with(job)
+
+    def test_run_concurrently_stopped(self):
+        strg = mock.Mock()
+        manager = mock.Mock(storage=strg)
+        scalator = instance_scalator.InstanceScalator(manager, interval=3, concurrency=2)
+        scalator.get_job = mock.Mock()
+        scalator.stop()
+        scalator.run()
+        self.assertFalse(scalator.get_job.called)
+
+    def test_drain(self):
+        manager = mock.Mock(storage=mock.Mock())
+        scalator = instance_scalator.InstanceScalator(manager, interval=3, concurrency=2)
+        scalator.workers = [mock.Mock(), mock.Mock()]
+        scalator.drain()
+        for worker in scalator.workers:
+            self.assertEqual(1, worker.join.call_count)
+
     def test_get_job_instance_not_started(self):
         instance = storage.Instance(name="something", state="scaling")
         job = {"instance": "something", "quantity": 3}
@@ -96,13 +200,64 @@ class InstanceScalatorTestCase(unittest.TestCase):
         scalator.locker = mock.Mock()
         got_instance, got_job = scalator.get_job()
         self.assertIsNone(got_instance)
-        self.assertIsNone(got_job)
+        self.assertEqual(job, got_job)
         scalator.locker.lock.assert_called_with(scalator.lock_name)
         strg.retrieve_instance.assert_called_with(name="something",
                                                   check_liveness=True)
+        self.assertFalse(strg.transition_instance.called)
         strg.reset_scale_job.assert_called_with(job)
         scalator.locker.unlock.assert_called_with(scalator.lock_name)
 
+    def test_get_job_instance_in_terminal_state(self):
+        for state in instance_scalator.TERMINAL_STATES:
+            job = {"instance": "something", "quantity": 3}
+            strg = mock.Mock()
+            strg.get_scale_job.return_value = job
+            strg.retrieve_instance.return_value = storage.Instance(name="something",
+                                                                   state=state)
+            manager = mock.Mock(storage=strg)
+            scalator = instance_scalator.InstanceScalator(manager, interval=3)
+            scalator.locker = mock.Mock()
+            self.assertEqual((None, job), scalator.get_job())
+            strg.finish_scale_job.assert_called_once_with(job)
+            self.assertFalse(strg.reset_scale_job.called)
+
+    def test_get_job_skips_tried_instances(self):
+        job = {"instance": "something", "quantity": 3}
+        strg = mock.Mock()
+        strg.get_scale_job.return_value = job
+        strg.retrieve_instance.return_value = storage.Instance(name="something",
+                                                               state="creating")
+        manager = mock.Mock(storage=strg)
+        scalator = instance_scalator.InstanceScalator(manager, interval=3)
+        scalator.locker = mock.Mock()
+        tried = set(["other"])
+        scalator.get_job(tried)
+        self.assertEqual(set(["other", "something"]), tried)
+        _, kwargs = strg.get_scale_job.call_args
+        self.assertEqual({"$nin": ["other"]}, kwargs["instance"])
+
+    def test_run_blocked_job_ahead_of_runnable_one(self):
+        strg = storage.MemoryStorage()
+        strg.store_instance(storage.Instance(name="broken", state="error"))
+        strg.store_instance(storage.Instance(name="waiting", state="creating"))
+        strg.store_instance(storage.Instance(name="ready", state="started"))
+        for name in ("broken", "waiting", "ready"):
+            strg.store_scale_job({"instance": name, "quantity": 2})
+        for concurrency in (1, 4):
+            manager = mock.Mock(storage=strg)
+            scalator = instance_scalator.InstanceScalator(manager, interval=3,
+                                                          concurrency=concurrency)
+            scalator.run()
+            scalator.drain()
+            self.assertEqual(1, manager.physical_scale.call_count)
+            self.assertEqual("ready", manager.physical_scale.call_args[0][0].name)
+            strg.store_scale_job({"instance": "ready", "quantity": 3})
+        states = dict([(j["instance"], j["state"]) for j in strg.retrieve_scale_jobs()
+                       if j["state"] != "done"])
+        self.assertEqual({"waiting": "pending", "ready": "pending"}, states)
+        self.assertEqual("started", strg.retrieve_instance(name="ready").state)
+
     def test_get_job_instance_not_found(self):
         job = {"instance": "something", "quantity": 3}
         strg = mock.Mock()
@@ -161,3 +316,85 @@ class InstanceScalatorTestCase(unittest.TestCase):
         scalator.locker.lock.assert_called_with(lock_name)
         strg.store_instance.assert_called_with(instance, save_units=False)
         scalator.locker.unlock.assert_called_with(lock_name)
+
+    def test_run_concurrently(self):
+        jobs = [(storage.Instance(name="one"), {"instance": "one", "quantity": 2}),
+                (storage.Instance(name="two"), {"instance": "two", "quantity": 5})]
+        manager = mock.Mock(storage=mock.Mock())
+        scalator = instance_scalator.InstanceScalator(manager, interval=3, concurrency=3)
+        scalator.get_job = mock.Mock(side_effect=jobs + [(None, None)])
+        scalator.run_job = mock.Mock(side_effect=lambda i, j: scalator.slots.release())
+        scalator.run()
+        for worker in scalator.workers:
+            worker.join()
+        self.assertEqual(3, scalator.get_job.call_count)
+        expected_calls = [mock.call(*jobs[0]), mock.call(*jobs[1])]
+        self.assertEqual(expected_calls, scalator.run_job.call_args_list)
+
+    def test_run_concurrently_respects_concurrency(self):
+        manager = mock.Mock(storage=mock.Mock())
+        scalator = instance_scalator.InstanceScalator(manager, interval=3, concurrency=2)
+        release = threading.Event()
+        scalator.get_job = mock.Mock(return_value=(storage.Instance(name="one"),
+                                                   {"instance": "one", "quantity": 2}))
+
+        def run_job(instance, job):
+            release.wait()
+            scalator.slots.release()
+        scalator.run_job = mock.Mock(side_effect=run_job)
+        scalator.run()
+        self.assertEqual(2, scalator.get_job.call_count)
+        release.set()
+        for worker in scalator.workers:
+            worker.join()
+
+    def test_run_concurrently_instance_not_found(self):
+        manager = mock.Mock(storage=mock.Mock())
+        scalator = instance_scalator.InstanceScalator(manager, interval=3, concurrency=2)
+        scalator.get_job = mock.Mock(side_effect=[storage.InstanceNotFoundError(),
+                                                  (None, None)])
+        scalator.run_job = mock.Mock()
+        scalator.run()
+        self.assertEqual(2, scalator.get_job.call_count)
+        self.assertFalse(scalator.run_job.called)
+
+    def test_run_job(self):
+        instance, job = storage.Instance(name="one"), {"instance": "one", "quantity": 2}
+        strg = mock.Mock()
+        manager = mock.Mock(storage=strg)
+        scalator = instance_scalator.InstanceScalator(manager, interval=3, concurrency=2)
+        scalator.scale_instance = mock.Mock()
+        scalator.slots.acquire()
+        scalator.run_job(instance, job)
+        scalator.scale_instance.assert_called_with(instance, 2, job)
+        strg.finish_scale_job.assert_called_with(job)
+        self.assertTrue(scalator.slots.acquire(False))
+        self.assertTrue(scalator.slots.acquire(False))
+
+    @mock.patch("sys.stderr")
+    def test_run_job_failure(self, stderr):
+        instance, job = storage.Instance(name="one"), {"instance": "one", "quantity": 2}
+        strg = mock.Mock()
+        manager = mock.Mock(storage=strg)
+        scalator = instance_scalator.InstanceScalator(manager, interval=3, concurrency=2)
+        scalator.scale_instance = mock.Mock(side_effect=ValueError("no capacity"))
+        scalator.slots.acquire()
+        scalator.run_job(instance, job)
+        self.assertFalse(strg.finish_scale_job.called)
+        strg.reset_scale_job.assert_called_once_with(job)
+        stderr.write.assert_called_with("[ERROR] failed to scale instance one: no capacity\n")
+        self.assertTrue(scalator.slots.acquire(False))
+
+    @mock.patch("sys.stderr")
+    def test_run_job_failure_reset_failure(self, stderr):
+        instance, job = storage.Instance(name="one"), {"instance": "one", "quantity": 2}
+        strg = mock.Mock()
+        strg.reset_scale_job.side_effect = ValueError("database is gone")
+        manager = mock.Mock(storage=strg)
+        scalator = instance_scalator.InstanceScalator(manager, interval=3, concurrency=2)
+        scalator.scale_instance = mock.Mock(side_effect=ValueError("no capacity"))
+        scalator.slots.acquire()
+        scalator.run_job(instance, job)
+        msg = "[ERROR] failed to reset scale job of instance one: database is gone\n"
+        stderr.write.assert_called_with(msg)
+        self.assertTrue(scalator.slots.acquire(False))
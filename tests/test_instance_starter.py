@@ -2,10 +2,12 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
 import threading
 import time
 import unittest
 
+import freezegun
 import mock
 
 from feaas import storage
@@ -57,7 +59,52 @@ class InstanceStarterTestCase(unittest.TestCase):
         starter.run()
         starter.start_instance.assert_not_called()
 
-    def test_get_instance(self):
+    def test_run_tracks_in_flight_instance(self):
+        instance = storage.Instance(name="something")
+        manager = mock.Mock(storage=mock.Mock())
+        starter = instance_starter.InstanceStarter(manager, interval=3)
+        starter.get_instance = mock.Mock(return_value=instance)
+        in_flight = []
+        starter.start_instance = lambda instance: in_flight.append(starter.in_flight)
+        starter.run()
+        self.assertEqual([instance], in_flight)
+        self.assertIsNone(starter.in_flight)
+
+    def test_checkpoint(self):
+        instance = storage.Instance(name="something", state="starting")
+        strg = mock.Mock()
+        strg.retrieve_instance.return_value = storage.Instance(name="something")
+        manager = mock.Mock(storage=strg)
+        starter = instance_starter.InstanceStarter(manager, interval=3)
+        starter.in_flight = instance
+        starter.checkpoint()
+        strg.retrieve_instance.assert_called_with(name="something")
+        self.assertEqual("creating", instance.state)
+        strg.store_instance.assert_called_with(instance, save_units=False)
+
+    def test_checkpoint_units_already_created(self):
+        instance = storage.Instance(name="something", state="starting")
+        strg = mock.Mock()
+        strg.retrieve_instance.return_value = storage.Instance(
+            name="something", units=[storage.Unit(id="i-0800")])
+        manager = mock.Mock(storage=strg)
+        starter = instance_starter.InstanceStarter(manager, interval=3)
+        starter.in_flight = instance
+        starter.checkpoint()
+        self.assertEqual("started", instance.state)
+        strg.store_instance.assert_called_with(instance, save_units=False)
+
+    def test_checkpoint_nothing_in_flight(self):
+        strg = mock.Mock()
+        manager = mock.Mock(storage=strg)
+        starter = instance_starter.InstanceStarter(manager, interval=3)
+        starter.checkpoint()
+        self.assertFalse(strg.store_instance.called)
+
+    @freezegun.freeze_time("2015-03-10 12:00:00")
+    @mock.patch("feaas.runners.lease_expiration")
+    def test_get_instance(self, lease_expiration):
+        lease_expiration.return_value = datetime.datetime(2015, 3, 10, 12, 15)
         instance = storage.Instance(name="something")
         strg = mock.Mock()
         strg.retrieve_instance.return_value = instance
@@ -67,7 +114,11 @@ class InstanceStarterTestCase(unittest.TestCase):
         got_instance = starter.get_instance()
         self.assertEqual(instance, got_instance)
         self.assertEqual("starting", got_instance.state)
-        strg.retrieve_instance.assert_called_with(state="creating")
+        self.assertEqual(datetime.datetime(2015, 3, 10, 12, 15), got_instance.lease_expires_at)
+        now = datetime.datetime(2015, 3, 10, 12, 0)
+        due = {"$or": [{"next_attempt_at": None}, {"next_attempt_at": {"$lte": now}}]}
+        strg.retrieve_instance.assert_called_with(state="creating",
+                                                  sort=storage.PRIORITY_SORT, **due)
         strg.store_instance.assert_called_with(instance)
         starter.locker.lock.assert_called_with(starter.lock_name)
         starter.locker.unlock.assert_called_with(starter.lock_name)
@@ -84,18 +135,25 @@ class InstanceStarterTestCase(unittest.TestCase):
         starter.locker.unlock.assert_called_with(starter.lock_name)
 
     def test_start_instance(self):
-        instance = storage.Instance(name="something")
+        instance = storage.Instance(name="something", attempts=2, last_error="wat",
+                                    next_attempt_at=datetime.datetime(2015, 3, 10, 12, 1),
+                                    lease_expires_at=datetime.datetime(2015, 3, 10, 12, 15))
         strg = mock.Mock()
         manager = mock.Mock(storage=strg)
         starter = instance_starter.InstanceStarter(manager, interval=3)
         starter.locker = mock.Mock()
         starter.start_instance(instance)
         self.assertEqual("started", instance.state)
+        self.assertIsNone(instance.lease_expires_at)
+        self.assertEqual(0, instance.attempts)
+        self.assertIsNone(instance.last_error)
+        self.assertIsNone(instance.next_attempt_at)
         starter.locker.lock.assert_called_with(starter.lock_name)
         manager.start_instance.assert_called_with(instance.name)
         starter.locker.unlock.assert_called_with(starter.lock_name)
         strg.store_instance.assert_called_with(instance, save_units=False)
 
+    @freezegun.freeze_time("2015-03-10 12:00:00")
     @mock.patch("sys.stderr")
     def test_start_instance_error(self, stderr):
         instance = storage.Instance(name="something")
@@ -105,7 +163,10 @@ class InstanceStarterTestCase(unittest.TestCase):
         starter = instance_starter.InstanceStarter(manager, interval=3)
         starter.locker = mock.Mock()
         starter.start_instance(instance)
-        self.assertEqual("error", instance.state)
+        self.assertEqual("creating", instance.state)
+        self.assertEqual(1, instance.attempts)
+        self.assertEqual("something went wrong", instance.last_error)
+        self.assertEqual(datetime.datetime(2015, 3, 10, 12, 0, 30), instance.next_attempt_at)
         starter.locker.lock.assert_called_with(starter.lock_name)
         starter.locker.unlock.assert_called_with(starter.lock_name)
         strg.store_instance.assert_called_with(instance, save_units=False)
@@ -2,6 +2,7 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
 import threading
 import time
 import unittest
@@ -57,7 +58,30 @@ class InstanceTerminatorTestCase(unittest.TestCase):
         terminator.run()
         terminator.terminate_instance.assert_not_called()
 
-    def test_get_instance(self):
+    def test_checkpoint(self):
+        instance = storage.Instance(name="something", state="terminating")
+        strg = mock.Mock()
+        manager = mock.Mock(storage=strg)
+        terminator = instance_terminator.InstanceTerminator(manager, interval=3)
+        terminator.in_flight = instance
+        terminator.checkpoint()
+        strg.retrieve_instance.assert_called_with(name="something")
+        self.assertEqual("removed", instance.state)
+        strg.store_instance.assert_called_with(instance, save_units=False)
+
+    def test_checkpoint_instance_already_removed(self):
+        instance = storage.Instance(name="something", state="terminating")
+        strg = mock.Mock()
+        strg.retrieve_instance.side_effect = storage.InstanceNotFoundError()
+        manager = mock.Mock(storage=strg)
+        terminator = instance_terminator.InstanceTerminator(manager, interval=3)
+        terminator.in_flight = instance
+        terminator.checkpoint()
+        self.assertFalse(strg.store_instance.called)
+
+    @mock.patch("feaas.runners.lease_expiration")
+    def test_get_instance(self, lease_expiration):
+        lease_expiration.return_value = datetime.datetime(2015, 3, 10, 12, 15)
         instance = storage.Instance(name="something")
         strg = mock.Mock()
         strg.retrieve_instance.return_value = instance
@@ -67,6 +91,7 @@ class InstanceTerminatorTestCase(unittest.TestCase):
         got_instance = terminator.get_instance()
         self.assertEqual(instance, got_instance)
         self.assertEqual("terminating", got_instance.state)
+        self.assertEqual(datetime.datetime(2015, 3, 10, 12, 15), got_instance.lease_expires_at)
         strg.retrieve_instance.assert_called_with(state="removed")
         strg.store_instance.assert_called_with(instance)
         terminator.locker.lock.assert_called_with(terminator.lock_name)
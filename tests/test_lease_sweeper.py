@@ -0,0 +1,27 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+
+from feaas import runners
+from feaas.runners import lease_sweeper
+
+
+class LeaseSweeperTestCase(unittest.TestCase):
+
+    def test_init(self):
+        manager = mock.Mock(storage=mock.Mock())
+        sweeper = lease_sweeper.LeaseSweeper(manager, interval=3)
+        self.assertIsInstance(sweeper, runners.Base)
+        self.assertEqual(manager.storage, sweeper.storage)
+        self.assertEqual(3, sweeper.interval)
+
+    def test_run(self):
+        strg = mock.Mock()
+        strg.release_expired_leases.return_value = {"starting": 2}
+        sweeper = lease_sweeper.LeaseSweeper(mock.Mock(storage=strg))
+        self.assertEqual({"starting": 2}, sweeper.run())
+        strg.release_expired_leases.assert_called_once_with()
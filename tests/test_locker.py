@@ -66,6 +66,20 @@ class MultiLockerTestCase(unittest.TestCase):
         self.assertEqual("test_lock", lock["_id"])
         self.assertEqual(1, lock["state"])
 
+    def test_release_all(self):
+        self.locker.init("test_lock1")
+        self.locker.init("test_lock2")
+        self.addCleanup(self.client.feaas_test.multi_locker.remove,
+                        {"_id": {"$in": ["test_lock1", "test_lock2"]}})
+        self.locker.lock("test_lock1")
+        self.locker.lock("test_lock2")
+        self.locker.unlock("test_lock2")
+        self.assertEqual(set(["test_lock1"]), self.locker.held)
+        self.locker.release_all()
+        self.assertEqual(set(), self.locker.held)
+        states = [l["state"] for l in self.client.feaas_test.multi_locker.find()]
+        self.assertEqual([0, 0], states)
+
     def test_double_lock(self):
         self.locker.init("test_lock")
         self.addCleanup(self.client.feaas_test.multi_locker.remove, {"_id": "test_lock"})
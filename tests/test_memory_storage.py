@@ -0,0 +1,118 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import threading
+import time
+import unittest
+
+from feaas import storage
+
+
+class CollectionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = storage._Collection(iter(range(1, 100)), ["state"])
+        for i, state in enumerate(["started", "creating", "started", "removed"]):
+            self.collection.insert({"name": "i{}".format(i), "state": state,
+                                    "priority": i % 2 or None})
+
+    def names(self, docs):
+        return [d["name"] for d in docs]
+
+    def test_find_indexed(self):
+        docs = self.collection.find({"state": "started"})
+        self.assertEqual(["i0", "i2"], self.names(docs))
+        docs = self.collection.find({"state": {"$in": ["creating", "removed"]}})
+        self.assertEqual(["i1", "i3"], self.names(docs))
+
+    def test_find_operators(self):
+        docs = self.collection.find({"state": {"$nin": ["started"]}, "name": {"$gte": "i2"}})
+        self.assertEqual(["i3"], self.names(docs))
+        docs = self.collection.find({"$or": [{"name": "i0"}, {"priority": 1}]})
+        self.assertEqual(["i0", "i1", "i3"], self.names(docs))
+        docs = self.collection.find({"priority": None})
+        self.assertEqual(["i0", "i2"], self.names(docs))
+
+    def test_find_sort_and_limit(self):
+        docs = self.collection.find(sort=storage.PRIORITY_SORT)
+        self.assertEqual(["i1", "i3", "i0", "i2"], self.names(docs))
+        docs = self.collection.find(sort=[("name", -1)], limit=2)
+        self.assertEqual(["i3", "i2"], self.names(docs))
+
+    def test_update_reindexes(self):
+        doc = self.collection.find_one({"name": "i1"})
+        self.collection.update(doc, {"state": "started"})
+        self.assertEqual(["i0", "i1", "i2"],
+                         self.names(self.collection.find({"state": "started"})))
+        self.assertNotIn("creating", self.collection.indexes["state"])
+
+    def test_remove(self):
+        self.assertEqual(2, self.collection.remove({"state": "started"}))
+        self.assertEqual(["i1", "i3"], self.names(self.collection.find()))
+        self.assertNotIn("started", self.collection.indexes["state"])
+
+
+class MemoryStorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = storage.MemoryStorage()
+
+    def test_store_instance_replaces_document(self):
+        instance = storage.Instance(name="years", state="started")
+        self.storage.store_instance(instance)
+        instance.state = "removed"
+        self.storage.store_instance(instance, save_units=False)
+        self.assertEqual(1, len(self.storage.instances.docs))
+        self.assertEqual({"removed": set([1])}, self.storage.instances.indexes["state"])
+
+    def test_returns_copies(self):
+        job = {"instance": "years", "quantity": 2}
+        self.storage.store_scale_job(job)
+        job["quantity"] = 10
+        self.assertEqual(2, self.storage.retrieve_scale_jobs()[0]["quantity"])
+        self.storage.retrieve_scale_jobs()[0]["quantity"] = 10
+        self.assertEqual(2, self.storage.retrieve_scale_jobs()[0]["quantity"])
+
+
+class MemoryLockerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = storage.MemoryStorage()
+        self.locker = storage.new_locker(self.storage)
+        self.locker.init("lock")
+
+    def test_new_locker(self):
+        self.assertIsInstance(self.locker, storage.MemoryLocker)
+
+    def test_lock_blocks_other_lockers(self):
+        other = storage.MemoryLocker(self.storage)
+        acquired = []
+        self.locker.lock("lock")
+
+        def lock():
+            other.lock("lock")
+            acquired.append(time.time())
+            other.unlock("lock")
+
+        t = threading.Thread(target=lock)
+        t.start()
+        time.sleep(0.05)
+        self.assertEqual([], acquired)
+        self.locker.unlock("lock")
+        t.join(1)
+        self.assertEqual(1, len(acquired))
+
+    def test_double_unlock(self):
+        self.locker.lock("lock")
+        self.locker.unlock("lock")
+        with self.assertRaises(storage.DoubleUnlockError):
+            self.locker.unlock("lock")
+
+    def test_release_all(self):
+        self.locker.init("other")
+        self.locker.lock("lock")
+        self.locker.lock("other")
+        self.locker.release_all()
+        self.assertEqual({"lock": 0, "other": 0}, self.storage.locks)
+        self.assertEqual(set(), self.locker.held)
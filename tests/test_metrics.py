@@ -0,0 +1,183 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+import urllib2
+
+import mock
+
+from feaas import metrics
+
+
+class CounterTestCase(unittest.TestCase):
+
+    def test_inc(self):
+        counter = metrics.Counter("feaas_things_total", "Things.", ["kind"])
+        counter.inc(kind="a")
+        counter.inc(2, kind="a")
+        counter.inc(kind="b")
+        self.assertEqual(3, counter.get(kind="a"))
+        self.assertEqual(1, counter.get(kind="b"))
+        self.assertEqual(0, counter.get(kind="c"))
+
+    def test_inc_wrong_labels(self):
+        counter = metrics.Counter("feaas_things_total", "Things.", ["kind"])
+        with self.assertRaises(ValueError):
+            counter.inc(other="a")
+
+    def test_render(self):
+        counter = metrics.Counter("feaas_things_total", "Things.", ["kind"])
+        counter.inc(kind='say "wat"')
+        expected = [u"# HELP feaas_things_total Things.",
+                    u"# TYPE feaas_things_total counter",
+                    u'feaas_things_total{kind="say \\"wat\\""} 1']
+        self.assertEqual(expected, counter.render())
+
+
+class HistogramTestCase(unittest.TestCase):
+
+    def test_observe(self):
+        histogram = metrics.Histogram("feaas_duration_seconds", "Duration.", ["op"],
+                                      buckets=[0.1, 1])
+        histogram.observe(0.05, op="a")
+        histogram.observe(0.5, op="a")
+        histogram.observe(5, op="a")
+        sample = histogram.get(op="a")
+        self.assertEqual([1, 2, 3], sample["buckets"])
+        self.assertEqual(3, sample["count"])
+        self.assertAlmostEqual(5.55, sample["sum"])
+
+    def test_render(self):
+        histogram = metrics.Histogram("feaas_duration_seconds", "Duration.", ["op"],
+                                      buckets=[0.1, 1])
+        histogram.observe(0.5, op="a")
+        expected = [u"# HELP feaas_duration_seconds Duration.",
+                    u"# TYPE feaas_duration_seconds histogram",
+                    u'feaas_duration_seconds_bucket{op="a",le="0.1"} 0',
+                    u'feaas_duration_seconds_bucket{op="a",le="1"} 1',
+                    u'feaas_duration_seconds_bucket{op="a",le="+Inf"} 1',
+                    u'feaas_duration_seconds_sum{op="a"} 0.5',
+                    u'feaas_duration_seconds_count{op="a"} 1']
+        self.assertEqual(expected, histogram.render())
+
+    @mock.patch("time.time")
+    def test_time(self, time):
+        time.side_effect = [10, 12.5]
+        histogram = metrics.Histogram("feaas_duration_seconds", "Duration.", ["op"])
+        with histogram.time(op="a"):
+            pass
+        self.assertEqual(2.5, histogram.get(op="a")["sum"])
+
+
+class RegistryTestCase(unittest.TestCase):
+
+    def test_register_returns_existing(self):
+        registry = metrics.Registry()
+        counter = registry.register(metrics.Counter("feaas_things_total", "Things."))
+        other = registry.register(metrics.Counter("feaas_things_total", "Things."))
+        self.assertIs(counter, other)
+
+    def test_register_conflicting_kind(self):
+        registry = metrics.Registry()
+        registry.register(metrics.Counter("feaas_things", "Things."))
+        with self.assertRaises(ValueError):
+            registry.register(metrics.Gauge("feaas_things", "Things."))
+
+    def test_render_runs_collectors(self):
+        registry = metrics.Registry()
+        gauge = registry.register(metrics.Gauge("feaas_things", "Things."))
+        registry.add_collector(lambda: gauge.set(4))
+        expected = u"# HELP feaas_things Things.\n# TYPE feaas_things gauge\nfeaas_things 4\n"
+        self.assertEqual(expected, registry.render())
+
+
+class InstrumentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.histogram = metrics.Histogram("feaas_duration_seconds", "Duration.", ["operation"])
+        self.errors = metrics.Counter("feaas_errors_total", "Errors.", ["operation"])
+
+    def test_instrument_methods(self):
+        class Thing(object):
+            def do(self, value):
+                return value * 2
+
+            def fail(self):
+                raise ValueError("wat")
+
+            def _private(self):
+                pass
+
+        metrics.instrument_methods(Thing, self.histogram, self.errors)
+        self.assertEqual(4, Thing().do(2))
+        with self.assertRaises(ValueError):
+            Thing().fail()
+        Thing()._private()
+        self.assertEqual(1, self.histogram.get(operation="do")["count"])
+        self.assertEqual(1, self.histogram.get(operation="fail")["count"])
+        self.assertEqual(0, self.histogram.get(operation="_private")["count"])
+        self.assertEqual(0, self.errors.get(operation="do"))
+        self.assertEqual(1, self.errors.get(operation="fail"))
+        self.assertEqual("do", Thing.do.__name__)
+
+    def test_instrument_methods_by_name(self):
+        class Thing(object):
+            def do(self):
+                pass
+
+            def skip(self):
+                pass
+
+        metrics.instrument_methods(Thing, self.histogram, self.errors, ["do", "missing"])
+        Thing().do()
+        Thing().skip()
+        self.assertEqual(1, self.histogram.get(operation="do")["count"])
+        self.assertEqual(0, self.histogram.get(operation="skip")["count"])
+
+
+class QueueDepthsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = mock.Mock()
+        self.storage.queue_depths.return_value = {
+            "instances": {"creating": 3, "started": 10},
+            "scale_jobs": 2, "binds": 1, "units": 4,
+        }
+
+    @mock.patch("time.time")
+    def test_collect(self, time):
+        time.return_value = 100
+        depths = metrics.QueueDepths(self.storage, ttl=15)
+        depths()
+        self.assertEqual(3, metrics.queue_depth.get(queue="instances", state="creating"))
+        self.assertEqual(10, metrics.queue_depth.get(queue="instances", state="started"))
+        self.assertEqual(2, metrics.queue_depth.get(queue="scale_jobs", state="pending"))
+        self.assertEqual(1, metrics.queue_depth.get(queue="binds", state="creating"))
+        self.assertEqual(4, metrics.queue_depth.get(queue="units", state="creating"))
+
+    @mock.patch("time.time")
+    def test_collect_is_cached(self, time):
+        time.return_value = 100
+        depths = metrics.QueueDepths(self.storage, ttl=15)
+        depths()
+        time.return_value = 110
+        depths()
+        self.assertEqual(1, self.storage.queue_depths.call_count)
+        time.return_value = 116
+        depths()
+        self.assertEqual(2, self.storage.queue_depths.call_count)
+
+
+class ServeTestCase(unittest.TestCase):
+
+    def test_serve(self):
+        server = metrics.serve(0, host="127.0.0.1")
+        self.addCleanup(server.shutdown)
+        url = "http://127.0.0.1:{}".format(server.server_address[1])
+        resp = urllib2.urlopen(url + "/metrics")
+        self.assertEqual(metrics.CONTENT_TYPE, resp.info()["Content-Type"])
+        self.assertIn("# TYPE feaas_runner_tick_duration_seconds histogram", resp.read())
+        with self.assertRaises(urllib2.HTTPError) as cm:
+            urllib2.urlopen(url + "/wat")
+        self.assertEqual(404, cm.exception.code)
@@ -0,0 +1,143 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import unittest
+
+import freezegun
+import mock
+
+from feaas import runners, storage
+from feaas.runners import pool_replenisher
+
+
+class PoolReplenisherTestCase(unittest.TestCase):
+
+    def test_inherits_from_base_runner(self):
+        manager = mock.Mock(storage=mock.Mock())
+        replenisher = pool_replenisher.PoolReplenisher(manager, interval=3, size=2)
+        self.assertIsInstance(replenisher, runners.Base)
+        self.assertEqual(2, replenisher.size)
+
+    def test_run(self):
+        manager = mock.Mock(storage=mock.Mock())
+        replenisher = pool_replenisher.PoolReplenisher(manager, interval=3, size=2)
+        replenisher.locker = mock.Mock()
+        replenisher.probe_units = mock.Mock()
+        replenisher.expire_units = mock.Mock()
+        replenisher.fill = mock.Mock()
+        replenisher.run()
+        replenisher.locker.lock.assert_called_with(replenisher.lock_name)
+        self.assertEqual(1, replenisher.probe_units.call_count)
+        self.assertEqual(1, replenisher.expire_units.call_count)
+        self.assertEqual(1, replenisher.fill.call_count)
+        replenisher.locker.unlock.assert_called_with(replenisher.lock_name)
+
+    @mock.patch("feaas.runners.is_unit_up")
+    def test_probe_units(self, is_unit_up):
+        units = [storage.Unit(id="i-0800", dns_name="unit1.cloud.tsuru.io"),
+                 storage.Unit(id="i-0801", dns_name="unit2.cloud.tsuru.io")]
+        is_unit_up.side_effect = lambda unit: unit == units[1]
+        strg = mock.Mock()
+        strg.retrieve_pool_units.return_value = units
+        manager = mock.Mock(storage=strg)
+        replenisher = pool_replenisher.PoolReplenisher(manager, interval=3, size=2)
+        replenisher.probe_units()
+        strg.retrieve_pool_units.assert_called_with(state="booting")
+        strg.update_pool_units.assert_called_with([units[1]], state="ready")
+
+    @freezegun.freeze_time("2015-03-11 10:00:00")
+    def test_expire_units(self):
+        units = [storage.Unit(id="i-0800"), storage.Unit(id="i-0801"),
+                 storage.Unit(id="i-0802")]
+        strg = mock.Mock()
+        strg.retrieve_pool_units.return_value = []
+        strg.expire_pool_unit.side_effect = units + [None]
+        manager = mock.Mock(storage=strg)
+        manager.destroy_units.return_value = []
+        replenisher = pool_replenisher.PoolReplenisher(manager, interval=3,
+                                                       batch_size=2)
+        replenisher.expire_units()
+        strg.retrieve_pool_units.assert_called_once_with(state="expiring", limit=2)
+        expected_call = mock.call(expires_at={"$lt": datetime.datetime(2015, 3, 11, 10)})
+        self.assertEqual([expected_call] * 4, strg.expire_pool_unit.call_args_list)
+        expected_calls = [mock.call(units[:2]), mock.call(units[2:])]
+        self.assertEqual(expected_calls, manager.destroy_units.call_args_list)
+        self.assertEqual(expected_calls, strg.remove_pool_units.call_args_list)
+        self.assertFalse(strg.update_pool_units.called)
+
+    def test_expire_units_retries_expiring_units(self):
+        left = [storage.Unit(id="i-0800", state="expiring")]
+        expired = storage.Unit(id="i-0801", state="expiring")
+        strg = mock.Mock()
+        strg.retrieve_pool_units.return_value = list(left)
+        strg.expire_pool_unit.side_effect = [expired, None]
+        manager = mock.Mock(storage=strg)
+        manager.destroy_units.return_value = []
+        replenisher = pool_replenisher.PoolReplenisher(manager, interval=3)
+        replenisher.expire_units()
+        manager.destroy_units.assert_called_once_with(left + [expired])
+        strg.remove_pool_units.assert_called_once_with(left + [expired])
+
+    @mock.patch("sys.stderr")
+    def test_expire_units_destroy_failure(self, stderr):
+        units = [storage.Unit(id="i-0800"), storage.Unit(id="i-0801"),
+                 storage.Unit(id="i-0802")]
+        strg = mock.Mock()
+        strg.retrieve_pool_units.return_value = []
+        strg.expire_pool_unit.side_effect = units + [None]
+        manager = mock.Mock(storage=strg)
+        manager.destroy_units.return_value = [storage.Unit(id="i-0801")]
+        replenisher = pool_replenisher.PoolReplenisher(manager, interval=3,
+                                                       batch_size=2)
+        replenisher.expire_units()
+        manager.destroy_units.assert_called_once_with(units[:2])
+        strg.remove_pool_units.assert_called_once_with([units[0]])
+        strg.update_pool_units.assert_called_once_with(manager.destroy_units.return_value,
+                                                       state="ready")
+        self.assertEqual(2, strg.expire_pool_unit.call_count)
+        msg = "[ERROR] failed to destroy 1 expired pool units, will retry\n"
+        stderr.write.assert_called_with(msg)
+
+    def test_expire_units_nothing_expired(self):
+        strg = mock.Mock()
+        strg.retrieve_pool_units.return_value = []
+        strg.expire_pool_unit.return_value = None
+        manager = mock.Mock(storage=strg)
+        replenisher = pool_replenisher.PoolReplenisher(manager, interval=3)
+        replenisher.expire_units()
+        self.assertFalse(manager.destroy_units.called)
+
+    def test_fill(self):
+        units = [storage.Unit(id="i-0800"), storage.Unit(id="i-0801")]
+        strg = mock.Mock()
+        strg.count_pool_units.return_value = 1
+        manager = mock.Mock(storage=strg)
+        manager.boot_unit.side_effect = units
+        replenisher = pool_replenisher.PoolReplenisher(manager, interval=3, size=3)
+        replenisher.fill()
+        self.assertEqual(2, manager.boot_unit.call_count)
+        expected_calls = [mock.call(units[0]), mock.call(units[1])]
+        self.assertEqual(expected_calls, strg.store_pool_unit.call_args_list)
+        self.assertEqual("booting", units[0].state)
+
+    def test_fill_full_pool(self):
+        strg = mock.Mock()
+        strg.count_pool_units.return_value = 3
+        manager = mock.Mock(storage=strg)
+        replenisher = pool_replenisher.PoolReplenisher(manager, interval=3, size=3)
+        replenisher.fill()
+        self.assertFalse(manager.boot_unit.called)
+
+    @mock.patch("sys.stderr")
+    def test_fill_boot_failure(self, stderr):
+        strg = mock.Mock()
+        strg.count_pool_units.return_value = 0
+        manager = mock.Mock(storage=strg)
+        manager.boot_unit.side_effect = ValueError("no capacity")
+        replenisher = pool_replenisher.PoolReplenisher(manager, interval=3, size=3)
+        replenisher.fill()
+        self.assertEqual(1, manager.boot_unit.call_count)
+        self.assertFalse(strg.store_pool_unit.called)
+        stderr.write.assert_called_with("[ERROR] failed to boot pool unit: no capacity\n")
@@ -0,0 +1,335 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import threading
+import unittest
+
+import mock
+
+from feaas import runners, storage
+from feaas.runners import reconciler
+
+
+class PlanTestCase(unittest.TestCase):
+
+    def test_diff_removed(self):
+        instance = storage.Instance(name="secret", state="removed",
+                                    units=[storage.Unit(id="i-0800")])
+        binds = [storage.Bind("myapp.cloud.tsuru.io", instance)]
+        plan = reconciler.Plan(instance, binds)
+        self.assertEqual(["terminate"], plan.diff())
+
+    def test_diff_creating(self):
+        instance = storage.Instance(name="secret", state="creating")
+        binds = [storage.Bind("myapp.cloud.tsuru.io", instance)]
+        plan = reconciler.Plan(instance, binds)
+        self.assertEqual(["start", "write_binds"], plan.diff())
+
+    def test_diff_removing_binds(self):
+        instance = storage.Instance(name="secret", state="started")
+        binds = [storage.Bind("myapp.cloud.tsuru.io", instance, state="removing")]
+        self.assertEqual(["remove_binds"], reconciler.Plan(instance, binds).diff())
+
+    def test_diff_creating_not_due(self):
+        next_attempt = datetime.datetime.utcnow() + datetime.timedelta(seconds=60)
+        instance = storage.Instance(name="secret", state="creating", attempts=1,
+                                    next_attempt_at=next_attempt)
+        self.assertEqual([], reconciler.Plan(instance).diff())
+
+    def test_diff_scale(self):
+        instance = storage.Instance(name="secret", state="started",
+                                    units=[storage.Unit(id="i-0800", state="started")])
+        plan = reconciler.Plan(instance, job={"instance": "secret", "quantity": 3})
+        self.assertEqual(["scale"], plan.diff())
+
+    def test_diff_scale_already_converged(self):
+        instance = storage.Instance(name="secret", state="started",
+                                    units=[storage.Unit(id="i-0800", state="started")])
+        plan = reconciler.Plan(instance, job={"instance": "secret", "quantity": 1})
+        self.assertEqual(["finish_job"], plan.diff())
+
+    def test_diff_scale_instance_not_started(self):
+        instance = storage.Instance(name="secret", state="starting")
+        plan = reconciler.Plan(instance, job={"instance": "secret", "quantity": 3})
+        self.assertEqual([], plan.diff())
+
+    def test_diff_units(self):
+        instance = storage.Instance(name="secret", state="started",
+                                    units=[storage.Unit(id="i-0800", state="started"),
+                                           storage.Unit(id="i-0801")])
+        binds = [storage.Bind("myapp.cloud.tsuru.io", instance, state="created")]
+        plan = reconciler.Plan(instance, binds)
+        self.assertEqual(["write_units"], plan.diff())
+
+    def test_diff_converged(self):
+        instance = storage.Instance(name="secret", state="started",
+                                    units=[storage.Unit(id="i-0800", state="started")])
+        binds = [storage.Bind("myapp.cloud.tsuru.io", instance, state="created")]
+        plan = reconciler.Plan(instance, binds)
+        self.assertEqual([], plan.diff())
+
+
+class ReconcilerTestCase(unittest.TestCase):
+
+    def get_reconciler(self, strg=None):
+        manager = mock.Mock(storage=strg or mock.Mock())
+        runner = reconciler.Reconciler(manager, interval=3, concurrency=2)
+        runner.locker = mock.Mock()
+        return runner
+
+    def test_inherits_from_base_runner(self):
+        runner = self.get_reconciler()
+        self.assertIsInstance(runner, runners.Base)
+        self.assertEqual(2, runner.concurrency)
+
+    def test_run(self):
+        runner = self.get_reconciler()
+        plans = [mock.Mock(), mock.Mock()]
+        runner.plan = mock.Mock(return_value=plans)
+        runner.reconcile = mock.Mock()
+        runner.run()
+        runner.drain()
+        runner.locker.lock.assert_called_with(runner.lock_name)
+        self.assertItemsEqual([mock.call(plans[0]), mock.call(plans[1])],
+                              runner.reconcile.call_args_list)
+        runner.locker.unlock.assert_called_with(runner.lock_name)
+
+    def test_run_releases_lock_before_reconciling(self):
+        runner = self.get_reconciler()
+        plan = reconciler.Plan(storage.Instance(name="secret"))
+        plan.actions = ["start"]
+        runner.plan = mock.Mock(return_value=[plan])
+        started = threading.Event()
+        release = threading.Event()
+
+        def start(plan):
+            started.set()
+            release.wait(2)
+        runner.start = start
+        runner.run()
+        self.assertTrue(started.wait(2))
+        runner.locker.unlock.assert_called_with(runner.lock_name)
+        self.assertEqual({"secret": plan}, runner.in_flight)
+        release.set()
+        runner.drain()
+        self.assertEqual({}, runner.in_flight)
+
+    def test_plan(self):
+        creating = storage.Instance(name="creating", state="creating")
+        scaling = storage.Instance(name="scaling", state="started",
+                                   units=[storage.Unit(id="i-0800", state="started")])
+        binding = storage.Instance(name="binding", state="started",
+                                   units=[storage.Unit(id="i-0801", state="started")])
+        job = {"instance": "scaling", "quantity": 2}
+        bind = storage.Bind("myapp.cloud.tsuru.io", storage.Instance(name="binding"))
+        strg = mock.Mock()
+        strg.retrieve_instances.side_effect = [[creating],
+                                               [creating, scaling, binding]]
+        strg.retrieve_scale_jobs.return_value = [job]
+        strg.retrieve_binds.side_effect = [[bind], [bind]]
+        strg.retrieve_units.return_value = []
+        runner = self.get_reconciler(strg)
+        plans = runner.plan()
+        self.assertEqual([creating, scaling, binding], [p.instance for p in plans])
+        self.assertEqual([["start"], ["scale"], ["write_binds"]],
+                         [p.actions for p in plans])
+        self.assertEqual(job, plans[1].job)
+        self.assertEqual([bind], plans[2].binds)
+        strg.retrieve_scale_jobs.assert_called_with(state="pending")
+        strg.retrieve_units.assert_called_with(state="creating")
+        calls = strg.retrieve_instances.call_args_list
+        self.assertEqual(mock.call(state={"$in": ["creating", "removed"]}), calls[0])
+        self.assertEqual(set(["creating", "scaling", "binding"]),
+                         set(calls[1][1]["name"]["$in"]))
+
+    def test_plan_skips_in_flight_instances(self):
+        creating = storage.Instance(name="creating", state="creating")
+        strg = mock.Mock()
+        strg.retrieve_instances.side_effect = [[creating, storage.Instance(name="busy")],
+                                               [creating]]
+        strg.retrieve_scale_jobs.return_value = []
+        strg.retrieve_binds.side_effect = [[], []]
+        strg.retrieve_units.return_value = []
+        runner = self.get_reconciler(strg)
+        runner.in_flight["busy"] = reconciler.Plan(storage.Instance(name="busy"))
+        plans = runner.plan()
+        self.assertEqual([creating], [p.instance for p in plans])
+        calls = strg.retrieve_instances.call_args_list
+        self.assertEqual(["creating"], calls[1][1]["name"]["$in"])
+
+    def test_plan_nothing_to_do(self):
+        strg = mock.Mock()
+        strg.retrieve_instances.return_value = []
+        strg.retrieve_scale_jobs.return_value = []
+        strg.retrieve_binds.return_value = []
+        strg.retrieve_units.return_value = []
+        runner = self.get_reconciler(strg)
+        self.assertEqual([], runner.plan())
+        self.assertEqual(1, strg.retrieve_instances.call_count)
+
+    @mock.patch("sys.stderr")
+    def test_reconcile_stops_on_failure(self, stderr):
+        runner = self.get_reconciler()
+        runner.start = mock.Mock(side_effect=ValueError("no capacity"))
+        runner.write_binds = mock.Mock()
+        plan = reconciler.Plan(storage.Instance(name="secret"))
+        plan.actions = ["start", "write_binds"]
+        runner.reconcile(plan)
+        runner.start.assert_called_with(plan)
+        self.assertFalse(runner.write_binds.called)
+        stderr.write.assert_called_with("[ERROR] failed to start instance secret: no capacity\n")
+
+    def test_reconcile_tracks_in_flight_plans(self):
+        runner = self.get_reconciler()
+        plan = reconciler.Plan(storage.Instance(name="secret"))
+        plan.actions = ["start"]
+        in_flight = []
+        runner.start = lambda p: in_flight.append(dict(runner.in_flight))
+        runner.reconcile(plan)
+        self.assertEqual([{"secret": plan}], in_flight)
+        self.assertEqual({}, runner.in_flight)
+
+    def test_checkpoint(self):
+        strg = mock.Mock()
+        strg.retrieve_instance.side_effect = lambda name: {
+            "starting1": storage.Instance(name="starting1", units=[storage.Unit(id="i-1")]),
+            "starting2": storage.Instance(name="starting2"),
+            "terminating": storage.Instance(name="terminating"),
+        }[name]
+        runner = self.get_reconciler(strg)
+        lease = datetime.datetime(2015, 3, 10, 12, 15)
+        job = {"instance": "scaling", "quantity": 3}
+        for name, state in [("starting1", "starting"), ("starting2", "starting"),
+                            ("scaling", "scaling"), ("terminating", "terminating"),
+                            ("binding", "started")]:
+            instance = storage.Instance(name=name, state=state, lease_expires_at=lease)
+            runner.in_flight[name] = reconciler.Plan(instance, job=job)
+        runner.checkpoint()
+        stored = dict([(c[0][0].name, (c[0][0].state, c[0][0].lease_expires_at))
+                       for c in strg.store_instance.call_args_list])
+        self.assertEqual({"starting1": ("started", None), "starting2": ("creating", None),
+                          "scaling": ("started", None), "terminating": ("removed", None)},
+                         stored)
+        strg.reset_scale_job.assert_called_once_with(job)
+
+    def test_checkpoint_terminated_instance(self):
+        strg = mock.Mock()
+        strg.retrieve_instance.side_effect = storage.InstanceNotFoundError()
+        runner = self.get_reconciler(strg)
+        instance = storage.Instance(name="secret", state="terminating")
+        runner.in_flight["secret"] = reconciler.Plan(instance)
+        runner.checkpoint()
+        self.assertEqual(0, strg.store_instance.call_count)
+
+    def test_start(self):
+        instance = storage.Instance(name="secret")
+        started = storage.Instance(name="secret", units=[storage.Unit(id="i-0800")])
+        strg = mock.Mock()
+        runner = self.get_reconciler(strg)
+        runner.manager.start_instance.return_value = started
+        runner.start(reconciler.Plan(instance))
+        runner.manager.start_instance.assert_called_with("secret")
+        self.assertEqual("started", instance.state)
+        self.assertEqual(started.units, instance.units)
+        strg.store_instance.assert_called_with(instance, save_units=False)
+
+    def test_start_failure(self):
+        instance = storage.Instance(name="secret")
+        strg = mock.Mock()
+        runner = self.get_reconciler(strg)
+        runner.manager.start_instance.side_effect = ValueError("no capacity")
+        with self.assertRaises(ValueError):
+            runner.start(reconciler.Plan(instance))
+        self.assertEqual("creating", instance.state)
+        self.assertEqual(1, instance.attempts)
+        self.assertEqual("no capacity", instance.last_error)
+        strg.store_instance.assert_called_with(instance, save_units=False)
+
+    def test_terminate(self):
+        instance = storage.Instance(name="secret", state="removed")
+        strg = mock.Mock()
+        runner = self.get_reconciler(strg)
+        runner.terminate(reconciler.Plan(instance))
+        self.assertEqual("terminating", instance.state)
+        runner.manager.terminate_instance.assert_called_with("secret")
+        strg.remove_instance.assert_called_with("secret")
+
+    @mock.patch("feaas.runners.lease_expiration")
+    def test_scale(self, lease_expiration):
+        lease_expiration.return_value = datetime.datetime(2015, 3, 10, 12, 15)
+        instance = storage.Instance(name="secret", state="started")
+        job = {"instance": "secret", "quantity": 2}
+        strg = mock.Mock()
+        runner = self.get_reconciler(strg)
+        runner.scale(reconciler.Plan(instance, job=job))
+        strg.start_scale_job.assert_called_with(job, datetime.datetime(2015, 3, 10, 12, 15))
+        runner.manager.physical_scale.assert_called_with(instance, 2)
+        self.assertEqual("started", instance.state)
+        self.assertIsNone(instance.lease_expires_at)
+        strg.store_instance.assert_called_with(instance, save_units=False)
+        strg.finish_scale_job.assert_called_with(job)
+
+    def test_scale_failure(self):
+        instance = storage.Instance(name="secret", state="started")
+        job = {"instance": "secret", "quantity": 2}
+        strg = mock.Mock()
+        runner = self.get_reconciler(strg)
+        runner.manager.physical_scale.side_effect = ValueError("no capacity")
+        with self.assertRaises(ValueError):
+            runner.scale(reconciler.Plan(instance, job=job))
+        strg.reset_scale_job.assert_called_with(job)
+        self.assertFalse(strg.finish_scale_job.called)
+        self.assertEqual("started", instance.state)
+        self.assertIsNone(instance.lease_expires_at)
+
+    def test_write_binds(self):
+        units = [storage.Unit(id="i-0800", dns_name="unit1.cloud.tsuru.io",
+                              secret="abc123", state="started"),
+                 storage.Unit(id="i-0801", dns_name="unit2.cloud.tsuru.io",
+                              secret="abc321")]
+        instance = storage.Instance(name="secret", state="started", units=units)
+        binds = [storage.Bind("myapp.cloud.tsuru.io", instance),
+                 storage.Bind("other.cloud.tsuru.io", instance, state="created"),
+                 storage.Bind("third.cloud.tsuru.io", instance)]
+        strg = mock.Mock()
+        runner = self.get_reconciler(strg)
+        runner.write_binds(reconciler.Plan(instance, binds))
+        runner.manager.write_vcl.assert_called_once_with("unit1.cloud.tsuru.io", "abc123",
+                                                         "myapp.cloud.tsuru.io")
+        self.assertEqual([mock.call(binds[0], state="created"),
+                          mock.call(binds[2], state="created")],
+                         strg.update_bind.call_args_list)
+
+    def test_remove_binds(self):
+        units = [storage.Unit(id="i-0800", dns_name="10.0.0.1", secret="abc", state="started"),
+                 storage.Unit(id="i-0801", dns_name="10.0.0.2", secret="def", state="creating")]
+        instance = storage.Instance(name="secret", state="started", units=units)
+        binds = [storage.Bind("myapp.cloud.tsuru.io", instance, state="removing"),
+                 storage.Bind("other.cloud.tsuru.io", instance, state="created"),
+                 storage.Bind("another.cloud.tsuru.io", instance, state="removing")]
+        strg = mock.Mock()
+        runner = self.get_reconciler(strg)
+        runner.remove_binds(reconciler.Plan(instance, binds))
+        runner.manager.remove_vcl.assert_called_once_with("10.0.0.1", "abc")
+        self.assertEqual([mock.call(binds[0]), mock.call(binds[2])],
+                         strg.remove_bind.call_args_list)
+        self.assertEqual(["removed", "created", "removed"], [b.state for b in binds])
+
+    @mock.patch("feaas.runners.is_unit_up")
+    def test_write_units(self, is_unit_up):
+        units = [storage.Unit(id="i-0800", dns_name="unit1.cloud.tsuru.io",
+                              secret="abc123"),
+                 storage.Unit(id="i-0801", dns_name="unit2.cloud.tsuru.io",
+                              secret="abc321")]
+        is_unit_up.side_effect = lambda unit: unit == units[1]
+        instance = storage.Instance(name="secret", state="started", units=units)
+        binds = [storage.Bind("myapp.cloud.tsuru.io", instance, state="created")]
+        strg = mock.Mock()
+        runner = self.get_reconciler(strg)
+        runner.write_units(reconciler.Plan(instance, binds))
+        runner.manager.write_vcl.assert_called_once_with("unit2.cloud.tsuru.io", "abc321",
+                                                         "myapp.cloud.tsuru.io")
+        strg.update_units.assert_called_once_with([units[1]], state="started")
+        self.assertEqual("started", units[1].state)
@@ -0,0 +1,257 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import os
+import signal
+import threading
+import unittest
+
+import freezegun
+import mock
+
+from feaas import metrics, runners, storage
+
+
+class LeaseTestCase(unittest.TestCase):
+
+    @freezegun.freeze_time("2015-03-10 12:00:00")
+    def test_lease_expiration(self):
+        os.environ["API_LEASE_TIMEOUT"] = "300"
+        self.addCleanup(os.environ.pop, "API_LEASE_TIMEOUT")
+        self.assertEqual(datetime.datetime(2015, 3, 10, 12, 5), runners.lease_expiration())
+
+    @freezegun.freeze_time("2015-03-10 12:00:00")
+    def test_lease_expiration_default(self):
+        self.assertEqual(datetime.datetime(2015, 3, 10, 12, 15), runners.lease_expiration())
+
+    @freezegun.freeze_time("2015-03-10 12:00:00")
+    def test_lease_renewer_renew(self):
+        strg = mock.Mock()
+        strg.transition_instance.return_value = True
+        instance = storage.Instance(name="myinstance", state="scaling")
+        job = {"instance": "myinstance", "quantity": 2}
+        renewer = runners.LeaseRenewer(strg, instance, job)
+        self.assertEqual(300, renewer.interval)
+        renewer.renew()
+        lease = datetime.datetime(2015, 3, 10, 12, 15)
+        strg.transition_instance.assert_called_once_with("myinstance", "scaling",
+                                                         lease_expires_at=lease)
+        strg.renew_scale_job.assert_called_once_with(job, lease)
+        self.assertEqual(lease, instance.lease_expires_at)
+
+    def test_lease_renewer_not_applied(self):
+        strg = mock.Mock()
+        strg.transition_instance.return_value = False
+        instance = storage.Instance(name="myinstance", state="starting")
+        runners.LeaseRenewer(strg, instance).renew()
+        self.assertIsNone(instance.lease_expires_at)
+        self.assertFalse(strg.renew_scale_job.called)
+
+    def test_lease_renewer_renews_until_exit(self):
+        renewed = threading.Event()
+        strg = mock.Mock()
+        strg.transition_instance.side_effect = lambda *args, **kwargs: renewed.set()
+        instance = storage.Instance(name="myinstance", state="starting")
+        with runners.LeaseRenewer(strg, instance, interval=0.01) as renewer:
+            renewed.wait(2)
+        self.assertTrue(renewed.is_set())
+        self.assertFalse(renewer.thread.is_alive())
+        calls = strg.transition_instance.call_count
+        renewer.stopped.wait(0.05)
+        self.assertEqual(calls, strg.transition_instance.call_count)
+
+    @mock.patch("sys.stderr")
+    def test_lease_renewer_logs_errors(self, stderr):
+        renewed = threading.Event()
+
+        def fail(*args, **kwargs):
+            renewed.set()
+            raise ValueError("something went wrong")
+        strg = mock.Mock()
+        strg.transition_instance.side_effect = fail
+        instance = storage.Instance(name="myinstance", state="starting")
+        with runners.LeaseRenewer(strg, instance, interval=0.01):
+            renewed.wait(2)
+        msg = "[ERROR] failed to renew the lease of instance myinstance: something went wrong\n"
+        stderr.write.assert_any_call(msg)
+
+
+class RetryTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        for env in ("API_START_MAX_ATTEMPTS", "API_START_RETRY_BACKOFF",
+                    "API_START_RETRY_MAX_BACKOFF"):
+            os.environ.pop(env, None)
+
+    @freezegun.freeze_time("2015-03-10 12:00:00")
+    def test_schedule_retry(self):
+        os.environ["API_START_RETRY_BACKOFF"] = "10"
+        os.environ["API_START_RETRY_MAX_BACKOFF"] = "30"
+        instance = storage.Instance(name="myinstance", state="starting")
+        delays = []
+        for i in xrange(4):
+            runners.schedule_retry(instance, "wat {}".format(i))
+            self.assertEqual("creating", instance.state)
+            delays.append(instance.next_attempt_at - datetime.datetime(2015, 3, 10, 12))
+        self.assertEqual([10, 20, 30, 30], [d.seconds for d in delays])
+        self.assertEqual(4, instance.attempts)
+        self.assertEqual("wat 3", instance.last_error)
+
+    def test_schedule_retry_gives_up(self):
+        os.environ["API_START_MAX_ATTEMPTS"] = "2"
+        instance = storage.Instance(name="myinstance", state="starting")
+        runners.schedule_retry(instance, "wat")
+        self.assertEqual("creating", instance.state)
+        runners.schedule_retry(instance, "wot")
+        self.assertEqual("error", instance.state)
+        self.assertEqual(2, instance.attempts)
+        self.assertEqual("wot", instance.last_error)
+        self.assertIsNone(instance.next_attempt_at)
+
+    def test_is_due(self):
+        instance = storage.Instance(name="myinstance")
+        self.assertTrue(runners.is_due(instance))
+        now = datetime.datetime.utcnow()
+        instance.next_attempt_at = now - datetime.timedelta(seconds=1)
+        self.assertTrue(runners.is_due(instance))
+        instance.next_attempt_at = now + datetime.timedelta(seconds=60)
+        self.assertFalse(runners.is_due(instance))
+
+    def test_reset_retries(self):
+        instance = storage.Instance(name="myinstance", attempts=3, last_error="wat",
+                                    next_attempt_at=datetime.datetime.utcnow())
+        runners.reset_retries(instance)
+        self.assertEqual(0, instance.attempts)
+        self.assertIsNone(instance.last_error)
+        self.assertIsNone(instance.next_attempt_at)
+
+
+class FakeRunner(runners.Base):
+
+    def __init__(self, *args, **kwargs):
+        super(FakeRunner, self).__init__(*args, **kwargs)
+        self.runs = 0
+
+    def run(self):
+        self.runs += 1
+
+
+class BaseTestCase(unittest.TestCase):
+
+    def get_runner(self, interval=60):
+        runner = FakeRunner(mock.Mock(storage=mock.Mock()), interval)
+        runner.locker = mock.Mock()
+        return runner
+
+    def test_stop_interrupts_sleep(self):
+        runner = self.get_runner(interval=60)
+        t = threading.Thread(target=runner.loop)
+        t.start()
+        while not runner.runs:
+            pass
+        runner.stop()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(1, runner.runs)
+
+    def test_loop_drains(self):
+        runner = self.get_runner()
+        runner.run = runner.stop
+        runner.drain = mock.Mock()
+        runner.loop()
+        self.assertEqual(1, runner.drain.call_count)
+
+    @mock.patch("signal.siginterrupt")
+    @mock.patch("signal.signal")
+    def test_handle_signals(self, signal_mock, siginterrupt):
+        runner = self.get_runner()
+        runner.shutdown = mock.Mock()
+        runner.handle_signals(deadline=10)
+        calls = signal_mock.call_args_list
+        self.assertEqual([signal.SIGTERM, signal.SIGINT], [c[0][0] for c in calls])
+        self.assertEqual([mock.call(signal.SIGTERM, False), mock.call(signal.SIGINT, False)],
+                         siginterrupt.call_args_list)
+        handler = calls[0][0][1]
+        handler(signal.SIGTERM, None)
+        runner.shutdown.assert_called_with(10)
+
+    def test_shutdown(self):
+        runner = self.get_runner()
+        runner.running = True
+        runner.shutdown(deadline=60)
+        self.addCleanup(runner.deadline_timer.cancel)
+        self.assertFalse(runner.running)
+        self.assertTrue(runner.stopped.is_set())
+        self.assertTrue(runner.deadline_timer.is_alive())
+        self.assertEqual(60, runner.deadline_timer.interval)
+
+    def test_shutdown_default_deadline(self):
+        os.environ["API_SHUTDOWN_DEADLINE"] = "45"
+        self.addCleanup(os.environ.pop, "API_SHUTDOWN_DEADLINE")
+        runner = self.get_runner()
+        runner.shutdown()
+        self.addCleanup(runner.deadline_timer.cancel)
+        self.assertEqual(45, runner.deadline_timer.interval)
+
+    def test_loop_cancels_deadline_timer(self):
+        runner = self.get_runner()
+        runner.run = lambda: runner.shutdown(deadline=60)
+        runner.loop()
+        runner.deadline_timer.join(5)
+        self.assertFalse(runner.deadline_timer.is_alive())
+
+    @mock.patch("sys.stderr")
+    @mock.patch("os._exit")
+    def test_abort(self, exit, stderr):
+        runner = self.get_runner()
+        runner.checkpoint = mock.Mock()
+        runner.abort()
+        self.assertEqual(1, runner.checkpoint.call_count)
+        self.assertEqual(1, runner.locker.release_all.call_count)
+        exit.assert_called_with(1)
+        msg = "[ERROR] shutdown deadline exceeded, checkpointing in-flight work\n"
+        stderr.write.assert_called_with(msg)
+
+    @mock.patch("sys.stderr")
+    @mock.patch("os._exit")
+    def test_abort_checkpoint_failure(self, exit, stderr):
+        runner = self.get_runner()
+        runner.checkpoint = mock.Mock(side_effect=ValueError("database is gone"))
+        runner.abort()
+        self.assertEqual(1, runner.locker.release_all.call_count)
+        exit.assert_called_with(1)
+        stderr.write.assert_called_with("[ERROR] failed to checkpoint: database is gone\n")
+
+    def test_loop_records_tick_duration(self):
+        runner = self.get_runner()
+        before = metrics.runner_tick_seconds.get(runner="FakeRunner")["count"]
+        runner.run = runner.stop
+        runner.loop()
+        self.assertEqual(before + 1, metrics.runner_tick_seconds.get(runner="FakeRunner")["count"])
+
+    def test_tick_records_errors(self):
+        runner = self.get_runner()
+        runner.run = mock.Mock(side_effect=ValueError("wat"))
+        before = metrics.runner_errors.get(runner="FakeRunner")
+        with self.assertRaises(ValueError):
+            runner.tick()
+        self.assertEqual(before + 1, metrics.runner_errors.get(runner="FakeRunner"))
+
+    def test_claim_sort(self):
+        runner = self.get_runner()
+        sorts = [runner.claim_sort() for i in xrange(8)]
+        expected = [storage.PRIORITY_SORT] * 3 + [storage.FIFO_SORT]
+        self.assertEqual(expected * 2, sorts)
+
+    def test_claim_sort_fifo_every(self):
+        os.environ["API_PRIORITY_FIFO_EVERY"] = "2"
+        self.addCleanup(os.environ.pop, "API_PRIORITY_FIFO_EVERY")
+        runner = self.get_runner()
+        sorts = [runner.claim_sort() for i in xrange(4)]
+        self.assertEqual([storage.PRIORITY_SORT, storage.FIFO_SORT] * 2, sorts)
+
+    def test_release_locks_without_locker(self):
+        runner = FakeRunner(mock.Mock(storage=mock.Mock()), 10)
+        runner.release_locks()
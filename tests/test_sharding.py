@@ -0,0 +1,90 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import unittest
+
+import freezegun
+import mock
+
+from feaas import storage
+from feaas.runners import sharding
+
+
+class HashRingTestCase(unittest.TestCase):
+
+    def test_get_node(self):
+        ring = sharding.HashRing(["a", "b", "c"])
+        node = ring.get_node("myinstance")
+        self.assertIn(node, ["a", "b", "c"])
+        self.assertEqual(node, sharding.HashRing(["c", "b", "a"]).get_node("myinstance"))
+
+    def test_get_node_empty_ring(self):
+        self.assertIsNone(sharding.HashRing([]).get_node("myinstance"))
+
+    def test_distribution(self):
+        ring = sharding.HashRing(["a", "b", "c", "d"])
+        counts = {}
+        for b in xrange(storage.SHARDS):
+            node = ring.get_node(str(b))
+            counts[node] = counts.get(node, 0) + 1
+        self.assertEqual(["a", "b", "c", "d"], sorted(counts.keys()))
+        for count in counts.values():
+            self.assertGreater(count, storage.SHARDS / 8)
+
+    def test_only_buckets_from_dead_node_move(self):
+        before = sharding.HashRing(["a", "b", "c"])
+        after = sharding.HashRing(["a", "b"])
+        for b in xrange(storage.SHARDS):
+            node = before.get_node(str(b))
+            if node != "c":
+                self.assertEqual(node, after.get_node(str(b)))
+
+
+class ShardTestCase(unittest.TestCase):
+
+    @freezegun.freeze_time("2015-03-10 12:00:30")
+    def test_refresh(self):
+        strg = mock.Mock()
+        strg.retrieve_replicas.return_value = ["a", "b"]
+        shard = sharding.Shard(strg, "vcl_writer", ttl=30, replica_id="a")
+        buckets = shard.refresh()
+        strg.store_replica.assert_called_with("vcl_writer", "a")
+        strg.retrieve_replicas.assert_called_with("vcl_writer",
+                                                  datetime.datetime(2015, 3, 10, 12, 0, 0))
+        ring = sharding.HashRing(["a", "b"])
+        expected = [b for b in xrange(storage.SHARDS) if ring.get_node(str(b)) == "a"]
+        self.assertEqual(expected, buckets)
+        self.assertEqual({"shard": {"$in": expected}}, shard.query())
+        self.assertEqual(["a", "b"], shard.members)
+
+    def test_refresh_includes_itself(self):
+        strg = mock.Mock()
+        strg.retrieve_replicas.return_value = []
+        shard = sharding.Shard(strg, "vcl_writer", replica_id="a")
+        self.assertEqual(range(storage.SHARDS), shard.refresh())
+
+    def test_refresh_rebalances(self):
+        strg = mock.Mock()
+        strg.retrieve_replicas.return_value = ["a"]
+        shard = sharding.Shard(strg, "vcl_writer", replica_id="a")
+        shard.refresh()
+        strg.retrieve_replicas.return_value = ["a", "b"]
+        buckets = shard.refresh()
+        self.assertLess(len(buckets), storage.SHARDS)
+        self.assertGreater(len(buckets), 0)
+
+    def test_default_replica_id(self):
+        shard1 = sharding.Shard(mock.Mock(), "vcl_writer")
+        shard2 = sharding.Shard(mock.Mock(), "vcl_writer")
+        self.assertNotEqual(shard1.replica_id, shard2.replica_id)
+
+    def test_leave(self):
+        strg = mock.Mock()
+        strg.retrieve_replicas.return_value = ["a"]
+        shard = sharding.Shard(strg, "vcl_writer", replica_id="a")
+        shard.refresh()
+        shard.leave()
+        strg.remove_replica.assert_called_with("a")
+        self.assertEqual([], shard.buckets)
@@ -2,12 +2,16 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
+import itertools
+import Queue
 import unittest
 
 import freezegun
+import mock
 import pymongo
 
-from feaas import storage
+from feaas import cache, storage
 
 
 class InstanceTestCase(unittest.TestCase):
@@ -23,6 +27,26 @@ class InstanceTestCase(unittest.TestCase):
         expected = {"name": "myinstance", "state": "created"}
         self.assertEqual(expected, instance.to_dict())
 
+    def test_to_dict_lease(self):
+        lease = datetime.datetime(2015, 3, 10, 12, 15)
+        instance = storage.Instance(name="myinstance", state="starting",
+                                    lease_expires_at=lease)
+        expected = {"name": "myinstance", "state": "starting", "lease_expires_at": lease}
+        self.assertEqual(expected, instance.to_dict())
+
+    def test_to_dict_priority(self):
+        instance = storage.Instance(name="myinstance", priority=storage.PRIORITY_BULK)
+        expected = {"name": "myinstance", "state": "creating", "priority": 0}
+        self.assertEqual(expected, instance.to_dict())
+
+    def test_to_dict_retries(self):
+        next_attempt = datetime.datetime(2015, 3, 10, 12, 1)
+        instance = storage.Instance(name="myinstance", attempts=1, last_error="wat",
+                                    next_attempt_at=next_attempt)
+        expected = {"name": "myinstance", "state": "creating", "attempts": 1,
+                    "last_error": "wat", "next_attempt_at": next_attempt}
+        self.assertEqual(expected, instance.to_dict())
+
     def test_add_unit(self):
         unit1 = storage.Unit(dns_name="instance1.cloud.tsuru.io", id="i-0800")
         unit2 = storage.Unit(dns_name="instance2.cloud.tsuru.io", id="i-0801")
@@ -56,6 +80,45 @@ class UnitTestCase(unittest.TestCase):
         self.assertEqual(expected, unit.to_dict())
 
 
+class ShardOfTestCase(unittest.TestCase):
+
+    def test_shard_of(self):
+        shard = storage.shard_of("myinstance")
+        self.assertEqual(shard, storage.shard_of(u"myinstance"))
+        self.assertGreaterEqual(shard, 0)
+        self.assertLess(shard, storage.SHARDS)
+
+
+class CollectionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = storage._Collection(itertools.count(), ["state"])
+        for name, state, priority in [("a", "ready", 2), ("b", "ready", None),
+                                      ("c", "booting", 1), ("d", "ready", 1),
+                                      ("e", "ready", 2)]:
+            self.collection.insert({"name": name, "state": state, "priority": priority})
+
+    def names(self, docs):
+        return [d["name"] for d in docs]
+
+    def test_find_natural_order(self):
+        self.assertEqual(["a", "b", "d", "e"],
+                         self.names(self.collection.find({"state": "ready"})))
+        self.assertEqual(["a", "b"],
+                         self.names(self.collection.find({"state": "ready"}, limit=2)))
+        self.assertEqual("a", self.collection.find_one()["name"])
+
+    def test_find_sort(self):
+        sort = [("priority", 1), ("name", -1)]
+        self.assertEqual(["b", "d", "c", "e", "a"], self.names(self.collection.find(sort=sort)))
+        self.assertEqual(["b", "d"], self.names(self.collection.find(sort=sort, limit=2)))
+        sort = [("priority", -1)]
+        self.assertEqual(["a", "e", "c", "d", "b"], self.names(self.collection.find(sort=sort)))
+        self.assertEqual("a", self.collection.find_one(sort=sort)["name"])
+        self.assertEqual("b", self.collection.find_one({"state": "ready"},
+                                                       sort=[("priority", 1)])["name"])
+
+
 class BindTestCase(unittest.TestCase):
 
     def test_to_dict(self):
@@ -86,7 +149,8 @@ class MongoDBStorageTestCase(unittest.TestCase):
         self.storage.store_instance(instance)
         self.addCleanup(self.client.feaas_test.instances.remove, {"name": "secret"})
         instance = self.client.feaas_test.instances.find_one({"name": "secret"})
-        expected = {"name": "secret", "_id": instance["_id"], "state": "creating"}
+        expected = {"name": "secret", "_id": instance["_id"], "state": "creating",
+                    "shard": storage.shard_of("secret")}
         self.assertEqual(expected, instance)
 
     def test_store_instance_with_units(self):
@@ -96,12 +160,14 @@ class MongoDBStorageTestCase(unittest.TestCase):
         self.addCleanup(self.client.feaas_test.instances.remove, {"name": "secret"})
         self.addCleanup(self.client.feaas_test.units.remove, {"instance_name": "secret"})
         instance = self.client.feaas_test.instances.find_one({"name": "secret"})
-        expected = {"name": "secret", "_id": instance["_id"], "state": "creating"}
+        expected = {"name": "secret", "_id": instance["_id"], "state": "creating",
+                    "shard": storage.shard_of("secret")}
         self.assertEqual(expected, instance)
         unit = self.client.feaas_test.units.find_one({"id": "i-0800",
                                                       "instance_name": "secret"})
         expected = units[0].to_dict()
         expected["_id"] = unit["_id"]
+        expected["shard"] = storage.shard_of("secret")
         self.assertEqual(expected, unit)
 
     def test_store_instance_update_with_units(self):
@@ -146,6 +212,22 @@ class MongoDBStorageTestCase(unittest.TestCase):
                          [u.to_dict() for u in got_instance.units])
         self.assertEqual(instance.to_dict(), got_instance.to_dict())
 
+    def test_retrieve_instances(self):
+        units = [storage.Unit(dns_name="instance1.cloud.tsuru.io", id="i-0800"),
+                 storage.Unit(dns_name="instance2.cloud.tsuru.io", id="i-0801")]
+        instance1 = storage.Instance(name="what", units=units)
+        self.storage.store_instance(instance1)
+        self.addCleanup(self.storage.remove_instance, instance1.name)
+        instance2 = storage.Instance(name="when", state="started")
+        self.storage.store_instance(instance2)
+        self.addCleanup(self.storage.remove_instance, instance2.name)
+        instances = self.storage.retrieve_instances(name={"$in": ["what", "when"]})
+        self.assertEqual([instance1.to_dict(), instance2.to_dict()],
+                         [i.to_dict() for i in instances])
+        self.assertEqual([u.to_dict() for u in units],
+                         [u.to_dict() for u in instances[0].units])
+        self.assertEqual([], instances[1].units)
+
     def test_retrieve_instance_check_liveness(self):
         instance = storage.Instance(name="what", state="removed")
         self.storage.store_instance(instance)
@@ -212,6 +294,25 @@ class MongoDBStorageTestCase(unittest.TestCase):
         got_job = self.client.feaas_test.scale_jobs.find_one()
         self.assertEqual(job, got_job)
 
+    def test_store_scale_job_coalesces_pending_jobs(self):
+        self.storage.store_scale_job({"instance": "myapp", "quantity": 5})
+        self.storage.store_scale_job({"instance": "myapp", "quantity": 10})
+        job = {"instance": "myapp", "quantity": 3}
+        self.storage.store_scale_job(job)
+        self.addCleanup(self.client.feaas_test.scale_jobs.remove, {"instance": "myapp"})
+        jobs = list(self.client.feaas_test.scale_jobs.find({"instance": "myapp"}))
+        self.assertEqual([job], jobs)
+        self.assertEqual(3, jobs[0]["quantity"])
+
+    def test_store_scale_job_does_not_touch_processing_jobs(self):
+        job1 = {"instance": "myapp", "quantity": 5, "state": "processing"}
+        self.storage.store_scale_job(job1)
+        job2 = {"instance": "myapp", "quantity": 3}
+        self.storage.store_scale_job(job2)
+        self.addCleanup(self.client.feaas_test.scale_jobs.remove, {"instance": "myapp"})
+        jobs = list(self.client.feaas_test.scale_jobs.find({"instance": "myapp"}))
+        self.assertEqual([job1, job2], jobs)
+
     def test_get_scale_job(self):
         job1 = {"instance": "myapp", "quantity": 2}
         self.storage.store_scale_job(job1)
@@ -236,6 +337,23 @@ class MongoDBStorageTestCase(unittest.TestCase):
         job = self.storage.get_scale_job()
         self.assertIsNone(job)
 
+    def test_retrieve_scale_jobs(self):
+        job1 = {"instance": "myapp", "quantity": 2}
+        self.storage.store_scale_job(job1)
+        job2 = {"instance": "yourapp", "quantity": 3, "state": "done"}
+        self.storage.store_scale_job(job2)
+        self.addCleanup(self.client.feaas_test.scale_jobs.remove,
+                        {"instance": {"$in": ["myapp", "yourapp"]}})
+        self.assertEqual([job1], self.storage.retrieve_scale_jobs(state="pending"))
+
+    def test_start_scale_job(self):
+        job = {"instance": "myapp", "quantity": 2}
+        self.storage.store_scale_job(job)
+        self.addCleanup(self.client.feaas_test.scale_jobs.remove, {"instance": "myapp"})
+        self.storage.start_scale_job(job)
+        self.assertEqual("processing", job["state"])
+        self.assertEqual(job, self.client.feaas_test.scale_jobs.find_one())
+
     def test_reset_scale_job(self):
         job = {"instance": "myapp", "quantity": 2, "state": "processing"}
         self.storage.store_scale_job(job)
@@ -245,6 +363,16 @@ class MongoDBStorageTestCase(unittest.TestCase):
         persisted_job = self.client.feaas_test.scale_jobs.find_one()
         self.assertEqual(job, persisted_job)
 
+    def test_reset_scale_job_with_newer_pending_job(self):
+        job = {"instance": "myapp", "quantity": 2, "state": "processing"}
+        self.storage.store_scale_job(job)
+        self.storage.store_scale_job({"instance": "myapp", "quantity": 4})
+        self.addCleanup(self.client.feaas_test.scale_jobs.remove, {"instance": "myapp"})
+        self.storage.reset_scale_job(job)
+        self.assertEqual("done", job["state"])
+        pending = list(self.client.feaas_test.scale_jobs.find({"state": "pending"}))
+        self.assertEqual([4], [j["quantity"] for j in pending])
+
     def test_reset_scale_job_no_id(self):
         job = {"instance": "myapp", "quantity": 2, "state": "processing"}
         with self.assertRaises(ValueError) as cm:
@@ -252,15 +380,21 @@ class MongoDBStorageTestCase(unittest.TestCase):
         exc = cm.exception
         self.assertEqual(("job is not persisted",), exc.args)
 
+    @freezegun.freeze_time("2014-02-16 12:00:01")
     def test_finish_scale_job(self):
         job = {"instance": "myapp", "quantity": 2, "state": "processing"}
         self.storage.store_scale_job(job)
         self.addCleanup(self.client.feaas_test.scale_jobs.remove, {"instance": "myapp"})
         self.storage.finish_scale_job(job)
         self.assertEqual("done", job["state"])
+        self.assertEqual(datetime.datetime(2014, 2, 16, 12, 0, 1), job["finished_at"])
         persisted_job = self.client.feaas_test.scale_jobs.find_one()
         self.assertEqual(job, persisted_job)
 
+    def test_scale_jobs_ttl_index(self):
+        indexes = self.client.feaas_test.scale_jobs.index_information()
+        self.assertEqual(86400, indexes["finished_at_1"]["expireAfterSeconds"])
+
     def test_finish_scale_job_no_id(self):
         job = {"instance": "myapp", "quantity": 2, "state": "processing"}
         with self.assertRaises(ValueError) as cm:
@@ -279,6 +413,7 @@ class MongoDBStorageTestCase(unittest.TestCase):
         expected = bind.to_dict()
         expected["_id"] = got["_id"]
         expected["created_at"] = got["created_at"]
+        expected["shard"] = storage.shard_of("years")
         self.assertEqual(expected, got)
 
     @freezegun.freeze_time("2014-02-16 12:00:01")
@@ -377,11 +512,732 @@ class MongoDBStorageTestCase(unittest.TestCase):
         bind = self.storage.retrieve_binds(instance_name="great")[0]
         self.assertEqual("created", bind.state)
 
+    def test_store_pool_unit(self):
+        unit = storage.Unit(id="i-0800", dns_name="pool.cloud.tsuru.io",
+                            secret="abc123", state="booting")
+        self.storage.store_pool_unit(unit)
+        self.addCleanup(self.client.feaas_test.unit_pool.remove, {"id": "i-0800"})
+        got_units = self.storage.retrieve_pool_units(state="booting")
+        self.assertEqual(1, len(got_units))
+        self.assertEqual("i-0800", got_units[0].id)
+        self.assertEqual("abc123", got_units[0].secret)
+        self.assertEqual(1, self.storage.count_pool_units())
+
+    def test_update_pool_units(self):
+        unit = storage.Unit(id="i-0800", dns_name="pool.cloud.tsuru.io",
+                            secret="abc123", state="booting")
+        self.storage.store_pool_unit(unit)
+        self.addCleanup(self.client.feaas_test.unit_pool.remove, {"id": "i-0800"})
+        self.storage.update_pool_units([unit], state="ready")
+        got_units = self.storage.retrieve_pool_units(state="ready")
+        self.assertEqual(["i-0800"], [u.id for u in got_units])
+
+    def test_claim_pool_unit(self):
+        unit1 = storage.Unit(id="i-0800", dns_name="pool1.cloud.tsuru.io",
+                             secret="abc123", state="booting")
+        unit2 = storage.Unit(id="i-0801", dns_name="pool2.cloud.tsuru.io",
+                             secret="abc321", state="ready")
+        self.storage.store_pool_unit(unit1)
+        self.storage.store_pool_unit(unit2)
+        self.addCleanup(self.client.feaas_test.unit_pool.remove,
+                        {"id": {"$in": ["i-0800", "i-0801"]}})
+        unit = self.storage.claim_pool_unit()
+        self.assertEqual("i-0801", unit.id)
+        self.assertEqual("abc321", unit.secret)
+        self.assertIsNone(self.storage.claim_pool_unit())
+        self.assertEqual(1, self.storage.count_pool_units())
+
+    def test_store_scale_job_shard(self):
+        job = {"instance": "myapp", "quantity": 2}
+        self.storage.store_scale_job(job)
+        self.addCleanup(self.client.feaas_test.scale_jobs.remove, {"instance": "myapp"})
+        self.assertEqual(storage.shard_of("myapp"), job["shard"])
+        self.assertIsNone(self.storage.get_scale_job(shard={"$in": []}))
+        self.assertEqual(job["_id"],
+                         self.storage.get_scale_job(shard={"$in": [job["shard"]]})["_id"])
+
+    def test_retrieve_units_by_shard(self):
+        units = [storage.Unit(dns_name="instance1.cloud.tsuru.io", id="i-0800")]
+        instance = storage.Instance(name="secret", units=units)
+        self.storage.store_instance(instance)
+        self.addCleanup(self.storage.remove_instance, "secret")
+        shard = storage.shard_of("secret")
+        got = self.storage.retrieve_units(shard={"$in": [shard]})
+        self.assertEqual([u.to_dict() for u in units], [u.to_dict() for u in got])
+        self.assertEqual([], self.storage.retrieve_units(shard={"$in": [shard + 1]}))
+
+    def test_replicas(self):
+        self.addCleanup(self.client.feaas_test.runner_replicas.remove, {"group": "writer"})
+        self.addCleanup(self.client.feaas_test.runner_replicas.remove, {"group": "other"})
+        with freezegun.freeze_time("2015-03-10 12:00:00"):
+            self.storage.store_replica("writer", "host1:123")
+        with freezegun.freeze_time("2015-03-10 12:00:40"):
+            self.storage.store_replica("writer", "host2:456")
+            self.storage.store_replica("other", "host3:789")
+        since = datetime.datetime(2015, 3, 10, 12, 0, 10)
+        self.assertEqual(["host2:456"], self.storage.retrieve_replicas("writer", since))
+        since = datetime.datetime(2015, 3, 10, 11, 59, 50)
+        self.assertEqual(["host1:123", "host2:456"],
+                         self.storage.retrieve_replicas("writer", since))
+        self.storage.remove_replica("host1:123")
+        self.assertEqual(["host2:456"], self.storage.retrieve_replicas("writer", since))
+
+    def test_retrieve_instance_due_for_retry(self):
+        now = datetime.datetime(2015, 3, 10, 12, 0)
+        later = storage.Instance(name="later", attempts=1, last_error="wat",
+                                 next_attempt_at=now + datetime.timedelta(seconds=30))
+        self.storage.store_instance(later)
+        self.addCleanup(self.storage.remove_instance, later.name)
+        query = {"$or": [{"next_attempt_at": None},
+                         {"next_attempt_at": {"$lte": now}}]}
+        with self.assertRaises(storage.InstanceNotFoundError):
+            self.storage.retrieve_instance(state="creating", **query)
+        due = storage.Instance(name="due", attempts=2, last_error="wat",
+                               next_attempt_at=now - datetime.timedelta(seconds=30))
+        self.storage.store_instance(due)
+        self.addCleanup(self.storage.remove_instance, due.name)
+        got = self.storage.retrieve_instance(state="creating", **query)
+        self.assertEqual(due.to_dict(), got.to_dict())
+
+    def test_retrieve_binds_priority_order(self):
+        instance = storage.Instance(name="years")
+        binds = [storage.Bind("bulk1.cloud.tsuru.io", instance, priority=storage.PRIORITY_BULK),
+                 storage.Bind("bulk2.cloud.tsuru.io", instance, priority=storage.PRIORITY_BULK),
+                 storage.Bind("myapp.cloud.tsuru.io", instance,
+                              priority=storage.PRIORITY_INTERACTIVE)]
+        for bind in binds:
+            self.storage.store_bind(bind)
+        self.addCleanup(self.client.feaas_test.binds.remove, {"instance_name": "years"})
+        got = self.storage.retrieve_binds(instance_name="years", sort=storage.PRIORITY_SORT)
+        self.assertEqual(["myapp.cloud.tsuru.io", "bulk1.cloud.tsuru.io",
+                          "bulk2.cloud.tsuru.io"], [b.app_host for b in got])
+        self.assertEqual(storage.PRIORITY_INTERACTIVE, got[0].priority)
+        got = self.storage.retrieve_binds(instance_name="years", sort=storage.FIFO_SORT)
+        self.assertEqual(["bulk1.cloud.tsuru.io", "bulk2.cloud.tsuru.io",
+                          "myapp.cloud.tsuru.io"], [b.app_host for b in got])
+
+    def test_get_scale_job_priority_order(self):
+        self.storage.store_scale_job({"instance": "bulk", "quantity": 2,
+                                      "priority": storage.PRIORITY_BULK})
+        self.storage.store_scale_job({"instance": "interactive", "quantity": 2,
+                                      "priority": storage.PRIORITY_INTERACTIVE})
+        self.addCleanup(self.client.feaas_test.scale_jobs.remove,
+                        {"instance": {"$in": ["bulk", "interactive"]}})
+        job = self.storage.get_scale_job(sort=storage.PRIORITY_SORT)
+        self.assertEqual("interactive", job["instance"])
+        job = self.storage.get_scale_job(sort=storage.PRIORITY_SORT)
+        self.assertEqual("bulk", job["instance"])
+
+    def test_release_expired_leases(self):
+        now = datetime.datetime(2015, 3, 10, 12, 0)
+        expired = now - datetime.timedelta(seconds=1)
+        valid = now + datetime.timedelta(seconds=1)
+        instances = [storage.Instance(name="starting1", state="starting",
+                                      lease_expires_at=expired),
+                     storage.Instance(name="starting2", state="starting",
+                                      lease_expires_at=valid),
+                     storage.Instance(name="scaling", state="scaling",
+                                      lease_expires_at=expired),
+                     storage.Instance(name="terminating", state="terminating",
+                                      lease_expires_at=expired),
+                     storage.Instance(name="started", state="started")]
+        for instance in instances:
+            self.storage.store_instance(instance)
+            self.addCleanup(self.storage.remove_instance, instance.name)
+        job = {"instance": "scaling", "quantity": 3}
+        self.storage.store_scale_job(job)
+        self.addCleanup(self.client.feaas_test.scale_jobs.remove, {"instance": "scaling"})
+        self.storage.start_scale_job(job, expired)
+        released = self.storage.release_expired_leases(now)
+        self.assertEqual({"starting": 1, "scaling": 1, "terminating": 1, "processing": 1},
+                         released)
+        states = dict([(i.name, (i.state, i.lease_expires_at))
+                       for i in self.storage.retrieve_instances()])
+        self.assertEqual({"starting1": ("creating", None), "starting2": ("starting", valid),
+                          "scaling": ("started", None), "terminating": ("removed", None),
+                          "started": ("started", None)}, states)
+        got_job = self.client.feaas_test.scale_jobs.find_one({"instance": "scaling"})
+        self.assertEqual("pending", got_job["state"])
+        self.assertNotIn("lease_expires_at", got_job)
+
+    def test_queue_depths(self):
+        for name, state in [("a", "creating"), ("b", "creating"), ("c", "started")]:
+            self.storage.store_instance(storage.Instance(name=name, state=state))
+            self.addCleanup(self.client.feaas_test.instances.remove, {"name": name})
+        self.storage.store_scale_job({"instance": "c", "quantity": 2})
+        self.addCleanup(self.client.feaas_test.scale_jobs.remove, {"instance": "c"})
+        unit = storage.Unit(id="i-1", dns_name="a.varnish.io", state="creating")
+        self.storage.store_instance(storage.Instance(name="a", state="creating",
+                                                     units=[unit]))
+        self.addCleanup(self.client.feaas_test.units.remove, {"instance_name": "a"})
+        self.storage.store_bind(storage.Bind("myapp.io", storage.Instance(name="c")))
+        self.addCleanup(self.client.feaas_test.binds.remove, {"instance_name": "c"})
+        expected = {"instances": {"creating": 2, "started": 1},
+                    "scale_jobs": 1, "binds": 1, "units": 1}
+        self.assertEqual(expected, self.storage.queue_depths())
+
     def assert_units(self, expected_units, instance_name):
         cursor = self.client.feaas_test.units.find({"instance_name": instance_name})
         units = []
         expected = [u.to_dict() for u in expected_units]
         for i, unit in enumerate(cursor):
             expected[i]["_id"] = unit["_id"]
+            expected[i]["shard"] = storage.shard_of(instance_name)
             units.append(unit)
         self.assertEqual(expected, units)
+
+
+class StorageContract(object):
+    """
+    StorageContract holds the tests that every storage backend must pass,
+    using only the interface defined by :class:`feaas.storage.BaseStorage`.
+    Test cases for a backend mix it in and implement ``new_storage``.
+    """
+
+    def new_storage(self):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.storage = self.new_storage()
+
+    def store_instance(self, name, state="started", units=(), **kwargs):
+        instance = storage.Instance(name=name, state=state, **kwargs)
+        for unit_id in units:
+            instance.add_unit(storage.Unit(id=unit_id, dns_name=unit_id + ".cloud.tsuru.io",
+                                           secret="abc"))
+        self.storage.store_instance(instance)
+        return instance
+
+    def test_is_a_storage(self):
+        self.assertIsInstance(self.storage, storage.BaseStorage)
+
+    def test_store_and_retrieve_instance(self):
+        lease = datetime.datetime(2015, 3, 10, 12, 0)
+        self.store_instance("years", state="starting", units=["i-1", "i-2"],
+                            lease_expires_at=lease, priority=storage.PRIORITY_BULK)
+        instance = self.storage.retrieve_instance(name="years")
+        self.assertEqual("starting", instance.state)
+        self.assertEqual(lease, instance.lease_expires_at)
+        self.assertEqual(storage.PRIORITY_BULK, instance.priority)
+        self.assertEqual(["i-1", "i-2"], sorted([u.id for u in instance.units]))
+        unit = [u for u in instance.units if u.id == "i-1"][0]
+        self.assertEqual("i-1.cloud.tsuru.io", unit.dns_name)
+        self.assertEqual("abc", unit.secret)
+        self.assertEqual("creating", unit.state)
+        self.assertEqual(instance, unit.instance)
+
+    def test_store_instance_update_with_units(self):
+        instance = self.store_instance("years", units=["i-1"])
+        instance.state = "scaling"
+        instance.units[0].state = "started"
+        instance.add_unit(storage.Unit(id="i-2"))
+        self.storage.store_instance(instance)
+        instance = self.storage.retrieve_instance(name="years")
+        self.assertEqual("scaling", instance.state)
+        states = dict([(u.id, u.state) for u in instance.units])
+        self.assertEqual({"i-1": "started", "i-2": "creating"}, states)
+        self.assertEqual(1, len(self.storage.retrieve_instances(name="years")))
+
+    def test_store_instance_update_without_units(self):
+        instance = self.store_instance("years", units=["i-1"])
+        instance.state = "removed"
+        instance.units = []
+        self.storage.store_instance(instance, save_units=False)
+        instance = self.storage.retrieve_instance(name="years")
+        self.assertEqual("removed", instance.state)
+        self.assertEqual(["i-1"], [u.id for u in instance.units])
+
+    def test_retrieve_instance_not_found(self):
+        with self.assertRaises(storage.InstanceNotFoundError):
+            self.storage.retrieve_instance(name="years")
+
+    def test_retrieve_instance_check_liveness(self):
+        self.store_instance("years", state="removed")
+        self.store_instance("days", state="terminating")
+        for name in ("years", "days"):
+            with self.assertRaises(storage.InstanceNotFoundError):
+                self.storage.retrieve_instance(name=name, check_liveness=True)
+        self.store_instance("weeks", state="started")
+        instance = self.storage.retrieve_instance(name="weeks", check_liveness=True)
+        self.assertEqual("weeks", instance.name)
+
+    def test_retrieve_instance_sort(self):
+        self.store_instance("years", state="creating")
+        self.store_instance("days", state="creating", priority=storage.PRIORITY_INTERACTIVE)
+        self.store_instance("weeks", state="started", priority=20)
+        instance = self.storage.retrieve_instance(state="creating", sort=storage.PRIORITY_SORT)
+        self.assertEqual("days", instance.name)
+        instance = self.storage.retrieve_instance(state="creating", sort=storage.FIFO_SORT)
+        self.assertEqual("years", instance.name)
+
+    def test_retrieve_instance_due_for_retry(self):
+        now = datetime.datetime(2015, 3, 10, 12, 0)
+        self.store_instance("years", state="creating", attempts=1, last_error="wat",
+                            next_attempt_at=now + datetime.timedelta(minutes=1))
+        self.store_instance("days", state="creating", attempts=2, last_error="wat",
+                            next_attempt_at=now - datetime.timedelta(minutes=1))
+        self.store_instance("weeks", state="creating")
+        query = {"$or": [{"next_attempt_at": None}, {"next_attempt_at": {"$lte": now}}]}
+        instances = self.storage.retrieve_instances(state="creating", **query)
+        self.assertEqual(["days", "weeks"], sorted([i.name for i in instances]))
+        instance = self.storage.retrieve_instance(name="days")
+        self.assertEqual((2, "wat"), (instance.attempts, instance.last_error))
+
+    def test_retrieve_instances(self):
+        self.store_instance("years", units=["i-1"])
+        self.store_instance("days", units=["i-2", "i-3"])
+        self.store_instance("weeks", state="creating")
+        instances = self.storage.retrieve_instances(state="started")
+        units = dict([(i.name, sorted([u.id for u in i.units])) for i in instances])
+        self.assertEqual({"years": ["i-1"], "days": ["i-2", "i-3"]}, units)
+        instances = self.storage.retrieve_instances(name={"$in": ["years", "weeks"]})
+        self.assertEqual(["weeks", "years"], sorted([i.name for i in instances]))
+        self.assertEqual([], self.storage.retrieve_instances(state="removed"))
+
+    def test_remove_instance(self):
+        instance = self.store_instance("years", units=["i-1"])
+        self.store_instance("days", units=["i-2"])
+        self.storage.store_bind(storage.Bind("myapp.cloud.tsuru.io", instance))
+        self.storage.remove_instance("years")
+        self.assertEqual(["days"], [i.name for i in self.storage.retrieve_instances()])
+        self.assertEqual(["i-2"], [u.id for u in self.storage.retrieve_units()])
+        self.assertEqual([], self.storage.retrieve_binds())
+
+    def test_retrieve_units(self):
+        self.store_instance("years", units=["i-1", "i-2", "i-3"])
+        self.store_instance("days", units=["i-4"])
+        units = self.storage.retrieve_units(instance_name="years")
+        self.assertEqual(["i-1", "i-2", "i-3"], sorted([u.id for u in units]))
+        self.assertEqual("years", units[0].instance.name)
+        self.assertEqual(2, len(self.storage.retrieve_units(limit=2)))
+        units = self.storage.retrieve_units(id={"$in": ["i-1", "i-4"]})
+        self.assertEqual(["i-1", "i-4"], sorted([u.id for u in units]))
+
+    def test_retrieve_units_by_shard(self):
+        self.store_instance("years", units=["i-1"])
+        self.store_instance("days", units=["i-2"])
+        units = self.storage.retrieve_units(shard={"$in": [storage.shard_of("days")]},
+                                            state="creating")
+        self.assertEqual(["i-2"], [u.id for u in units])
+
+    def test_update_units(self):
+        instance = self.store_instance("years", units=["i-1", "i-2", "i-3"])
+        self.storage.update_units(instance.units[:2], state="started")
+        units = self.storage.retrieve_units(state="started")
+        self.assertEqual(["i-1", "i-2"], sorted([u.id for u in units]))
+        self.assertEqual(["i-3"], [u.id for u in self.storage.retrieve_units(state="creating")])
+
+    def test_store_scale_job(self):
+        job = {"instance": "years", "quantity": 2}
+        self.storage.store_scale_job(job)
+        self.assertEqual("pending", job["state"])
+        self.assertEqual(storage.shard_of("years"), job["shard"])
+        jobs = self.storage.retrieve_scale_jobs(instance="years")
+        self.assertEqual([(2, "pending")], [(j["quantity"], j["state"]) for j in jobs])
+
+    def test_store_scale_job_coalesces_pending_jobs(self):
+        self.storage.store_scale_job({"instance": "years", "quantity": 2})
+        job = {"instance": "years", "quantity": 5}
+        self.storage.store_scale_job(job)
+        jobs = self.storage.retrieve_scale_jobs(instance="years")
+        self.assertEqual([5], [j["quantity"] for j in jobs])
+        self.assertEqual(jobs[0]["_id"], job["_id"])
+
+    def test_store_scale_job_does_not_touch_processing_jobs(self):
+        self.storage.store_scale_job({"instance": "years", "quantity": 2})
+        self.storage.get_scale_job()
+        self.storage.store_scale_job({"instance": "years", "quantity": 3})
+        jobs = self.storage.retrieve_scale_jobs(instance="years")
+        self.assertEqual([(2, "processing"), (3, "pending")],
+                         sorted([(j["quantity"], j["state"]) for j in jobs]))
+
+    def test_store_scale_job_not_pending(self):
+        job = {"instance": "years", "quantity": 2, "state": "done"}
+        self.storage.store_scale_job(job)
+        self.assertIn("_id", job)
+        self.assertEqual([], self.storage.retrieve_scale_jobs(state="pending"))
+
+    def test_get_scale_job(self):
+        lease = datetime.datetime(2015, 3, 10, 12, 0)
+        self.storage.store_scale_job({"instance": "years", "quantity": 2})
+        job = self.storage.get_scale_job(lease_expires_at=lease)
+        self.assertEqual(("years", 2, "processing", lease),
+                         (job["instance"], job["quantity"], job["state"],
+                          job["lease_expires_at"]))
+        stored = self.storage.retrieve_scale_jobs(instance="years")[0]
+        self.assertEqual(("processing", lease), (stored["state"], stored["lease_expires_at"]))
+        self.assertIsNone(self.storage.get_scale_job())
+
+    def test_transition_instance(self):
+        self.store_instance("years", state="started")
+        lease = datetime.datetime(2015, 3, 10, 12, 0)
+        self.assertTrue(self.storage.transition_instance("years", "started", state="scaling",
+                                                         lease_expires_at=lease))
+        self.assertFalse(self.storage.transition_instance("years", "started",
+                                                          state="scaling"))
+        self.assertFalse(self.storage.transition_instance("days", "started", state="scaling"))
+        instance = self.storage.retrieve_instance(name="years")
+        self.assertEqual(("scaling", lease), (instance.state, instance.lease_expires_at))
+
+    def test_retrieve_instances_by_shard(self):
+        self.store_instance("years")
+        shard = storage.shard_of("years")
+        self.assertEqual(["years"],
+                         [i.name for i in self.storage.retrieve_instances(shard=shard)])
+        self.assertEqual([], self.storage.retrieve_instances(shard=shard + 1))
+        self.assertEqual("years", self.storage.retrieve_instance(shard=shard).name)
+
+    def test_start_scale_job_claims_latest_pending(self):
+        job = {"instance": "years", "quantity": 2}
+        self.storage.store_scale_job(job)
+        self.storage.store_scale_job({"instance": "years", "quantity": 5})
+        self.storage.start_scale_job(job)
+        self.assertEqual(("processing", 5), (job["state"], job["quantity"]))
+        with self.assertRaises(ValueError) as cm:
+            self.storage.start_scale_job(job)
+        self.assertEqual(("job is not pending",), cm.exception.args)
+        self.assertEqual(["processing"],
+                         [j["state"] for j in self.storage.retrieve_scale_jobs(instance="years")])
+
+    def test_get_scale_job_query_and_priority(self):
+        self.storage.store_scale_job({"instance": "years", "quantity": 2,
+                                      "priority": storage.PRIORITY_BULK})
+        self.storage.store_scale_job({"instance": "days", "quantity": 2,
+                                      "priority": storage.PRIORITY_INTERACTIVE})
+        self.storage.store_scale_job({"instance": "weeks", "quantity": 2})
+        job = self.storage.get_scale_job(sort=storage.PRIORITY_SORT)
+        self.assertEqual("days", job["instance"])
+        job = self.storage.get_scale_job(shard=storage.shard_of("weeks"))
+        self.assertEqual("weeks", job["instance"])
+
+    def test_start_scale_job_not_persisted(self):
+        with self.assertRaises(ValueError):
+            self.storage.start_scale_job({"instance": "years", "quantity": 2})
+
+    def test_reset_scale_job(self):
+        self.storage.store_scale_job({"instance": "years", "quantity": 2})
+        job = self.storage.get_scale_job(lease_expires_at=datetime.datetime(2015, 3, 10))
+        self.storage.reset_scale_job(job)
+        self.assertEqual("pending", job["state"])
+        stored = self.storage.retrieve_scale_jobs(instance="years")[0]
+        self.assertEqual("pending", stored["state"])
+        self.assertNotIn("lease_expires_at", stored)
+
+    def test_reset_scale_job_with_newer_pending_job(self):
+        self.storage.store_scale_job({"instance": "years", "quantity": 2})
+        job = self.storage.get_scale_job()
+        self.storage.store_scale_job({"instance": "years", "quantity": 3})
+        self.storage.reset_scale_job(job)
+        jobs = self.storage.retrieve_scale_jobs(instance="years")
+        self.assertEqual([(2, "done"), (3, "pending")],
+                         sorted([(j["quantity"], j["state"]) for j in jobs]))
+
+    def test_finish_scale_job(self):
+        self.storage.store_scale_job({"instance": "years", "quantity": 2})
+        job = self.storage.get_scale_job()
+        with freezegun.freeze_time("2015-03-10 12:00:00"):
+            self.storage.finish_scale_job(job)
+        stored = self.storage.retrieve_scale_jobs(instance="years")[0]
+        self.assertEqual("done", stored["state"])
+        self.assertEqual(datetime.datetime(2015, 3, 10, 12, 0), stored["finished_at"])
+
+    def test_scale_job_not_persisted(self):
+        job = {"instance": "years", "quantity": 2}
+        for fn in (self.storage.reset_scale_job, self.storage.finish_scale_job):
+            with self.assertRaises(ValueError):
+                fn(job)
+
+    def test_release_expired_leases(self):
+        now = datetime.datetime(2015, 3, 10, 12, 0)
+        expired = now - datetime.timedelta(minutes=1)
+        self.store_instance("years", state="starting", lease_expires_at=expired)
+        self.store_instance("days", state="terminating", lease_expires_at=expired)
+        self.store_instance("weeks", state="scaling", lease_expires_at=now)
+        self.storage.store_scale_job({"instance": "weeks", "quantity": 2})
+        self.storage.get_scale_job(lease_expires_at=expired)
+        released = self.storage.release_expired_leases(now=now)
+        self.assertEqual({"starting": 1, "scaling": 0, "terminating": 1, "processing": 1},
+                         released)
+        instance = self.storage.retrieve_instance(name="years")
+        self.assertEqual(("creating", None), (instance.state, instance.lease_expires_at))
+        self.assertEqual("removed", self.storage.retrieve_instance(name="days").state)
+        self.assertEqual("scaling", self.storage.retrieve_instance(name="weeks").state)
+        self.assertEqual("pending", self.storage.retrieve_scale_jobs()[0]["state"])
+
+    def test_release_expired_leases_starting_with_units(self):
+        now = datetime.datetime(2015, 3, 10, 12, 0)
+        expired = now - datetime.timedelta(minutes=1)
+        self.store_instance("years", state="starting", units=["i-1"],
+                            lease_expires_at=expired)
+        self.store_instance("days", state="starting", lease_expires_at=expired)
+        released = self.storage.release_expired_leases(now=now)
+        self.assertEqual(2, released["starting"])
+        instance = self.storage.retrieve_instance(name="years")
+        self.assertEqual(("started", None), (instance.state, instance.lease_expires_at))
+        self.assertEqual(["i-1"], [u.id for u in instance.units])
+        self.assertEqual("creating", self.storage.retrieve_instance(name="days").state)
+
+    def test_renew_scale_job(self):
+        now = datetime.datetime(2015, 3, 10, 12, 0)
+        later = now + datetime.timedelta(minutes=15)
+        self.storage.store_scale_job({"instance": "years", "quantity": 2})
+        job = self.storage.get_scale_job(lease_expires_at=now)
+        self.assertTrue(self.storage.renew_scale_job(job, later))
+        self.assertEqual(later, job["lease_expires_at"])
+        released = self.storage.release_expired_leases(now=now + datetime.timedelta(minutes=1))
+        self.assertEqual(0, released["processing"])
+        self.storage.finish_scale_job(job)
+        self.assertFalse(self.storage.renew_scale_job(job, later))
+
+    def test_store_and_retrieve_binds(self):
+        created_at = datetime.datetime(2015, 3, 10, 12, 0)
+        instance = storage.Instance(name="years")
+        self.storage.store_bind(storage.Bind("a.cloud.tsuru.io", instance,
+                                             created_at=created_at))
+        self.storage.store_bind(storage.Bind("b.cloud.tsuru.io", instance, state="created",
+                                             priority=storage.PRIORITY_BULK, trace_id="abc"))
+        self.storage.store_bind(storage.Bind("c.cloud.tsuru.io",
+                                             storage.Instance(name="days")))
+        binds = self.storage.retrieve_binds(instance_name="years", sort=storage.FIFO_SORT)
+        self.assertEqual(["a.cloud.tsuru.io", "b.cloud.tsuru.io"], [b.app_host for b in binds])
+        self.assertEqual((created_at, "creating", None, None),
+                         (binds[0].created_at, binds[0].state, binds[0].priority,
+                          binds[0].trace_id))
+        self.assertEqual(("created", storage.PRIORITY_BULK, "abc"),
+                         (binds[1].state, binds[1].priority, binds[1].trace_id))
+        self.assertEqual("years", binds[0].instance.name)
+        self.assertEqual(1, len(self.storage.retrieve_binds(limit=1)))
+        binds = self.storage.retrieve_binds(state="creating", sort=storage.FIFO_SORT)
+        self.assertEqual(["a.cloud.tsuru.io", "c.cloud.tsuru.io"], [b.app_host for b in binds])
+
+    def test_store_binds(self):
+        instance = storage.Instance(name="years")
+        self.storage.store_binds([])
+        self.storage.store_binds([storage.Bind("a.cloud.tsuru.io", instance),
+                                  storage.Bind("b.cloud.tsuru.io", instance,
+                                               priority=storage.PRIORITY_BULK, trace_id="abc")])
+        binds = self.storage.retrieve_binds(instance_name="years", sort=storage.FIFO_SORT)
+        self.assertEqual(["a.cloud.tsuru.io", "b.cloud.tsuru.io"], [b.app_host for b in binds])
+        self.assertEqual(["creating", "creating"], [b.state for b in binds])
+        self.assertEqual((storage.PRIORITY_BULK, "abc"), (binds[1].priority, binds[1].trace_id))
+
+    def test_update_binds(self):
+        years = storage.Instance(name="years")
+        self.storage.store_binds([storage.Bind("a.cloud.tsuru.io", years),
+                                  storage.Bind("b.cloud.tsuru.io", years),
+                                  storage.Bind("c.cloud.tsuru.io", years),
+                                  storage.Bind("a.cloud.tsuru.io", storage.Instance(name="days"))])
+        self.storage.update_binds({"instance_name": "years",
+                                   "app_host": {"$in": ["a.cloud.tsuru.io", "c.cloud.tsuru.io"]}},
+                                  state="removing", trace_id="abc")
+        binds = self.storage.retrieve_binds(state="removing", sort=storage.FIFO_SORT)
+        self.assertEqual([("years", "a.cloud.tsuru.io", "abc"),
+                          ("years", "c.cloud.tsuru.io", "abc")],
+                         [(b.instance.name, b.app_host, b.trace_id) for b in binds])
+        self.assertEqual(2, len(self.storage.retrieve_binds(state="creating")))
+
+    def test_retrieve_binds_priority_order(self):
+        instance = storage.Instance(name="years")
+        self.storage.store_bind(storage.Bind("a.cloud.tsuru.io", instance,
+                                             priority=storage.PRIORITY_BULK))
+        self.storage.store_bind(storage.Bind("b.cloud.tsuru.io", instance))
+        self.storage.store_bind(storage.Bind("c.cloud.tsuru.io", instance,
+                                             priority=storage.PRIORITY_INTERACTIVE))
+        binds = self.storage.retrieve_binds(sort=storage.PRIORITY_SORT)
+        self.assertEqual(["c.cloud.tsuru.io", "a.cloud.tsuru.io", "b.cloud.tsuru.io"],
+                         [b.app_host for b in binds])
+
+    def test_update_and_remove_bind(self):
+        instance = storage.Instance(name="years")
+        bind = storage.Bind("a.cloud.tsuru.io", instance,
+                            created_at=datetime.datetime(2015, 3, 10, 12, 0))
+        self.storage.store_bind(bind)
+        self.storage.store_bind(storage.Bind("b.cloud.tsuru.io", instance))
+        self.storage.update_bind(bind, state="created")
+        binds = self.storage.retrieve_binds(state="created")
+        self.assertEqual(["a.cloud.tsuru.io"], [b.app_host for b in binds])
+        bind.state = "created"
+        self.storage.remove_bind(bind)
+        binds = self.storage.retrieve_binds()
+        self.assertEqual(["b.cloud.tsuru.io"], [b.app_host for b in binds])
+
+    def test_pool_units(self):
+        expires_at = datetime.datetime(2015, 3, 10, 13, 0)
+        with freezegun.freeze_time("2015-03-10 12:00:00"):
+            self.storage.store_pool_unit(storage.Unit(id="i-2", dns_name="i-2.tsuru.io",
+                                                      secret="abc", state="ready"),
+                                         expires_at=expires_at)
+        with freezegun.freeze_time("2015-03-10 11:00:00"):
+            self.storage.store_pool_unit(storage.Unit(id="i-1", state="ready"))
+            self.storage.store_pool_unit(storage.Unit(id="i-3"))
+        self.assertEqual(2, self.storage.count_pool_units(state="ready"))
+        self.assertEqual(1, self.storage.count_pool_units(expires_at={"$lte": expires_at}))
+        self.assertEqual(["i-3"], [u.id for u in
+                                   self.storage.retrieve_pool_units(state="creating")])
+        self.assertEqual(1, len(self.storage.retrieve_pool_units(limit=1)))
+        self.assertEqual("i-1", self.storage.claim_pool_unit().id)
+        unit = self.storage.claim_pool_unit()
+        self.assertEqual(("i-2", "i-2.tsuru.io", "abc", "ready"),
+                         (unit.id, unit.dns_name, unit.secret, unit.state))
+        self.assertIsNone(self.storage.claim_pool_unit())
+        self.storage.update_pool_units([storage.Unit(id="i-3")], state="ready")
+        self.assertEqual("i-3", self.storage.claim_pool_unit(state="ready").id)
+        self.assertEqual(0, self.storage.count_pool_units())
+
+    def test_expire_and_remove_pool_units(self):
+        now = datetime.datetime.utcnow()
+        expired = now - datetime.timedelta(seconds=1)
+        self.storage.store_pool_unit(storage.Unit(id="i-1", state="ready"), expires_at=expired)
+        self.storage.store_pool_unit(storage.Unit(id="i-2", state="ready"))
+        unit = self.storage.expire_pool_unit(expires_at={"$lt": now})
+        self.assertEqual(("i-1", "expiring"), (unit.id, unit.state))
+        self.assertIsNone(self.storage.expire_pool_unit(expires_at={"$lt": now}))
+        self.assertEqual("i-2", self.storage.claim_pool_unit().id)
+        self.assertEqual(["i-1"], [u.id for u in
+                                   self.storage.retrieve_pool_units(state="expiring")])
+        self.storage.remove_pool_units([unit])
+        self.assertEqual(0, self.storage.count_pool_units())
+
+    def test_replicas(self):
+        with freezegun.freeze_time("2015-03-10 12:00:00"):
+            self.storage.store_replica("vcl_writer", "b")
+        with freezegun.freeze_time("2015-03-10 12:05:00"):
+            self.storage.store_replica("vcl_writer", "c")
+            self.storage.store_replica("vcl_writer", "a")
+            self.storage.store_replica("instance_starter", "d")
+        since = datetime.datetime(2015, 3, 10, 12, 1)
+        self.assertEqual(["a", "c"], self.storage.retrieve_replicas("vcl_writer", since))
+        with freezegun.freeze_time("2015-03-10 12:05:00"):
+            self.storage.store_replica("vcl_writer", "b")
+        self.storage.remove_replica("a")
+        self.assertEqual(["b", "c"], self.storage.retrieve_replicas("vcl_writer", since))
+
+    def test_queue_depths(self):
+        self.store_instance("years", units=["i-1"])
+        self.store_instance("days", state="creating")
+        self.store_instance("weeks", state="creating")
+        self.storage.store_scale_job({"instance": "years", "quantity": 2})
+        self.storage.store_bind(storage.Bind("a.cloud.tsuru.io", storage.Instance(name="years")))
+        expected = {"instances": {"started": 1, "creating": 2},
+                    "scale_jobs": 1, "binds": 1, "units": 1}
+        self.assertEqual(expected, self.storage.queue_depths())
+
+    def test_scan(self):
+        self.store_instance("years", units=["i-1", "i-2"])
+        self.store_instance("days", state="creating", units=["i-3"])
+        self.storage.store_bind(storage.Bind("a.cloud.tsuru.io", storage.Instance(name="days")))
+        items = list(self.storage.scan("instances"))
+        self.assertEqual(["years", "days"], [item["name"] for _, item in items])
+        self.assertEqual({"name": "years", "state": "started"}, items[0][1])
+        units = list(self.storage.scan("units", batch_size=2))
+        self.assertEqual(["i-1", "i-2", "i-3"], [item["id"] for _, item in units])
+        self.assertEqual("years", units[0][1]["instance_name"])
+        self.assertNotIn("shard", units[0][1])
+        page = list(self.storage.scan("units", limit=2))
+        self.assertEqual(["i-1", "i-2"], [item["id"] for _, item in page])
+        rest = list(self.storage.scan("units", after=page[-1][0]))
+        self.assertEqual(["i-3"], [item["id"] for _, item in rest])
+        binds = list(self.storage.scan("binds", instance_name="days"))
+        self.assertEqual(["a.cloud.tsuru.io"], [item["app_host"] for _, item in binds])
+        creating = list(self.storage.scan("instances", state="creating"))
+        self.assertEqual(["days"], [item["name"] for _, item in creating])
+
+    def test_scan_invalid(self):
+        with self.assertRaises(ValueError):
+            self.storage.scan("scale_jobs")
+        with self.assertRaises(ValueError):
+            self.storage.scan("units", after="wat")
+
+    def test_notifier(self):
+        notifier = self.storage.new_notifier()
+        if notifier is None:
+            return
+        names = Queue.Queue()
+        notifier.subscribe(names.put)
+        notifier.publish("years")
+        received = []
+        while "years" not in received:
+            received.append(names.get(timeout=5))
+
+    def test_locker(self):
+        locker = self.storage.new_locker()
+        locker.init("contract")
+        self.addCleanup(locker.destroy, "contract")
+        locker.lock("contract")
+        locker.unlock("contract")
+        with self.assertRaises(storage.DoubleUnlockError):
+            locker.unlock("contract")
+
+
+class MongoDBStorageContractTestCase(StorageContract, unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.client = pymongo.MongoClient('localhost', 27017)
+
+    def new_storage(self):
+        self.client.drop_database("feaas_contract_test")
+        self.addCleanup(self.client.drop_database, "feaas_contract_test")
+        return storage.MongoDBStorage(dbname="feaas_contract_test")
+
+
+class MemoryStorageContractTestCase(StorageContract, unittest.TestCase):
+
+    def new_storage(self):
+        return storage.MemoryStorage()
+
+
+class CachedStorageContractTestCase(StorageContract, unittest.TestCase):
+
+    def new_storage(self):
+        reads = cache.reads()
+        reads.__enter__()
+        self.addCleanup(reads.__exit__, None, None, None)
+        return cache.CachedStorage(storage.MemoryStorage(), cache.LRUCache())
+
+
+class MongoDBIndexesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = storage.MongoDBStorage.__new__(storage.MongoDBStorage)
+        self.storage.db = mock.MagicMock()
+        self.collection = self.storage.db.__getitem__.return_value
+
+    def test_ensure_ttl_index(self):
+        self.collection.index_information.return_value = {}
+        self.storage._ensure_ttl_index("scale_jobs", "finished_at", 60)
+        self.collection.ensure_index.assert_called_once_with("finished_at",
+                                                             expireAfterSeconds=60)
+        self.assertFalse(self.storage.db.command.called)
+
+    def test_backfill_shards(self):
+        self.collection.find.return_value.distinct.side_effect = [["years"], [], [], ["days"]]
+        self.storage.collection_name = "instances"
+        self.storage._backfill_shards()
+        self.assertEqual([mock.call("name"), mock.call("instance_name"),
+                          mock.call("instance_name"), mock.call("instance")],
+                         self.collection.find.return_value.distinct.call_args_list)
+        self.collection.find.assert_called_with({"shard": None})
+        self.assertEqual([mock.call({"name": "years", "shard": None},
+                                    {"$set": {"shard": storage.shard_of("years")}}, multi=True),
+                          mock.call({"instance": "days", "shard": None},
+                                    {"$set": {"shard": storage.shard_of("days")}}, multi=True)],
+                         self.collection.update.call_args_list)
+
+    def test_ensure_ttl_index_changed(self):
+        self.collection.index_information.return_value = {
+            "finished_at_1": {"key": [("finished_at", 1)], "expireAfterSeconds": 86400}}
+        self.storage._ensure_ttl_index("scale_jobs", "finished_at", 60)
+        self.storage.db.command.assert_called_once_with(
+            "collMod", "scale_jobs",
+            index={"keyPattern": {"finished_at": 1}, "expireAfterSeconds": 60})
+        self.assertFalse(self.collection.ensure_index.called)
+
+
+class RegisteredStoragesTestCase(unittest.TestCase):
+
+    def test_registered_storages_have_contract_tests(self):
+        from feaas import api
+        contracts = {"mongodb": MongoDBStorageContractTestCase,
+                     "memory": MemoryStorageContractTestCase}
+        self.assertEqual(sorted(api.storages), sorted(contracts))
@@ -0,0 +1,140 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import signal
+import threading
+import unittest
+
+import mock
+
+from feaas import runners
+from feaas.runners import pool_replenisher, supervisor, vcl_writer
+
+
+class SupervisorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = mock.Mock(last_run_at=None)
+        patcher = mock.patch.dict(supervisor.RUNNERS,
+                                  {"fake": mock.Mock(return_value=self.runner)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_init(self):
+        manager = mock.Mock()
+        sup = supervisor.Supervisor(manager, interval=3)
+        self.assertEqual(manager, sup.manager)
+        self.assertEqual(supervisor.DEFAULT_RUNNERS, sup.names)
+        self.assertEqual(3, sup.interval)
+        self.assertEqual(dict([(n, 0) for n in supervisor.DEFAULT_RUNNERS]),
+                         sup.restarts)
+
+    def test_init_unknown_runner(self):
+        with self.assertRaises(ValueError) as cm:
+            supervisor.Supervisor(mock.Mock(), ["wat"])
+        self.assertEqual(("unknown runner: wat",), cm.exception.args)
+
+    def test_runners_share_the_manager(self):
+        manager = mock.Mock(storage=mock.Mock())
+        writer = supervisor.RUNNERS["vcl_writer"](manager, 3)
+        self.assertIsInstance(writer, vcl_writer.VCLWriter)
+        self.assertEqual(manager.storage, writer.storage)
+        with mock.patch("feaas.managers.pool_size") as pool_size:
+            pool_size.return_value = 4
+            replenisher = supervisor.RUNNERS["pool_replenisher"](manager, 3)
+        self.assertIsInstance(replenisher, pool_replenisher.PoolReplenisher)
+        self.assertEqual(4, replenisher.size)
+
+    @mock.patch("sys.stderr")
+    def test_supervise_restarts_crashed_runner(self, stderr):
+        manager = mock.Mock()
+        sup = supervisor.Supervisor(manager, ["fake"], interval=3, restart_delay=0)
+        sup.running = True
+        self.runner.loop.side_effect = [ValueError("wat"), ValueError("wot"), None]
+        sup.supervise("fake")
+        self.assertEqual(3, self.runner.loop.call_count)
+        supervisor.RUNNERS["fake"].assert_called_with(manager, 3)
+        self.assertEqual(2, sup.restarts["fake"])
+        self.assertEqual("wot", sup.errors["fake"])
+        stderr.write.assert_called_with("[ERROR] runner fake crashed, restarting: wot\n")
+
+    def test_supervise_not_running(self):
+        sup = supervisor.Supervisor(mock.Mock(), ["fake"])
+        sup.supervise("fake")
+        self.assertFalse(self.runner.loop.called)
+
+    def test_start_and_stop(self):
+        started = threading.Event()
+        stopped = threading.Event()
+        self.runner.loop.side_effect = lambda: started.set() or stopped.wait(5)
+        self.runner.stop.side_effect = stopped.set
+        sup = supervisor.Supervisor(mock.Mock(), ["fake"])
+        sup.start()
+        started.wait(5)
+        self.assertTrue(sup.health()["fake"]["alive"])
+        sup.stop()
+        sup.threads["fake"].join(5)
+        self.assertEqual(1, self.runner.stop.call_count)
+        self.assertFalse(sup.health()["fake"]["alive"])
+
+    def test_shutdown(self):
+        sup = supervisor.Supervisor(mock.Mock(), ["fake"])
+        sup.runners["fake"] = self.runner
+        sup.running = True
+        sup.shutdown(deadline=60)
+        self.addCleanup(sup.deadline_timer.cancel)
+        self.assertFalse(sup.running)
+        self.assertEqual(1, self.runner.stop.call_count)
+        self.assertEqual(60, sup.deadline_timer.interval)
+
+    @mock.patch("sys.stderr")
+    @mock.patch("os._exit")
+    def test_abort(self, exit, stderr):
+        sup = supervisor.Supervisor(mock.Mock(), ["fake"])
+        sup.runners["fake"] = self.runner
+        self.runner.checkpoint.side_effect = ValueError("wat")
+        sup.abort()
+        self.assertEqual(1, self.runner.checkpoint.call_count)
+        self.assertEqual(1, self.runner.release_locks.call_count)
+        exit.assert_called_with(1)
+        stderr.write.assert_called_with("[ERROR] failed to checkpoint runner fake: wat\n")
+
+    @mock.patch("signal.siginterrupt")
+    @mock.patch("signal.signal")
+    def test_handle_signals(self, signal_mock, siginterrupt):
+        sup = supervisor.Supervisor(mock.Mock(), ["fake"])
+        sup.shutdown = mock.Mock()
+        sup.handle_signals(deadline=10)
+        handler = signal_mock.call_args_list[0][0][1]
+        handler(signal.SIGTERM, None)
+        sup.shutdown.assert_called_with(10)
+        self.assertEqual([mock.call(signal.SIGTERM, False), mock.call(signal.SIGINT, False)],
+                         siginterrupt.call_args_list)
+
+    def test_is_graceful(self):
+        sup = supervisor.Supervisor(mock.Mock(), ["fake"])
+        self.assertIsInstance(sup, runners.GracefulShutdown)
+
+    def test_health(self):
+        sup = supervisor.Supervisor(mock.Mock(), ["fake"])
+        sup.runners["fake"] = self.runner
+        self.runner.last_run_at = 1000
+        sup.restarts["fake"] = 2
+        sup.errors["fake"] = "wat"
+        expected = {"fake": {"alive": False, "last_run_at": 1000,
+                             "restarts": 2, "last_error": "wat"}}
+        self.assertEqual(expected, sup.health())
+
+    @mock.patch("time.time")
+    @mock.patch("sys.stderr")
+    def test_check(self, stderr, time):
+        time.return_value = 1400
+        sup = supervisor.Supervisor(mock.Mock(), ["fake"], stall_timeout=300)
+        sup.runners["fake"] = self.runner
+        sup.threads["fake"] = mock.Mock(is_alive=lambda: True)
+        self.runner.last_run_at = 1000
+        self.assertEqual(["fake"], sup.check())
+        stderr.write.assert_called_with("[ERROR] runner fake has not run for 400 seconds\n")
+        self.runner.last_run_at = 1200
+        self.assertEqual([], sup.check())
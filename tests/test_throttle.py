@@ -0,0 +1,157 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import os
+import unittest
+import urllib2
+
+import mock
+
+from feaas import metrics
+from feaas.managers import throttle
+
+
+class ThrottledError(Exception):
+    pass
+
+
+def is_throttled(exc):
+    return isinstance(exc, ThrottledError)
+
+
+class TokenBucketTestCase(unittest.TestCase):
+
+    @mock.patch("time.sleep")
+    def test_acquire_within_burst(self, sleep):
+        bucket = throttle.TokenBucket(rate=1, burst=3)
+        for i in xrange(3):
+            bucket.acquire()
+        self.assertFalse(sleep.called)
+
+    @mock.patch("time.time")
+    @mock.patch("time.sleep")
+    def test_acquire_waits_for_tokens(self, sleep, time):
+        time.return_value = 10
+        bucket = throttle.TokenBucket(rate=2, burst=1)
+        bucket.acquire()
+
+        def fake_sleep(seconds):
+            time.return_value += seconds
+        sleep.side_effect = fake_sleep
+        bucket.acquire()
+        sleep.assert_called_once_with(0.5)
+
+
+class ThrottleTestCase(unittest.TestCase):
+
+    def get_throttle(self, **kwargs):
+        params = {"rate": 100, "burst": 100, "max_concurrency": 8,
+                  "is_throttled": is_throttled}
+        params.update(kwargs)
+        return throttle.Throttle("test", **params)
+
+    def test_call(self):
+        t = self.get_throttle()
+        fn = mock.Mock(return_value="result")
+        self.assertEqual("result", t.call(fn, "a", b="c"))
+        fn.assert_called_with("a", b="c")
+        self.assertEqual(0, t.in_flight)
+
+    @mock.patch("time.sleep")
+    def test_call_throttled_backs_off_and_retries(self, sleep):
+        t = self.get_throttle(backoff=2)
+        fn = mock.Mock(side_effect=[ThrottledError(), ThrottledError(), "ok"])
+        self.assertEqual("ok", t.call(fn))
+        self.assertEqual([mock.call(2), mock.call(4)], sleep.call_args_list)
+        self.assertEqual(2, t.throttled)
+        self.assertLess(t.rate, 100)
+        self.assertLess(t.limit, 8)
+
+    @mock.patch("time.sleep")
+    def test_call_throttled_gives_up(self, sleep):
+        t = self.get_throttle(max_retries=1)
+        fn = mock.Mock(side_effect=ThrottledError())
+        with self.assertRaises(ThrottledError):
+            t.call(fn)
+        self.assertEqual(2, fn.call_count)
+        self.assertEqual(0, t.in_flight)
+
+    def test_call_other_errors_are_not_retried(self):
+        t = self.get_throttle()
+        fn = mock.Mock(side_effect=ValueError("wat"))
+        with self.assertRaises(ValueError):
+            t.call(fn)
+        self.assertEqual(1, fn.call_count)
+        self.assertEqual(8, t.limit)
+        self.assertEqual(100, t.rate)
+
+    @mock.patch("time.sleep")
+    def test_call_records_metrics(self, sleep):
+        t = self.get_throttle()
+        fn = mock.Mock(side_effect=[ThrottledError(), ValueError("wat")])
+        fn.__name__ = "run_instances"
+        labels = {"provider": "test", "operation": "run_instances"}
+        calls = metrics.cloud_seconds.get(**labels)["count"]
+        errors = metrics.cloud_errors.get(**labels)
+        throttled = metrics.cloud_throttled.get(provider="test")
+        with self.assertRaises(ValueError):
+            t.call(fn)
+        self.assertEqual(calls + 1, metrics.cloud_seconds.get(**labels)["count"])
+        self.assertEqual(errors + 1, metrics.cloud_errors.get(**labels))
+        self.assertEqual(throttled + 1, metrics.cloud_throttled.get(provider="test"))
+
+    def test_decrease_and_increase(self):
+        t = self.get_throttle(rate=4, min_rate=1)
+        t._decrease()
+        self.assertEqual(4, t.limit)
+        self.assertEqual(2, t.rate)
+        t._decrease()
+        t._decrease()
+        t._decrease()
+        self.assertEqual(1, t.limit)
+        self.assertEqual(1, t.rate)
+        t._increase()
+        self.assertEqual(2, t.limit)
+        self.assertEqual(2, t.rate)
+
+    def test_stats(self):
+        t = self.get_throttle()
+        expected = {"name": "test", "rate": 100, "concurrency_limit": 8,
+                    "in_flight": 0, "throttled": 0}
+        self.assertEqual(expected, t.stats())
+
+
+class GetTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        throttle._throttles.clear()
+        for env in ("TEST_RATE_LIMIT", "TEST_RATE_BURST", "TEST_MAX_CONCURRENCY"):
+            if env in os.environ:
+                del os.environ[env]
+
+    def test_get_from_env(self):
+        os.environ["TEST_RATE_LIMIT"] = "5"
+        os.environ["TEST_RATE_BURST"] = "20"
+        os.environ["TEST_MAX_CONCURRENCY"] = "2"
+        t = throttle.get("test", is_throttled)
+        self.assertEqual(5, t.rate)
+        self.assertEqual(20, t.bucket.burst)
+        self.assertEqual(2, t.max_concurrency)
+        self.assertEqual(is_throttled, t.is_throttled)
+
+    def test_metrics(self):
+        t = throttle.get("test", is_throttled)
+        t._decrease()
+        server = metrics.serve(0, host="127.0.0.1")
+        self.addCleanup(server.shutdown)
+        url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+        body = urllib2.urlopen(url).read()
+        self.assertIn('feaas_cloud_rate_limit{provider="test"} 5\n', body)
+        self.assertIn('feaas_cloud_concurrency_limit{provider="test"} 4\n', body)
+        self.assertIn('feaas_cloud_in_flight{provider="test"} 0\n', body)
+
+    def test_get_is_shared(self):
+        t = throttle.get("test", is_throttled)
+        self.assertIs(t, throttle.get("test", is_throttled))
+        self.assertEqual([t.stats()], throttle.stats())
@@ -0,0 +1,98 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import os
+import tempfile
+import unittest
+
+from feaas import tracing
+
+
+class FakeExporter(object):
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+class TracingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.exporter = FakeExporter()
+        tracing.set_exporter(self.exporter)
+        self.addCleanup(tracing.set_exporter, None)
+
+    def test_span_disabled(self):
+        tracing.set_exporter(None)
+        with tracing.span("something") as span:
+            self.assertIsNone(tracing.current_trace_id())
+        self.assertIsNone(span.trace_id)
+        self.assertEqual([], self.exporter.spans)
+
+    def test_nested_spans(self):
+        with tracing.span("parent", kind="http") as parent:
+            with tracing.span("child") as child:
+                self.assertEqual(parent.trace_id, tracing.current_trace_id())
+        self.assertIsNone(tracing.current_span())
+        exported = self.exporter.spans
+        self.assertEqual(["child", "parent"], [s["name"] for s in exported])
+        self.assertEqual(parent.trace_id, exported[0]["trace_id"])
+        self.assertEqual(parent.span_id, exported[0]["parent_id"])
+        self.assertEqual(child.span_id, exported[0]["span_id"])
+        self.assertIsNone(exported[1]["parent_id"])
+        self.assertEqual({"kind": "http"}, exported[1]["attributes"])
+
+    def test_span_with_trace_id(self):
+        with tracing.span("tick"):
+            with tracing.span("bind", trace_id="abc123"):
+                pass
+        self.assertEqual("abc123", self.exporter.spans[0]["trace_id"])
+        self.assertIsNone(self.exporter.spans[0]["parent_id"])
+
+    def test_span_error(self):
+        with self.assertRaises(ValueError):
+            with tracing.span("something"):
+                raise ValueError("wat")
+        self.assertEqual("wat", self.exporter.spans[0]["error"])
+        self.assertIsNone(tracing.current_span())
+
+    def test_trace_methods(self):
+        class Thing(object):
+            def do(self):
+                return tracing.current_span().name
+
+        tracing.trace_methods(Thing, "thing")
+        self.assertEqual("thing.do", Thing().do())
+        self.assertEqual(["thing.do"], [s["name"] for s in self.exporter.spans])
+
+
+class ConfigureTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        os.environ.pop("API_TRACING", None)
+        os.environ.pop("API_TRACE_FILE", None)
+        tracing.configure()
+
+    def test_configure_disabled(self):
+        tracing.configure()
+        self.assertFalse(tracing.enabled())
+
+    def test_configure_json_lines(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        os.environ["API_TRACING"] = "1"
+        os.environ["API_TRACE_FILE"] = path
+        tracing.configure()
+        self.assertTrue(tracing.enabled())
+        with tracing.span("first"):
+            pass
+        with tracing.span("second"):
+            pass
+        with open(path) as f:
+            spans = [json.loads(line) for line in f]
+        self.assertEqual(["first", "second"], [s["name"] for s in spans])
@@ -0,0 +1,115 @@
+# Copyright 2015 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import httplib2
+import mock
+
+from feaas.managers import user_data
+
+
+class TemplateCacheTestCase(unittest.TestCase):
+
+    def test_get_fetches_once_while_fresh(self):
+        cache = user_data.TemplateCache(ttl=300)
+        fetch = mock.Mock(return_value=user_data.Template("echo hello"))
+        self.assertEqual("echo hello", cache.get("key", fetch))
+        self.assertEqual("echo hello", cache.get("key", fetch))
+        fetch.assert_called_once_with(None)
+
+    @mock.patch("threading.Thread")
+    def test_get_stale_serves_cached_and_revalidates_in_background(self, Thread):
+        cache = user_data.TemplateCache(ttl=300, stale_ttl=600)
+        entry = user_data.Template("echo old")
+        entry.fetched_at -= 400
+        cache.entries["key"] = entry
+        fetch = mock.Mock()
+        self.assertEqual("echo old", cache.get("key", fetch))
+        Thread.assert_called_once_with(target=cache._refresh,
+                                       args=("key", fetch, entry))
+        self.assertEqual(1, Thread.return_value.start.call_count)
+        self.assertEqual(set(["key"]), cache.refreshing)
+        cache.get("key", fetch)
+        self.assertEqual(1, Thread.call_count)
+
+    def test_get_expired_revalidates(self):
+        cache = user_data.TemplateCache(ttl=300, stale_ttl=600)
+        entry = user_data.Template("echo old")
+        entry.fetched_at -= 1000
+        cache.entries["key"] = entry
+        fetch = mock.Mock(return_value=user_data.Template("echo new"))
+        self.assertEqual("echo new", cache.get("key", fetch))
+        fetch.assert_called_once_with(entry)
+
+    @mock.patch("sys.stderr")
+    def test_get_expired_revalidation_failure_serves_cached(self, stderr):
+        cache = user_data.TemplateCache(ttl=300, stale_ttl=600)
+        entry = user_data.Template("echo old")
+        entry.fetched_at -= 1000
+        cache.entries["key"] = entry
+        fetch = mock.Mock(side_effect=ValueError("host is down"))
+        self.assertEqual("echo old", cache.get("key", fetch))
+        stderr.write.assert_called_with("[ERROR] failed to revalidate user data: host is down\n")
+
+    def test_get_failure_without_cache(self):
+        cache = user_data.TemplateCache()
+        fetch = mock.Mock(side_effect=ValueError("host is down"))
+        with self.assertRaises(ValueError):
+            cache.get("key", fetch)
+
+    def test_clear(self):
+        cache = user_data.TemplateCache()
+        cache.entries["key"] = user_data.Template("echo old")
+        cache.clear()
+        self.assertEqual({}, cache.entries)
+
+
+class URLFetcherTestCase(unittest.TestCase):
+
+    @mock.patch("httplib2.Http.request")
+    def test_fetch(self, request):
+        response = httplib2.Response({"status": "200", "etag": '"abc"',
+                                      "last-modified": "Wed, 11 Mar 2015 10:00:00 GMT"})
+        request.return_value = (response, "echo VARNISH_SECRET_KEY")
+        template = user_data.url_fetcher("http://localhost/user-data")(None)
+        self.assertEqual("echo VARNISH_SECRET_KEY", template.content)
+        self.assertEqual('"abc"', template.etag)
+        self.assertEqual("Wed, 11 Mar 2015 10:00:00 GMT", template.last_modified)
+        request.assert_called_with("http://localhost/user-data", headers={})
+
+    @mock.patch("httplib2.Http.request")
+    def test_fetch_not_modified(self, request):
+        request.return_value = (httplib2.Response({"status": "304"}), "")
+        entry = user_data.Template("echo cached", etag='"abc"',
+                                   last_modified="Wed, 11 Mar 2015 10:00:00 GMT")
+        template = user_data.url_fetcher("http://localhost/user-data")(entry)
+        self.assertEqual("echo cached", template.content)
+        self.assertEqual('"abc"', template.etag)
+        expected_headers = {"If-None-Match": '"abc"',
+                            "If-Modified-Since": "Wed, 11 Mar 2015 10:00:00 GMT"}
+        request.assert_called_with("http://localhost/user-data",
+                                   headers=expected_headers)
+
+    @mock.patch("httplib2.Http.request")
+    def test_fetch_error_status(self, request):
+        fetch = user_data.url_fetcher("http://localhost/user-data")
+        for status in ("404", "500", "302"):
+            request.return_value = (httplib2.Response({"status": status}), "not found")
+            with self.assertRaises(ValueError) as cm:
+                fetch(None)
+            msg = "failed to fetch user data from http://localhost/user-data: status {}"
+            self.assertEqual((msg.format(status),), cm.exception.args)
+
+    @mock.patch("sys.stderr")
+    @mock.patch("httplib2.Http.request")
+    def test_fetch_error_status_keeps_cached_template(self, request, stderr):
+        request.return_value = (httplib2.Response({"status": "500"}), "internal error")
+        cache = user_data.TemplateCache(ttl=0, stale_ttl=0)
+        entry = user_data.Template("echo cached")
+        cache.entries["http://localhost/user-data"] = entry
+        content = cache.get("http://localhost/user-data",
+                            user_data.url_fetcher("http://localhost/user-data"))
+        self.assertEqual("echo cached", content)
+        self.assertIs(entry, cache.entries["http://localhost/user-data"])
@@ -8,7 +8,7 @@ import unittest
 
 import mock
 
-from feaas import storage
+from feaas import managers, storage, tracing
 from feaas.runners import vcl_writer
 
 
@@ -26,6 +26,8 @@ class VCLWriterTestCase(unittest.TestCase):
         writer.locker.unlock(vcl_writer.UNITS_LOCKER)
         writer.locker.lock(vcl_writer.BINDS_LOCKER)
         writer.locker.unlock(vcl_writer.BINDS_LOCKER)
+        writer.locker.lock(vcl_writer.UNBINDS_LOCKER)
+        writer.locker.unlock(vcl_writer.UNBINDS_LOCKER)
 
     def test_loop(self):
         strg = mock.Mock()
@@ -53,9 +55,11 @@ class VCLWriterTestCase(unittest.TestCase):
         writer = vcl_writer.VCLWriter(manager)
         writer.run_units = mock.Mock()
         writer.run_binds = mock.Mock()
+        writer.run_unbinds = mock.Mock()
         writer.run()
         writer.run_units.assert_called_once()
         writer.run_binds.assert_called_once()
+        self.assertEqual(1, writer.run_unbinds.call_count)
 
     def test_run_units(self):
         units = [storage.Unit(dns_name="instance1.cloud.tsuru.io", id="i-0800"),
@@ -75,6 +79,41 @@ class VCLWriterTestCase(unittest.TestCase):
         writer.bind_units.assert_called_with([units[1]])
         strg.update_units.assert_called_with([units[1]], state="started")
 
+    def test_run_units_sharded(self):
+        strg = mock.Mock()
+        strg.retrieve_units.return_value = []
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, max_items=3, sharded=True)
+        writer.shard = mock.Mock()
+        writer.shard.query.return_value = {"shard": {"$in": [1, 5]}}
+        writer.locker = mock.Mock()
+        writer.run_units()
+        self.assertFalse(writer.locker.lock.called)
+        self.assertFalse(writer.locker.unlock.called)
+        strg.retrieve_units.assert_called_with(state="creating", limit=3,
+                                               shard={"$in": [1, 5]})
+
+    def test_run_sharded_refreshes_shard(self):
+        manager = mock.Mock(storage=mock.Mock())
+        writer = vcl_writer.VCLWriter(manager, sharded=True)
+        self.assertEqual("vcl_writer", writer.shard.group)
+        writer.shard = mock.Mock()
+        writer.run_units = mock.Mock()
+        writer.run_binds = mock.Mock()
+        writer.run()
+        self.assertEqual(1, writer.shard.refresh.call_count)
+        self.assertEqual(1, writer.run_units.call_count)
+        self.assertEqual(1, writer.run_binds.call_count)
+
+    def test_loop_sharded_leaves_shard(self):
+        manager = mock.Mock(storage=mock.Mock())
+        writer = vcl_writer.VCLWriter(manager, interval=0, sharded=True)
+        writer.shard = mock.Mock()
+        writer.run = lambda: writer.stop()
+        writer.loop()
+        self.assertEqual(1, writer.shard.leave.call_count)
+        self.assertIsNotNone(writer.last_run_at)
+
     def test_bind_units(self):
         instance1 = storage.Instance(name="myinstance")
         instance2 = storage.Instance(name="yourinstance")
@@ -91,8 +130,10 @@ class VCLWriterTestCase(unittest.TestCase):
         manager = mock.Mock(storage=strg)
         writer = vcl_writer.VCLWriter(manager, max_items=3)
         writer.bind_units(units)
-        expected_calls = [mock.call(instance_name="myinstance", state="created"),
-                          mock.call(instance_name="yourinstance", state="created")]
+        expected_calls = [mock.call(instance_name="myinstance", state="created", limit=1,
+                                    sort=storage.FIFO_SORT),
+                          mock.call(instance_name="yourinstance", state="created", limit=1,
+                                    sort=storage.FIFO_SORT)]
         self.assertEqual(expected_calls, strg.retrieve_binds.call_args_list)
         expected_calls = [mock.call("instance1-1.cloud.tsuru.io", "abc123",
                                     "myapp.cloud.tsuru.io"),
@@ -123,14 +164,17 @@ class VCLWriterTestCase(unittest.TestCase):
         Telnet.assert_called_with(unit.dns_name, "6082", timeout=3)
 
     def test_run_binds(self):
+        instance1 = storage.Instance(name="wat")
+        instance2 = storage.Instance(name="wet")
         units = [storage.Unit(id="i-0800", dns_name="unit1.cloud.tsuru.io",
-                              secret="abc123", state="started"),
+                              secret="abc123", state="started", instance=instance1),
                  storage.Unit(id="i-8001", dns_name="unit2.cloud.tsuru.io",
-                              secret="abc321", state="started")]
-        instance1 = storage.Instance(name="wat", units=units)
-        instance2 = storage.Instance(name="wet", units=units)
+                              secret="abc321", state="started", instance=instance1),
+                 storage.Unit(id="i-8002", dns_name="unit3.cloud.tsuru.io",
+                              secret="abc456", state="started", instance=instance2)]
         binds = [storage.Bind(instance=instance1, app_host="cool", state="creating"),
-                 storage.Bind(instance=instance2, app_host="bool", state="creating")]
+                 storage.Bind(instance=instance2, app_host="bool", state="creating"),
+                 storage.Bind(instance=instance1, app_host="school", state="creating")]
         strg = mock.Mock()
         strg.retrieve_units.return_value = units
         strg.retrieve_binds.return_value = binds
@@ -142,12 +186,147 @@ class VCLWriterTestCase(unittest.TestCase):
         writer.locker.unlock.assert_called_with(vcl_writer.BINDS_LOCKER)
         strg.retrieve_units.assert_called_once_with(state="started",
                                                     instance_name={"$in": ["wat", "wet"]})
-        strg.retrieve_binds.assert_called_once_with(state="creating", limit=3)
+        strg.retrieve_binds.assert_called_once_with(state="creating", limit=3,
+                                                    sort=storage.PRIORITY_SORT)
         expected_write_vcl_calls = [mock.call("unit1.cloud.tsuru.io", "abc123", "cool"),
                                     mock.call("unit2.cloud.tsuru.io", "abc321", "cool"),
-                                    mock.call("unit1.cloud.tsuru.io", "abc123", "bool"),
-                                    mock.call("unit2.cloud.tsuru.io", "abc321", "bool")]
+                                    mock.call("unit3.cloud.tsuru.io", "abc456", "bool")]
         self.assertEqual(expected_write_vcl_calls, manager.write_vcl.call_args_list)
         expected_update_bind_calls = [mock.call(binds[0], state="created"),
-                                      mock.call(binds[1], state="created")]
+                                      mock.call(binds[1], state="created"),
+                                      mock.call(binds[2], state="created")]
         self.assertEqual(expected_update_bind_calls, strg.update_bind.call_args_list)
+
+    def test_run_binds_continues_trace(self):
+        exporter = mock.Mock()
+        tracing.set_exporter(exporter)
+        self.addCleanup(tracing.set_exporter, None)
+        bind = storage.Bind(instance=storage.Instance(name="wat"), app_host="cool",
+                            state="creating", trace_id="abc123")
+        strg = mock.Mock()
+        strg.retrieve_units.return_value = []
+        strg.retrieve_binds.return_value = [bind]
+        writer = vcl_writer.VCLWriter(mock.Mock(storage=strg))
+        writer.locker = mock.Mock()
+        writer.run_binds()
+        span = exporter.export.call_args[0][0]
+        self.assertEqual("vcl_writer.bind", span["name"])
+        self.assertEqual("abc123", span["trace_id"])
+        self.assertEqual({"instance": "wat", "app_host": "cool"}, span["attributes"])
+
+    def test_run_unbinds(self):
+        units = [storage.Unit(id="i-0800", dns_name="unit1.cloud.tsuru.io", secret="abc123",
+                              state="started", instance=storage.Instance(name="wat")),
+                 storage.Unit(id="i-8001", dns_name="unit2.cloud.tsuru.io", secret="abc321",
+                              state="started", instance=storage.Instance(name="wet"))]
+        binds = [storage.Bind(instance=storage.Instance(name="wat"), app_host="cool",
+                              state="removing"),
+                 storage.Bind(instance=storage.Instance(name="wet"), app_host="bool",
+                              state="removing")]
+        strg = mock.Mock()
+        strg.retrieve_units.return_value = units
+        strg.retrieve_binds.return_value = binds
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, max_items=3, concurrency=2)
+        writer.locker = mock.Mock()
+        writer.run_unbinds()
+        writer.locker.lock.assert_called_with(vcl_writer.UNBINDS_LOCKER)
+        writer.locker.unlock.assert_called_with(vcl_writer.UNBINDS_LOCKER)
+        strg.retrieve_binds.assert_called_once_with(state="removing", limit=3,
+                                                    sort=storage.PRIORITY_SORT)
+        query = strg.retrieve_units.call_args[1]
+        self.assertEqual("started", query["state"])
+        self.assertEqual(["wat", "wet"], sorted(query["instance_name"]["$in"]))
+        expected_remove_vcl_calls = [mock.call("unit1.cloud.tsuru.io", "abc123"),
+                                     mock.call("unit2.cloud.tsuru.io", "abc321")]
+        self.assertEqual(expected_remove_vcl_calls,
+                         sorted(manager.remove_vcl.call_args_list))
+        removed = [c[0][0] for c in strg.remove_bind.call_args_list]
+        self.assertEqual(["bool", "cool"], sorted([b.app_host for b in removed]))
+        self.assertFalse(strg.update_bind.called)
+
+    @mock.patch("sys.stderr")
+    def test_run_unbinds_keeps_failed_binds(self, stderr):
+        units = [storage.Unit(id="i-0800", dns_name="unit1.cloud.tsuru.io", secret="abc123",
+                              state="started", instance=storage.Instance(name="wat")),
+                 storage.Unit(id="i-8001", dns_name="unit2.cloud.tsuru.io", secret="abc321",
+                              state="started", instance=storage.Instance(name="wat"))]
+        bind = storage.Bind(instance=storage.Instance(name="wat"), app_host="cool",
+                            state="removing")
+        strg = mock.Mock()
+        strg.retrieve_units.return_value = units
+        strg.retrieve_binds.return_value = [bind]
+        manager = mock.Mock(storage=strg)
+
+        def remove_vcl(dns_name, secret):
+            if dns_name == "unit2.cloud.tsuru.io":
+                raise ValueError("connection refused")
+
+        manager.remove_vcl.side_effect = remove_vcl
+        writer = vcl_writer.VCLWriter(manager)
+        writer.locker = mock.Mock()
+        writer.run_unbinds()
+        self.assertEqual(2, manager.remove_vcl.call_count)
+        self.assertFalse(strg.remove_bind.called)
+        stderr.write.assert_called_with("[ERROR] failed to remove VCL from unit i-8001 of "
+                                        "instance wat: connection refused\n")
+
+    @mock.patch("sys.stderr")
+    @mock.patch("varnish.VarnishHandler")
+    def test_run_unbinds_many_binds_and_retry(self, VarnishHandler, stderr):
+        configs = set(["10.0.0.1:6082", "10.0.0.2:6082"])
+        down = set(["10.0.0.2:6082"])
+        discards = []
+
+        def handler(addr, secret):
+            def vcl_discard(name):
+                discards.append(addr)
+                if addr in down:
+                    raise ValueError("connection refused")
+                if addr not in configs:
+                    raise AssertionError("106 No configuration named feaas known.")
+                configs.remove(addr)
+            return mock.Mock(vcl_discard=vcl_discard)
+
+        VarnishHandler.side_effect = handler
+        strg = storage.MemoryStorage()
+        instance = storage.Instance(name="wat", state="started", units=[
+            storage.Unit(id="i-0800", dns_name="10.0.0.1", secret="abc", state="started"),
+            storage.Unit(id="i-0801", dns_name="10.0.0.2", secret="def", state="started")])
+        strg.store_instance(instance)
+        for app_host in ("cool", "bool"):
+            strg.store_bind(storage.Bind(app_host, instance, state="removing"))
+        writer = vcl_writer.VCLWriter(managers.BaseManager(strg), concurrency=2)
+        writer.run_unbinds()
+        self.assertEqual(["10.0.0.1:6082", "10.0.0.2:6082"], sorted(discards))
+        self.assertEqual(2, len(strg.retrieve_binds(state="removing")))
+        down.clear()
+        writer.run_unbinds()
+        self.assertEqual(4, len(discards))
+        self.assertEqual(set(), configs)
+        self.assertEqual([], strg.retrieve_binds())
+
+    def test_run_unbinds_nothing_to_do(self):
+        strg = mock.Mock()
+        strg.retrieve_binds.return_value = []
+        writer = vcl_writer.VCLWriter(mock.Mock(storage=strg))
+        writer.locker = mock.Mock()
+        writer.run_unbinds()
+        self.assertFalse(strg.retrieve_units.called)
+        self.assertIsNone(writer.executor)
+        writer.locker.unlock.assert_called_with(vcl_writer.UNBINDS_LOCKER)
+
+    def test_run_binds_sharded(self):
+        strg = mock.Mock()
+        strg.retrieve_binds.return_value = []
+        strg.retrieve_units.return_value = []
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, max_items=3, sharded=True)
+        writer.shard = mock.Mock()
+        writer.shard.query.return_value = {"shard": {"$in": [2]}}
+        writer.locker = mock.Mock()
+        writer.run_binds()
+        self.assertFalse(writer.locker.lock.called)
+        strg.retrieve_binds.assert_called_once_with(state="creating", limit=3,
+                                                    sort=storage.PRIORITY_SORT,
+                                                    shard={"$in": [2]})